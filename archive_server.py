@@ -0,0 +1,250 @@
+"""
+A long-lived server process that performs operations on archives
+using PSRCHIVE's python bindings.
+
+Running a PSRCHIVE command line tool (e.g. 'pam', 'psrstat')
+pays the full start-up cost of the program, including loading
+plugins, every time it is called. The server loads PSRCHIVE once
+and then accepts a queue of operations, so the per-operation
+overhead is only a round trip through a pipe.
+
+Errors are reported the same way as 'utils.execute', i.e. by
+raising errors.SystemCallError.
+"""
+import os
+import multiprocessing
+import traceback
+
+from coast_guard import utils
+from coast_guard import errors
+
+
+# Operations the server knows how to perform.
+# The keys are operation names, the values are functions.
+# The first argument of each function is the psrchive module.
+OPERATIONS = {}
+
+
+def operation(func):
+    """A decorator to register an operation that can be
+        performed by the archive server.
+
+        Input:
+            func: The function implementing the operation.
+                The first argument must be the psrchive module.
+
+        Output:
+            func: The input function, unmodified.
+    """
+    OPERATIONS[func.__name__] = func
+    return func
+
+
+@operation
+def snr(psrchive, fn):
+    """Equivalent to "psrstat -Qq -j DTFp -c 'snr' <fn>".
+    """
+    ar = psrchive.Archive_load(fn)
+    ar.dedisperse()
+    ar.tscrunch()
+    ar.fscrunch()
+    ar.pscrunch()
+    return ar.get_Profile(0, 0, 0).snr()
+
+
+@operation
+def setnchan(psrchive, fn, nchan):
+    """Equivalent to "pam -m --setnchn <nchan> <fn>".
+    """
+    ar = psrchive.Archive_load(fn)
+    ar.fscrunch_to_nchan(int(nchan))
+    ar.unload(fn)
+
+
+@operation
+def setnsub(psrchive, fn, nsub):
+    """Equivalent to "pam -m --setnsub <nsub> <fn>".
+    """
+    ar = psrchive.Archive_load(fn)
+    ar.tscrunch_to_nsub(int(nsub))
+    ar.unload(fn)
+
+
+def serve(conn):
+    """Serve requests received through 'conn' until 'None'
+        is received, or the connection is closed.
+
+        Each request is a tuple (opname, args). A reply is sent
+        for each request. Replies are tuples (success, result),
+        where 'result' is the operation's return value if
+        'success' is True, and an error message otherwise.
+
+        Input:
+            conn: A multiprocessing connection object.
+
+        Outputs:
+            None
+    """
+    import psrchive
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        opname, args = request
+        try:
+            result = OPERATIONS[opname](psrchive, *args)
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+        else:
+            conn.send((True, result))
+    conn.close()
+
+
+class ArchiveServer(object):
+    def __init__(self):
+        """An archive server running in a separate process.
+            The process is started on demand.
+        """
+        self.proc = None
+        self.conn = None
+
+    def start(self):
+        """Start the server process.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=serve,
+                                            name="archive_server",
+                                            args=(child_conn,))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        utils.print_debug("Started archive server (PID: %d)" %
+                          self.proc.pid, 'syscalls')
+
+    def stop(self):
+        """Stop the server process.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        if self.proc is None:
+            return
+        try:
+            self.conn.send(None)
+        except IOError:
+            # Server has already gone away
+            pass
+        self.conn.close()
+        self.proc.join()
+        self.proc = None
+        self.conn = None
+
+    def is_running(self):
+        return (self.proc is not None) and self.proc.is_alive()
+
+    def call_many(self, ops):
+        """Perform a queue of operations. All requests are sent
+            before waiting for the replies.
+
+            Input:
+                ops: A list of (opname, args) tuples.
+
+            Output:
+                results: A list of the operations' results, in order.
+                    If an operation failed, the error is raised once
+                    all replies have been read.
+        """
+        for opname, args in ops:
+            if opname not in OPERATIONS:
+                raise errors.UnrecognizedValueError("Archive server "
+                                    "operation (%s) is not recognized. "
+                                    "Valid operations are '%s'." %
+                                    (opname, "', '".join(OPERATIONS.keys())))
+        if not self.is_running():
+            self.start()
+        for opname, args in ops:
+            utils.print_debug("'%s%r' (archive server)" % (opname, args),
+                              'syscalls', stepsback=2)
+            self.conn.send((opname, args))
+        results = []
+        failure = None
+        for opname, args in ops:
+            try:
+                success, result = self.conn.recv()
+            except EOFError:
+                # The server died (e.g. segfaulted). Clean up so that
+                # a new server is started for the next call.
+                self.proc.join()
+                exitcode = self.proc.exitcode
+                self.proc = None
+                self.conn = None
+                raise errors.SystemCallError("Execution of operation "
+                                    "(%s%r) terminated by archive server "
+                                    "exiting (%s)!" % (opname, args, exitcode))
+            if (not success) and (failure is None):
+                # Keep reading, so the replies to the remaining
+                # operations aren't left in the pipe
+                failure = errors.SystemCallError("Execution of operation "
+                                    "(%s%r) failed!\nError output:\n%s" %
+                                    (opname, args, result))
+            results.append(result)
+        if failure is not None:
+            raise failure
+        return results
+
+    def call(self, opname, *args):
+        """Perform a single operation.
+
+            Inputs:
+                opname: The name of the operation.
+                *args: Arguments to pass to the operation.
+
+            Output:
+                result: The operation's return value.
+        """
+        return self.call_many([(opname, args)])[0]
+
+
+# One server per process
+__servers = {}
+
+
+def get_server():
+    """Get the archive server for the current process.
+
+        Inputs:
+            None
+
+        Output:
+            server: An ArchiveServer object.
+    """
+    pid = os.getpid()
+    if pid not in __servers:
+        __servers[pid] = ArchiveServer()
+    return __servers[pid]
+
+
+def call(opname, *args):
+    """Perform an operation using the current process'
+        archive server.
+
+        Inputs:
+            opname: The name of the operation.
+            *args: Arguments to pass to the operation.
+
+        Output:
+            result: The operation's return value.
+    """
+    return get_server().call(opname, *args)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Measure the overhead of logging calls whose messages are
+suppressed (i.e. verbosity too low, or debugging mode off).
+Walking the call stack with 'inspect.stack' is timed for
+comparison.
+"""
+import inspect
+import timeit
+
+from coast_guard import config
+from coast_guard import utils
+
+
+def suppressed_info():
+    utils.print_info("Suppressed message", config.verbosity+100)
+
+
+def suppressed_debug():
+    utils.print_debug("Suppressed message", 'queries')
+
+
+def unlogged_message():
+    utils.log_message("Unlogged message", 'debug')
+
+
+def stack_walk():
+    inspect.stack()[1][1:4]
+
+
+def main():
+    # Make sure messages are suppressed
+    config.debug.set_allmodes_off()
+    for name, func in [('print_info (suppressed)', suppressed_info),
+                       ('print_debug (mode off)', suppressed_debug),
+                       ('log_message (not logged)', unlogged_message),
+                       ('inspect.stack (for comparison)', stack_walk)]:
+        secs = min(timeit.repeat(func, number=args.num, repeat=3))
+        print "%-32s %8.3f us per call" % (name, secs/args.num*1e6)
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Measure the overhead of " \
+                        "suppressed logging calls.")
+    parser.add_argument("-n", "--num-calls", dest='num', type=int, \
+                        default=10000, \
+                        help="Number of calls to time. (Default: 10000)")
+    args = parser.parse_args()
+    main()
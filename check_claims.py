@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Check that claiming work is safe when several processes share
+one database, using a throw-away SQLite database:
+    - Processes racing to claim the same files and directories
+      each get a disjoint share, and every one is claimed once.
+    - The lease of a claim that is renewed doesn't expire.
+    - The claim of a process that has gone away expires, its file
+      is held back for a backoff and then put back in the queue,
+      and only one of several processes reclaiming at once
+      records it.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+from coast_guard import config
+from coast_guard import utils
+from coast_guard import claims
+from coast_guard import database
+
+
+# Tables used by claims, in an order that satisfies foreign keys
+TABLES = ['versions', 'directories', 'obs', 'files', 'claims',
+          'reattempts']
+
+
+def create_database(dbfn, nfiles, ndirs):
+    """Create a SQLite database with new files and directories.
+
+        Inputs:
+            dbfn: The name of the database file.
+            nfiles: The number of files to insert.
+            ndirs: The number of directories to insert.
+
+        Outputs:
+            None
+    """
+    config.dburl = "sqlite:///%s" % dbfn
+    engine = database.get_engine(config.dburl)
+    for name in TABLES:
+        database.schema.metadata.tables[name].create(engine)
+    db = database.Database()
+    with db.transaction() as conn:
+        conn.execute(db.files.insert(),
+                     [{'file_id': ii,
+                       'filepath': "/tmp",
+                       'filename': "file%d" % ii,
+                       'stage': 'grouped',
+                       'status': 'new',
+                       'md5sum': "%d" % ii,
+                       'ephem_md5sum': "",
+                       'coords': "",
+                       'filesize': 0} for ii in xrange(1, nfiles+1)])
+        conn.execute(db.directories.insert(),
+                     [{'dir_id': ii,
+                       'path': "/tmp/dir%d" % ii,
+                       'status': 'new'} for ii in xrange(1, ndirs+1)])
+
+
+def claim_all(nfiles, ndirs, results):
+    """Try to claim every file and directory. Report the IDs
+        of those claimed.
+    """
+    db = database.Database()
+    file_ids = [ii for ii in xrange(1, nfiles+1)
+                if claims.claim_file(db, ii, 'combine')]
+    dir_ids = [ii for ii in xrange(1, ndirs+1)
+               if claims.claim_directory(db, ii)]
+    results.put((file_ids, dir_ids))
+
+
+def hold_claims(resources):
+    """Hold on to claims by renewing them for a while.
+    """
+    renewer = claims.LeaseRenewer()
+    for resource in resources:
+        renewer.add(resource)
+    renewer.start()
+    time.sleep(4*config.claim_lease)
+    renewer.stop()
+
+
+def reclaim(results):
+    """Handle expired claims. Report the IDs of files put back
+        in the queue.
+    """
+    results.put(claims.reclaim_expired(database.Database()))
+
+
+def run_procs(target, args, nprocs, results=None):
+    """Run 'target' in several processes at once, and collect
+        what they report to 'results'.
+    """
+    procs = [multiprocessing.Process(target=target, args=args)
+             for ii in xrange(nprocs)]
+    for proc in procs:
+        proc.start()
+    reported = []
+    if results is not None:
+        reported = [results.get() for proc in procs]
+    for proc in procs:
+        proc.join()
+    return reported
+
+
+def check(ok, msg):
+    print "%s: %s" % ("ok" if ok else "FAILED", msg)
+    return ok
+
+
+def main():
+    config.claim_lease = args.lease
+    config.retry_backoff = args.lease
+    config.max_task_retries = 3
+    tmpdir = tempfile.mkdtemp(suffix="_claims")
+    passed = True
+    try:
+        create_database(os.path.join(tmpdir, "claims.db"),
+                        args.nfiles, args.ndirs)
+        db = database.Database()
+        results = multiprocessing.Queue()
+
+        # Race to claim everything
+        reported = run_procs(claim_all, (args.nfiles, args.ndirs, results),
+                             args.nprocs, results)
+        file_ids = sum([fids for fids, dids in reported], [])
+        dir_ids = sum([dids for fids, dids in reported], [])
+        passed &= check(sorted(file_ids) == range(1, args.nfiles+1),
+                        "%d processes claimed %d files once each "
+                        "(shares: %s)" %
+                        (args.nprocs, args.nfiles,
+                         ", ".join([str(len(fids)) for fids, dids
+                                    in reported])))
+        passed &= check(sorted(dir_ids) == range(1, args.ndirs+1),
+                        "%d processes claimed %d directories once each" %
+                        (args.nprocs, args.ndirs))
+
+        # File 1's claim is renewed. File 2's claim was taken out
+        # by a process that has exited without releasing it.
+        held = multiprocessing.Process(target=hold_claims,
+                        args=([claims.get_file_resource(1)],))
+        held.start()
+        # Release everything else
+        for file_id in xrange(3, args.nfiles+1):
+            claims.release(db, claims.get_file_resource(file_id))
+        for dir_id in xrange(1, args.ndirs+1):
+            claims.release(db, claims.get_dir_resource(dir_id))
+        time.sleep(1.5*config.claim_lease)
+
+        run_procs(reclaim, (results,), args.nprocs, results)
+        with db.transaction() as conn:
+            rows = conn.execute(db.select([db.claims])).fetchall()
+            reattempts = conn.execute(db.select([db.reattempts])).\
+                                fetchall()
+        workers = dict([(row['file_id'], row['worker']) for row in rows])
+        passed &= check(1 in workers and
+                            workers[1] != claims.BACKOFF_WORKER,
+                        "Renewed claim is kept")
+        passed &= check(workers.get(2) == claims.BACKOFF_WORKER,
+                        "Expired claim of an exited process is held back "
+                        "for a backoff")
+        passed &= check([row['file_id'] for row in reattempts] == [2],
+                        "Lost attempt is recorded once by %d processes "
+                        "reclaiming at once" % args.nprocs)
+
+        time.sleep(1.5*config.retry_backoff)
+        reported = run_procs(reclaim, (results,), args.nprocs, results)
+        passed &= check(sorted(sum(reported, [])) == [2],
+                        "File is put back in the queue once after its "
+                        "backoff")
+        reported = run_procs(claim_all, (args.nfiles, 0, results),
+                             args.nprocs, results)
+        passed &= check(sorted(sum([fids for fids, dids in reported],
+                                   [])) == [2],
+                        "Requeued file is claimed again once")
+        held.join()
+    finally:
+        shutil.rmtree(tmpdir)
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Check that claiming "
+                        "work is safe with several processes sharing a "
+                        "(throw-away SQLite) database.")
+    parser.add_argument("-P", "--num-procs", dest='nprocs', type=int,
+                        default=4,
+                        help="Number of processes competing for work. "
+                             "(Default: 4)")
+    parser.add_argument("-n", "--num-files", dest='nfiles', type=int,
+                        default=200,
+                        help="Number of files to claim. (Default: 200)")
+    parser.add_argument("--num-dirs", dest='ndirs', type=int,
+                        default=20,
+                        help="Number of directories to claim. "
+                             "(Default: 20)")
+    parser.add_argument("--lease", dest='lease', type=int, default=2,
+                        help="Length of leases, in seconds. (Default: 2)")
+    args = parser.parse_args()
+    main()
@@ -10,6 +10,7 @@ from coast_guard import utils
 from coast_guard import list_files
 from coast_guard import make_template
 from coast_guard import errors
+from coast_guard import scratch
 from coast_guard import reduce_data
 
 from toaster.toolkit.timfiles import readers
@@ -170,9 +171,12 @@ def main():
                 utils.execute(cmd)
                 arfn = os.path.join(scrunchdir, os.path.basename(fn+ext))
                 parfn = utils.get_norm_parfile(arfn)
-                # Re-install ephemeris
-                cmd = ['pam', '-Tp', '-E', parfn, '-m', arfn]+scrunchargs
-                utils.execute(cmd)
+                try:
+                    # Re-install ephemeris
+                    cmd = ['pam', '-Tp', '-E', parfn, '-m', arfn]+scrunchargs
+                    utils.execute(cmd)
+                finally:
+                    scratch.release(parfn)
 
             toas = []
             mjds = []
@@ -0,0 +1,590 @@
+"""
+Claim work so any number of 'reduce_data.py' instances, on
+any number of hosts, can share one database.
+
+A file is claimed with a conditional update of its status, so
+only one instance can move it from 'new' to 'submitted'. The
+claim is recorded in the 'claims' table along with a lease and the
+identity (host:pid) of the claiming instance, which is replaced by
+the worker process's when it starts the task. The worker renews the
+lease (its heartbeat) until it is done. While a task waits in the
+worker pool, the scheduler renews its lease instead. If a worker
+dies, or its host does, its leases expire. Whichever instance
+notices first records the lost attempt in the 'reattempts' table
+and puts the file back in the queue after an exponential backoff.
+Files that keep losing their workers are marked as failed.
+
+Directories are claimed for grouping the same way, with a conditional
+update of their status from 'new' to 'running' and a leased claim. A
+directory whose claim expires is put back in the queue.
+
+Locks shared between hosts (e.g. for calibrator databases) are
+claims too. They are acquired by inserting a row for the lock,
+which the unique 'resource' column allows only once.
+"""
+import os
+import time
+import socket
+import datetime
+import threading
+
+import sqlalchemy as sa
+
+from coast_guard import config
+from coast_guard import database
+from coast_guard import utils
+
+
+# Name recorded in the 'reattempts' table for retries of
+# tasks whose workers were lost
+REAPER_USER = "reduce_data"
+
+# Worker names of claims that aren't held by a real worker
+BACKOFF_WORKER = "(backoff)"
+UNKNOWN_WORKER = "(unknown)"
+
+# Maximum number of seconds to wait before retrying a task
+MAX_BACKOFF = 24*3600
+
+
+def get_worker_id():
+    """Get the identity of the current process, as recorded
+        in claims.
+
+        Inputs:
+            None
+
+        Output:
+            worker: A 'host:pid' string.
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def get_file_resource(file_id):
+    """Get the name of the resource for a file's claim.
+    """
+    return "file:%d" % file_id
+
+
+def get_dir_resource(dir_id):
+    """Get the name of the resource for a directory's claim.
+    """
+    return "dir:%d" % dir_id
+
+
+def get_lease_expiry(db, lease=None):
+    """Get the time a lease taken out now expires. The database's
+        clock is used, so hosts whose clocks differ agree on when
+        leases expire.
+
+        Inputs:
+            db: A Database object to use.
+            lease: The length of the lease in seconds.
+                (Default: config.claim_lease)
+
+        Output:
+            expires: An SQL expression for the expiry time.
+    """
+    if lease is None:
+        lease = config.claim_lease
+    return db.time_from_now(lease)
+
+
+def claim_file(db, file_id, action=None, status='new'):
+    """Claim a file for processing by marking it as submitted,
+        unless something else has claimed it first.
+
+        Inputs:
+            db: A Database object to use.
+            file_id: The ID of the file to claim.
+            action: The action that will be performed.
+                (Default: not recorded)
+            status: The status the file must still have.
+                (Default: 'new')
+
+        Output:
+            claimed: True if the file was claimed.
+    """
+    resource = get_file_resource(file_id)
+    with db.transaction() as conn:
+        update = db.files.update().\
+                    where((db.files.c.file_id == file_id) &
+                          (db.files.c.status == status)).\
+                    values(status='submitted',
+                            last_modified=datetime.datetime.now())
+        result = conn.execute(update)
+        claimed = (result.rowcount == 1)
+        result.close()
+        if claimed:
+            # Any earlier claim on the file is stale, since
+            # the file wasn't in the queue
+            delete = db.claims.delete().\
+                        where(db.claims.c.resource == resource)
+            conn.execute(delete)
+            insert = db.claims.insert().\
+                        values(resource=resource,
+                               file_id=file_id,
+                               action=action,
+                               worker=get_worker_id(),
+                               lease_expires=get_lease_expiry(db))
+            conn.execute(insert)
+    if claimed:
+        utils.print_debug("Claimed File ID %d" % file_id, 'reduce')
+    return claimed
+
+
+def claim_directory(db, dir_id):
+    """Claim a directory for grouping by marking it as running,
+        unless something else has claimed it first.
+
+        Inputs:
+            db: A Database object to use.
+            dir_id: The ID of the directory to claim.
+
+        Output:
+            claimed: True if the directory was claimed.
+    """
+    resource = get_dir_resource(dir_id)
+    with db.transaction() as conn:
+        update = db.directories.update().\
+                    where((db.directories.c.dir_id == dir_id) &
+                          (db.directories.c.status == 'new')).\
+                    values(status='running',
+                            last_modified=datetime.datetime.now())
+        result = conn.execute(update)
+        claimed = (result.rowcount == 1)
+        result.close()
+        if claimed:
+            # Any earlier claim on the directory is stale, since
+            # the directory wasn't in the queue
+            delete = db.claims.delete().\
+                        where(db.claims.c.resource == resource)
+            conn.execute(delete)
+            insert = db.claims.insert().\
+                        values(resource=resource,
+                               worker=get_worker_id(),
+                               lease_expires=get_lease_expiry(db))
+            conn.execute(insert)
+    if claimed:
+        utils.print_debug("Claimed Dir ID %d" % dir_id, 'reduce')
+    return claimed
+
+
+def renew(db, resource, lease=None):
+    """Extend the lease of a claim.
+
+        Inputs:
+            db: A Database object to use.
+            resource: The claimed resource.
+            lease: The number of seconds from now the lease
+                should expire. (Default: config.claim_lease)
+
+        Output:
+            renewed: True if the claim still existed.
+    """
+    with db.transaction() as conn:
+        update = db.claims.update().\
+                    where(db.claims.c.resource == resource).\
+                    values(lease_expires=get_lease_expiry(db, lease),
+                           last_modified=datetime.datetime.now())
+        result = conn.execute(update)
+        renewed = (result.rowcount == 1)
+        result.close()
+    return renewed
+
+
+def take_over(db, resource, lease=None):
+    """Record the current process as the worker holding a claim,
+        and renew its lease. Workers call this when they start a
+        task on a file claimed by the scheduler.
+
+        Inputs:
+            db: A Database object to use.
+            resource: The claimed resource.
+            lease: The number of seconds from now the lease
+                should expire. (Default: config.claim_lease)
+
+        Output:
+            taken: True if the claim still existed.
+    """
+    with db.transaction() as conn:
+        update = db.claims.update().\
+                    where(db.claims.c.resource == resource).\
+                    values(worker=get_worker_id(),
+                           lease_expires=get_lease_expiry(db, lease),
+                           last_modified=datetime.datetime.now())
+        result = conn.execute(update)
+        taken = (result.rowcount == 1)
+        result.close()
+    return taken
+
+
+def release(db, resource, worker=None):
+    """Remove a claim.
+
+        Inputs:
+            db: A Database object to use.
+            resource: The claimed resource.
+            worker: Only remove the claim if it belongs to this
+                worker. (Default: remove the claim regardless)
+
+        Outputs:
+            None
+    """
+    whereclause = (db.claims.c.resource == resource)
+    if worker is not None:
+        whereclause &= (db.claims.c.worker == worker)
+    with db.transaction() as conn:
+        conn.execute(db.claims.delete().where(whereclause))
+
+
+def count_retries(conn, db, file_id):
+    """Count the number of times a file has been put back in
+        the queue after its worker was lost.
+
+        Inputs:
+            conn: The connection to use.
+            db: A Database object.
+            file_id: The ID of the file.
+
+        Output:
+            nretries: The number of retries.
+    """
+    select = db.select([sa.func.count()]).\
+                where((db.reattempts.c.file_id == file_id) &
+                      (db.reattempts.c.user == REAPER_USER))
+    results = conn.execute(select)
+    nretries = results.scalar()
+    results.close()
+    return nretries
+
+
+def requeue_lost(conn, db, claimrow):
+    """Deal with a file whose worker stopped renewing its claim.
+        The lost attempt is recorded in the 'reattempts' table.
+        The file is put back in the queue after a backoff, unless
+        it has been retried too many times already.
+
+        Inputs:
+            conn: The connection to use. The expired claim
+                must have been removed within its transaction.
+            db: A Database object.
+            claimrow: The expired claim's row.
+
+        Output:
+            requeued: True if the file will be retried.
+    """
+    file_id = claimrow['file_id']
+    select = db.select([db.files.c.obs_id, db.files.c.status]).\
+                where(db.files.c.file_id == file_id)
+    results = conn.execute(select)
+    filerow = results.fetchone()
+    results.close()
+    if (filerow is None) or \
+            (filerow['status'] not in ('submitted', 'running')):
+        # The worker finished the task before it was lost
+        return False
+    nretries = count_retries(conn, db, file_id)+1
+    insert = db.reattempts.insert().\
+                values(file_id=file_id,
+                       obs_id=filerow['obs_id'],
+                       user=REAPER_USER,
+                       note="Worker %s stopped renewing its claim "
+                            "(attempt %d)" % (claimrow['worker'], nretries))
+    conn.execute(insert)
+    if nretries > config.max_task_retries:
+        update = db.files.update().\
+                    where(db.files.c.file_id == file_id).\
+                    values(status='failed',
+                           note="Gave up after losing %d workers. Last "
+                                "worker: %s" % (nretries,
+                                                claimrow['worker']),
+                           last_modified=datetime.datetime.now())
+        conn.execute(update)
+        utils.print_info("Giving up on File ID %d after %d lost "
+                         "attempts" % (file_id, nretries), 0)
+        return False
+    # Hold the file back with a claim that expires when the
+    # backoff is over
+    backoff = min(config.retry_backoff*2**(nretries-1), MAX_BACKOFF)
+    insert = db.claims.insert().\
+                values(resource=get_file_resource(file_id),
+                       file_id=file_id,
+                       action=claimrow['action'],
+                       worker=BACKOFF_WORKER,
+                       lease_expires=get_lease_expiry(db, backoff))
+    conn.execute(insert)
+    update = db.files.update().\
+                where(db.files.c.file_id == file_id).\
+                values(status='submitted',
+                       note="Worker %s was lost. Will retry in %d s "
+                            "(attempt %d)" % (claimrow['worker'], backoff,
+                                              nretries+1),
+                       last_modified=datetime.datetime.now())
+    conn.execute(update)
+    utils.print_info("Worker %s lost File ID %d. Will retry in %d s" %
+                     (claimrow['worker'], file_id, backoff), 1)
+    return True
+
+
+def requeue_directory(conn, db, claimrow):
+    """Put a directory whose grouping was abandoned back in
+        the queue.
+
+        Inputs:
+            conn: The connection to use. The expired claim
+                must have been removed within its transaction.
+            db: A Database object.
+            claimrow: The expired claim's row.
+
+        Output:
+            requeued: True if the directory was put back in
+                the queue.
+    """
+    dir_id = int(claimrow['resource'].split(':', 1)[1])
+    update = db.directories.update().\
+                where((db.directories.c.dir_id == dir_id) &
+                      (db.directories.c.status == 'running')).\
+                values(status='new',
+                       note="Worker %s stopped renewing its claim "
+                            "while grouping" % claimrow['worker'],
+                       last_modified=datetime.datetime.now())
+    result = conn.execute(update)
+    requeued = bool(result.rowcount)
+    result.close()
+    if requeued:
+        utils.print_info("Worker %s lost Dir ID %d. It has been put "
+                         "back in the queue" %
+                         (claimrow['worker'], dir_id), 1)
+    return requeued
+
+
+def reclaim_expired(db):
+    """Handle expired claims. Files whose workers stopped
+        renewing their claims are retried after a backoff (see
+        'requeue_lost'). Files whose backoff is over, and
+        directories whose grouping was abandoned, are put back
+        in the queue. Expired claims on locks are removed.
+
+        Input:
+            db: A Database object to use.
+
+        Output:
+            file_ids: A list of IDs of files put back in the queue.
+    """
+    now = db.time_from_now()
+    with db.transaction() as conn:
+        select = db.select([db.claims]).\
+                    where(db.claims.c.lease_expires < now)
+        results = conn.execute(select)
+        rows = results.fetchall()
+        results.close()
+    file_ids = []
+    for row in rows:
+        with db.transaction() as conn:
+            # Only one instance gets to remove the claim
+            delete = db.claims.delete().\
+                        where((db.claims.c.claim_id == row['claim_id']) &
+                              (db.claims.c.lease_expires < now))
+            result = conn.execute(delete)
+            removed = (result.rowcount == 1)
+            result.close()
+            if removed and row['resource'].startswith("dir:"):
+                requeue_directory(conn, db, row)
+                continue
+            if not removed or (row['file_id'] is None):
+                continue
+            if row['worker'] != BACKOFF_WORKER:
+                requeue_lost(conn, db, row)
+                continue
+            update = db.files.update().\
+                        where((db.files.c.file_id == row['file_id']) &
+                              (db.files.c.status == 'submitted')).\
+                        values(status='new',
+                               last_modified=datetime.datetime.now())
+            result = conn.execute(update)
+            if result.rowcount:
+                file_ids.append(row['file_id'])
+            result.close()
+    return file_ids
+
+
+def find_orphans(db):
+    """Find files that are marked as submitted or running, and
+        directories marked as running, but that nobody has claimed
+        for a full lease (e.g. ones left behind by versions of
+        'reduce_data.py' that didn't record claims). An already
+        expired claim is recorded for each so 'reclaim_expired'
+        deals with them.
+
+        Input:
+            db: A Database object to use.
+
+        Output:
+            file_ids: A list of IDs of orphaned files found.
+    """
+    # Files' 'last_modified' times are written by the hosts
+    # that modify them, so compare them with this host's clock
+    cutoff = datetime.datetime.now() - \
+                datetime.timedelta(seconds=config.claim_lease)
+    with db.transaction() as conn:
+        select = db.select([db.files.c.file_id],
+                    from_obj=[db.files.\
+                        outerjoin(db.claims,
+                            onclause=db.claims.c.file_id ==
+                                    db.files.c.file_id)]).\
+                    where(db.files.c.status.in_(['submitted', 'running']) &
+                          (db.files.c.last_modified < cutoff) &
+                          (db.claims.c.claim_id == None))
+        results = conn.execute(select)
+        file_ids = [row['file_id'] for row in results]
+        results.close()
+        select = db.select([db.directories.c.dir_id]).\
+                    where((db.directories.c.status == 'running') &
+                          (db.directories.c.last_modified < cutoff))
+        results = conn.execute(select)
+        dir_ids = [row['dir_id'] for row in results]
+        results.close()
+    for dir_id in dir_ids:
+        try:
+            with db.transaction() as conn:
+                insert = db.claims.insert().\
+                            values(resource=get_dir_resource(dir_id),
+                                   worker=UNKNOWN_WORKER,
+                                   lease_expires=get_lease_expiry(db,
+                                                    -config.claim_lease))
+                conn.execute(insert)
+        except sa.exc.IntegrityError:
+            # Claimed by the process grouping it
+            continue
+        utils.print_debug("Dir ID %d has no claim" % dir_id, 'reduce')
+    found = []
+    for file_id in file_ids:
+        try:
+            with db.transaction() as conn:
+                insert = db.claims.insert().\
+                            values(resource=get_file_resource(file_id),
+                                   file_id=file_id,
+                                   worker=UNKNOWN_WORKER,
+                                   lease_expires=get_lease_expiry(db,
+                                                    -config.claim_lease))
+                conn.execute(insert)
+        except sa.exc.IntegrityError:
+            # Claimed in the meantime
+            continue
+        found.append(file_id)
+        utils.print_debug("File ID %d has no claim" % file_id, 'reduce')
+    return found
+
+
+class LeaseRenewer(threading.Thread):
+    def __init__(self, resource=None, lease=None):
+        """A thread that keeps renewing the leases of claims
+            until stopped.
+
+            Inputs:
+                resource: The claimed resource. More can be added
+                    with 'add'. (Default: none to start with)
+                lease: The length of the leases in seconds.
+                    (Default: config.claim_lease)
+        """
+        super(LeaseRenewer, self).__init__(name="lease:%s" %
+                                           (resource or "queued"))
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.resources = set()
+        if resource is not None:
+            self.resources.add(resource)
+        if lease is None:
+            lease = config.claim_lease
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def add(self, resource):
+        """Start renewing the lease of a claim.
+        """
+        with self.lock:
+            self.resources.add(resource)
+
+    def discard(self, resource):
+        """Stop renewing the lease of a claim.
+        """
+        with self.lock:
+            self.resources.discard(resource)
+
+    def run(self):
+        db = database.Database()
+        # Renew well before the lease expires
+        while not self.stopped.wait(self.lease/3.0):
+            with self.lock:
+                resources = list(self.resources)
+            for resource in resources:
+                try:
+                    if not renew(db, resource, self.lease):
+                        utils.print_info("Claim on %s has been lost" %
+                                         resource, 0)
+                        self.discard(resource)
+                except Exception, exc:
+                    # Keep trying. The lease might still be renewed
+                    # before it expires.
+                    utils.print_info("Could not renew claim on %s: %s" %
+                                     (resource, exc), 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class ClaimLock(object):
+    def __init__(self, resource, poll_interval=1.0):
+        """A lock shared by all hosts using the database.
+            Unlike multiprocessing's locks, it can be pickled
+            and sent to any process.
+
+            Inputs:
+                resource: The name of the locked resource.
+                poll_interval: Number of seconds to wait between
+                    attempts to acquire the lock. (Default: 1 s)
+        """
+        self.resource = resource
+        self.poll_interval = poll_interval
+        self.renewer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['renewer'] = None
+        return state
+
+    def acquire(self):
+        db = database.Database()
+        while True:
+            try:
+                with db.transaction() as conn:
+                    insert = db.claims.insert().\
+                                values(resource=self.resource,
+                                       worker=get_worker_id(),
+                                       lease_expires=get_lease_expiry(db))
+                    conn.execute(insert)
+            except sa.exc.IntegrityError:
+                # Somebody else holds the lock
+                reclaim_expired(db)
+                time.sleep(self.poll_interval)
+            else:
+                break
+        self.renewer = LeaseRenewer(self.resource)
+        self.renewer.start()
+        utils.print_debug("Acquired lock %s" % self.resource, 'reduce')
+
+    def release(self):
+        if self.renewer is not None:
+            self.renewer.stop()
+            self.renewer = None
+        release(database.Database(), self.resource, get_worker_id())
+        utils.print_debug("Released lock %s" % self.resource, 'reduce')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
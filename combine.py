@@ -15,6 +15,7 @@ import glob
 import collections
 import datetime
 import shutil
+import functools
 
 import numpy as np
 
@@ -23,6 +24,8 @@ from coast_guard import clean
 from coast_guard import config
 from coast_guard import errors
 from coast_guard import debug
+from coast_guard import scratch
+from coast_guard import dirscan
 
 
 SUBINT_GLOB = '[0-9]'*4+'-'+'[0-9]'*2+'-'+'[0-9]'*2+'-' + \
@@ -42,8 +45,20 @@ def get_start_from_singlepulse(single):
     return arf.datetime
 
 
-FILETYPE_SPECIFICS = {'subint': (SUBINT_GLOB, get_start_from_subint), \
-                      'single': (SP_GLOB, get_start_from_singlepulse)}
+def get_starts_from_subints(subdir, subints):
+    # Sub-int start times are parsed from file names all at once
+    return dirscan.get_subint_seconds(subints)
+
+
+def get_starts_from_singlepulses(subdir, singles):
+    starts = [get_start_from_singlepulse(os.path.join(subdir, single))
+              for single in singles]
+    return np.array([(start - starts[0]).total_seconds()
+                     for start in starts])
+
+
+FILETYPE_SPECIFICS = {'subint': (SUBINT_GLOB, get_starts_from_subints), \
+                      'single': (SP_GLOB, get_starts_from_singlepulses)}
 
 
 def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
@@ -87,7 +102,7 @@ def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
                                 "Possible values are: '%s'" % \
                             (filetype, "', '".join(FILETYPE_SPECIFICS.keys())))
     else:
-        globpat, get_start = FILETYPE_SPECIFICS[filetype]
+        globpat, get_starts = FILETYPE_SPECIFICS[filetype]
 
     # Ensure paths are absolute
     subdirs = [os.path.abspath(path) for path in subdirs]
@@ -99,14 +114,18 @@ def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
     nperdir = collections.Counter()
     noccurs = collections.Counter()
     nintotal = 0
+    # List each sub-band directory only once. Sub-band directories
+    # are only grouped once, so their listings aren't cached.
+    listings = {}
     for subdir in subdirs:
-        fns = glob.glob(os.path.join(subdir, globpat))
+        fns = dirscan.list_files(subdir, globpat, cache=False)
+        listings[subdir] = fns
         nn = len(fns)
         utils.print_debug("Found %d sub-int files in %s" % \
                             (nn, subdir), 'combine')
         nintotal += nn
         nperdir[subdir] = nn
-        noccurs.update([os.path.basename(fn) for fn in fns])
+        noccurs.update(fns)
     nsubints = len(noccurs)
 
     # Remove sub-bands that have too few subints
@@ -120,8 +139,7 @@ def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
             subdirs.pop(ii)
             del nperdir[subdir]
 
-            fns = glob.glob(os.path.join(subdir, globpat))
-            noccurs.subtract([os.path.basename(fn) for fn in fns])
+            noccurs.subtract(listings[subdir])
             nsubbands -= 1
 
     # Remove subints that are no longer included in any subbands
@@ -133,26 +151,29 @@ def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
         del noccurs[fn]
     
     # Now combine subints
-    lastsubint = datetime.datetime.min
-    filestart = datetime.datetime.min
     groups = []
     if nsubbands:
+        tocombine = []
         for subint in sorted(noccurs):
             if noccurs[subint] < nsubbands:
                 utils.print_info("Ignoring sub-int (%s). It doesn't apear in all " \
                                 "subbands (only %d of %d)" % \
                                 (subint, noccurs[subint], nsubbands), 2)
                 continue
-            start = get_start(os.path.join(subdirs[0], subint))
-            if ((start - filestart).total_seconds() > maxspan) or \
-                        ((start - lastsubint).total_seconds() > maxgap):
-                filestart = start
-                utils.print_debug("Starting a new file at %s" % \
-                        filestart, 'combine')
-                # Start a new file
-                groups.append([])
-            groups[-1].append(subint)
-            lastsubint = start
+            tocombine.append(subint)
+        if tocombine:
+            starts = get_starts(subdirs[0], tocombine)
+            filestart = lastsubint = None
+            for subint, start in zip(tocombine, starts):
+                if (filestart is None) or (start - filestart > maxspan) or \
+                            (start - lastsubint > maxgap):
+                    filestart = start
+                    utils.print_debug("Starting a new file at %s" % \
+                            subint, 'combine')
+                    # Start a new file
+                    groups.append([])
+                groups[-1].append(subint)
+                lastsubint = start
     nused = sum([len(grp) for grp in groups])
     utils.print_info("Grouped %d files from %d directories into %d groups.\n" \
                      "(Threw out %d directories and %d files)" % \
@@ -161,6 +182,26 @@ def group_subband_dirs(subdirs, maxspan=None, maxgap=None, \
     return subdirs, groups
 
 
+def get_input_size(subdirs, subints):
+    """Get the total size of the sub-ints to be combined.
+
+        Inputs:
+            subdirs: List of sub-band directories containing 
+                sub-ints to combine
+            subints: List of subint files to be combined.
+
+        Output:
+            nbytes: The total size of the files, in bytes.
+    """
+    nbytes = 0
+    for subdir in subdirs:
+        for subint in subints:
+            fn = os.path.join(subdir, subint)
+            if os.path.exists(fn):
+                nbytes += os.path.getsize(fn)
+    return nbytes
+
+
 def write_listing(subdirs, subints, outfn):
     """Write a text file containing a listing of subints
         that should be combined.
@@ -237,6 +278,32 @@ def read_listing(infn):
     return subdirs, subints
 
 
+def get_preproc(effix=False, backend=None):
+    """Get the preprocessing jobs to run on sub-ints before
+        combining them.
+
+        Inputs:
+            effix: Change observation site to eff_psrix to correct 
+                for asterix clock offsets. (Default: False)
+            backend: Name of the backend. (Default: leave as is)
+
+        Output:
+            preproc: A comma-separated string of jobs, suitable
+                for 'paz -j'.
+    """
+    preproc = 'convert psrfits'
+    if effix:
+        preproc += ',edit site=eff_psrix'
+    if backend:
+        if ("," in backend) or ("=" in backend) or (' ' in backend):
+            raise errors.UnrecognizedValueError("Backend value (%s) is "
+                                                "invalid. It cannot "
+                                                "contain ',' or '=' or "
+                                                "' '" % backend)
+        preproc += ',edit be:name=%s' % backend
+    return preproc
+
+
 def prepare_subints(subdirs, subints, baseoutdir, trimpcnt=6.25, effix=False,
                     backend=None):
     """Prepare subints by
@@ -265,7 +332,8 @@ def prepare_subints(subdirs, subints, baseoutdir, trimpcnt=6.25, effix=False,
     """
     devnull = open(os.devnull)
     tmpsubdirs = []
-    for subdir in utils.show_progress(subdirs, width=50):
+    cmds = []
+    for subdir in subdirs:
         freqdir = os.path.split(os.path.abspath(subdir))[-1]
         freqdir = os.path.join(baseoutdir, freqdir)
         try:
@@ -274,28 +342,270 @@ def prepare_subints(subdirs, subints, baseoutdir, trimpcnt=6.25, effix=False,
             # Directory already exists
             pass
         fns = [os.path.join(subdir, fn) for fn in subints]
-        preproc = 'convert psrfits'
-        if effix:
-            preproc += ',edit site=eff_psrix'
-        if backend:
-            if ("," in backend) or ("=" in backend) or (' ' in backend):
-                raise errors.UnrecognizedValueError("Backend value (%s) is "
-                                                    "invalid. It cannot "
-                                                    "contain ',' or '=' or "
-                                                    "' '" % backend)
-            preproc += ',edit be:name=%s' % backend
-        utils.execute(['paz', '-j', preproc,
-                       '-E', '%f' % trimpcnt, '-O', freqdir] + fns,
-                      stderr=devnull)
+        preproc = get_preproc(effix=effix, backend=backend)
+        cmds.append(['paz', '-j', preproc,
+                     '-E', '%f' % trimpcnt, '-O', freqdir] + fns)
         tmpsubdirs.append(freqdir)
+    # Sub-band directories are independent. Prepare them concurrently.
+    utils.execute_many(cmds, progress=True, stderr=devnull)
     utils.print_info("Prepared %d subint fragments in %d freq sub-dirs" %
                     (len(subints), len(subdirs)), 3)
     return tmpsubdirs
 
 
+def combine_subints_inprocess(subdirs, subints, parfn=None, outdir=None):
+    """Combine prepared sub-ints from various freq sub-band 
+        directories in memory using PSRCHIVE's python bindings.
+        Sub-bands are added with PSRCHIVE's FrequencyAppend and 
+        sub-ints with its TimeAppend, as 'psradd -R' and 'psradd'
+        do in 'combine_subints', but no combined sub-ints are 
+        written and the combined file is written once.
 
+        The whole observation is held in memory.
 
-def combine_subints(subdirs, subints, parfn=None, outdir=None):
+        Inputs:
+            subdirs: List of sub-band directories containing 
+                sub-ints to combine, as returned by 'prepare_subints'.
+                (NOTE: The ephemeris is installed in these files.)
+            subints: List of subint files to be combined.
+                (NOTE: These are the file name only (i.e. no path)
+                    Each file listed should appear in each of the
+                    subdirs.)
+            parfn: New ephemeris to install when combining subints.
+                (Default: Use ephemeris in archive file's header)
+            outdir: Directory to output combined file.
+                (Default: Current working directory)
+
+        Output:
+            outfn: The name of the combined file.
+    """
+    import psrchive # Temporarily, because python bindings 
+                    # are not available on all computers
+    if outdir is None:
+        outdir = os.getcwd()
+    subints = sorted(subints)
+    devnull = open(os.devnull)
+    normparfn = None
+    tmpfn = None
+    try:
+        # Try to normalise the archive's parfile
+        try:
+            if parfn is None:
+                arfn = os.path.join(subdirs[0], subints[0])
+                normparfn = utils.get_norm_parfile(arfn)
+            else:
+                normparfn = utils.normalise_parfile(parfn)
+        except errors.InputError:
+            # No parfile present
+            normparfn = None
+        if normparfn is not None:
+            # Install the ephemeris in each sub-int before adding,
+            # as 'psradd -E' does
+            cmds = [['pam', '-m', '-E', normparfn] +
+                    [os.path.join(subdir, subint) for subint in subints]
+                    for subdir in subdirs]
+            utils.execute_many(cmds, stderr=devnull)
+
+        utils.print_info("Combining %d sub-ints from %d freq sub-bands "
+                         "in memory..." % (len(subints), len(subdirs)), 1)
+        freqappend = psrchive.FrequencyAppend()
+        timeappend = psrchive.TimeAppend()
+        combined = None
+        for subint in subints:
+            cmbsubint = None
+            for subdir in subdirs:
+                ar = psrchive.Archive_load(os.path.join(subdir, subint))
+                if cmbsubint is None:
+                    cmbsubint = ar
+                    freqappend.init(cmbsubint)
+                else:
+                    freqappend.append(cmbsubint, ar)
+            if combined is None:
+                combined = cmbsubint
+                timeappend.init(combined)
+            else:
+                timeappend.append(combined, cmbsubint)
+
+        tmpfd, tmpfn = tempfile.mkstemp(suffix=".cmb.tmp", dir=outdir)
+        os.close(tmpfd)
+        combined.unload(tmpfn)
+        del combined
+        arf = utils.ArchiveFile(tmpfn)
+        outfn = os.path.join(outdir, "%s_%s_%s_%05d_%dsubints.cmb" %
+                             (arf['name'], arf['band'], arf['yyyymmdd'],
+                              arf['secs'], len(subints)))
+        os.rename(tmpfn, outfn)
+    except:
+        if (tmpfn is not None) and os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+    finally:
+        if normparfn is not None:
+            scratch.release(normparfn)
+    return outfn
+
+
+def compare_combined(fn1, fn2, rtol=1e-5):
+    """Compare two combined archives, e.g. made by 
+        'combine_subints' and 'combine_subints_inprocess'
+        from the same sub-ints.
+
+        Inputs:
+            fn1: The name of the first archive.
+            fn2: The name of the second archive.
+            rtol: The relative tolerance for data values.
+                (Default: 1e-5)
+
+        Output:
+            diffs: A list of descriptions of the differences 
+                found. Empty if the archives match.
+    """
+    import psrchive # Temporarily, because python bindings 
+                    # are not available on all computers
+    ar1 = psrchive.Archive_load(fn1)
+    ar2 = psrchive.Archive_load(fn2)
+    diffs = []
+    for getter in ['get_nsubint', 'get_npol', 'get_nchan', 'get_nbin',
+                   'get_source', 'get_telescope', 'get_state',
+                   'get_dedispersed', 'get_faraday_corrected']:
+        val1 = getattr(ar1, getter)()
+        val2 = getattr(ar2, getter)()
+        if val1 != val2:
+            diffs.append("%s: %s != %s" % (getter, val1, val2))
+    for getter in ['get_centre_frequency', 'get_bandwidth',
+                   'get_dispersion_measure', 'get_rotation_measure']:
+        val1 = getattr(ar1, getter)()
+        val2 = getattr(ar2, getter)()
+        if not np.allclose(val1, val2, rtol=rtol):
+            diffs.append("%s: %s != %s" % (getter, val1, val2))
+    if diffs:
+        # Shapes or states differ. Don't compare data.
+        return diffs
+    for isub in xrange(ar1.get_nsubint()):
+        integ1 = ar1.get_Integration(isub)
+        integ2 = ar2.get_Integration(isub)
+        # The predictor sets the folding period and epoch of each sub-int
+        if not np.allclose(integ1.get_folding_period(),
+                           integ2.get_folding_period(), rtol=1e-12):
+            diffs.append("Folding periods of sub-int %d differ" % isub)
+        if abs((integ1.get_epoch()-integ2.get_epoch()).in_seconds()) > 1e-9:
+            diffs.append("Epochs of sub-int %d differ" % isub)
+        freqs1 = [integ1.get_centre_frequency(ichan)
+                  for ichan in xrange(ar1.get_nchan())]
+        freqs2 = [integ2.get_centre_frequency(ichan)
+                  for ichan in xrange(ar2.get_nchan())]
+        if not np.allclose(freqs1, freqs2, rtol=1e-9):
+            diffs.append("Channel frequencies of sub-int %d differ" % isub)
+    if not np.allclose(ar1.get_weights(), ar2.get_weights(), rtol=rtol):
+        diffs.append("Weights differ")
+    if not np.allclose(ar1.get_data(), ar2.get_data(), rtol=rtol,
+                       atol=rtol*np.abs(ar1.get_data()).max()):
+        diffs.append("Profiles differ")
+    return diffs
+
+
+def psradd_concurrently(jobs, nretries=None, progress=False, **kwargs):
+    """Run independent 'psradd' calls concurrently. Calls
+        that fail are retried, without re-running those that
+        succeeded.
+
+        Inputs:
+            jobs: A list of (outfn, args) tuples. 'outfn' is the
+                output file of the call and 'args' is the list of
+                arguments to pass to 'psradd' (other than '-o outfn').
+            nretries: The number of times to retry failed calls.
+                (Default: the 'combine_nretries' configuration)
+            progress: If True, show a progress counter as calls
+                complete. (Default: False)
+            ** Additional keyword arguments are passed to 
+                'utils.execute'.
+
+        Outputs:
+            None
+    """
+    if nretries is None:
+        nretries = config.cfg.combine_nretries
+    todo = jobs
+    for attempt in xrange(nretries+1):
+        if attempt:
+            utils.print_info("Retrying %d failed psradd calls (attempt "
+                             "%d of %d)" % (len(todo), attempt, nretries), 2)
+            # Remove any partially written output
+            for outfn, args in todo:
+                if os.path.exists(outfn):
+                    os.remove(outfn)
+        cmds = [['psradd', '-q', '-o', outfn] + args for outfn, args in todo]
+        funcs = [functools.partial(utils.execute, cmd, **kwargs)
+                 for cmd in cmds]
+        outcomes = utils.run_concurrently(funcs, progress=progress)
+        failed = [(job, exc) for job, (retval, exc) in zip(todo, outcomes)
+                  if exc is not None]
+        if not failed:
+            return
+        todo = [job for job, exc in failed]
+    raise errors.SystemCallError("%d (of %d) psradd calls failed after "
+                                 "%d retries!\n%s" %
+                                 (len(failed), len(jobs), nretries,
+                                  "\n".join([str(exc.args[0])
+                                             for job, exc in failed])))
+
+
+def tree_add(infns, outfn, tmpdir, fanin=None, **kwargs):
+    """Add archives in time using a balanced tree of 'psradd'
+        calls. No call adds more than 'fanin' archives, and calls 
+        at each level of the tree are run concurrently.
+
+        Each level of the tree writes and re-reads intermediate
+        files, which only pays off when calls run concurrently.
+        So a single 'psradd' call is used if no fan-in is set, or
+        if only one thread is configured ('nthreads').
+
+        Inputs:
+            infns: A list of archives to add, in time order.
+            outfn: The name of the output file.
+            tmpdir: The directory where intermediate files are 
+                written.
+            fanin: The maximum number of archives added by a
+                single call. (Default: the 'combine_fanin' 
+                configuration)
+            ** Additional keyword arguments are passed to
+                'psradd_concurrently'.
+
+        Outputs:
+            None
+    """
+    if fanin is None:
+        fanin = config.cfg.combine_fanin
+    if (fanin is None) or (config.cfg.nthreads == 1):
+        psradd_concurrently([(outfn, infns)], **kwargs)
+        return
+    if fanin < 2:
+        raise errors.InputError("The fan-in for combining archives (%d) "
+                                "must be at least 2!" % fanin)
+    level = 0
+    toremove = []
+    while len(infns) > fanin:
+        # Split into contiguous groups of (nearly) equal size
+        ngroups = int(np.ceil(len(infns)/float(fanin)))
+        bounds = [len(infns)*ii//ngroups for ii in xrange(ngroups+1)]
+        jobs = []
+        for ii in xrange(ngroups):
+            levelfn = os.path.join(tmpdir, "tree%d_%05d.ar" % (level, ii))
+            jobs.append((levelfn, infns[bounds[ii]:bounds[ii+1]]))
+        utils.print_info("Combining %d archives into %d (tree level %d)" %
+                         (len(infns), len(jobs), level), 2)
+        psradd_concurrently(jobs, **kwargs)
+        # Intermediate files from the previous level are no longer needed
+        for fn in toremove:
+            os.remove(fn)
+        infns = toremove = [levelfn for levelfn, grp in jobs]
+        level += 1
+    psradd_concurrently([(outfn, infns)], **kwargs)
+    for fn in toremove:
+        os.remove(fn)
+
+
+def combine_subints(subdirs, subints, parfn=None, outdir=None, tmpdir=None):
     """Combine sub-ints from various freq sub-band directories.
         The input lists are as created by
         'group_subband_dirs' or read-in by 'read_listing'.
@@ -311,6 +621,10 @@ def combine_subints(subdirs, subints, parfn=None, outdir=None):
                 (Default: Use ephemeris in archive file's header)
             outdir: Directory to output combined file.
                 (Default: Current working directory)
+            tmpdir: Scratch directory to write temporary files to.
+                The caller's reservation must allow for twice the
+                size of the input. (Default: reserve a new scratch
+                directory)
         
         Output:
             outfn: The name of the combined file.
@@ -318,8 +632,15 @@ def combine_subints(subdirs, subints, parfn=None, outdir=None):
     if outdir is None:
         outdir = os.getcwd()
     subints = sorted(subints)
-    tmpdir = tempfile.mkdtemp(suffix="_combine", dir=config.tmp_directory)
+    # Combined sub-ints and intermediate combined files are written
+    # to the temporary directory
+    if tmpdir is None:
+        workdir = scratch.mkdtemp(nbytes=2*get_input_size(subdirs, subints),
+                                  suffix="_combine")
+    else:
+        workdir = tmpdir
     devnull = open(os.devnull)
+    normparfn = None
     try:
         cmbsubints = []
         
@@ -337,28 +658,35 @@ def combine_subints(subdirs, subints, parfn=None, outdir=None):
             parargs = ['-E', normparfn]
 
         utils.print_info("Adding freq sub-bands for each sub-int...", 2)
-        for ii, subint in enumerate(utils.show_progress(subints, width=50)):
+        jobs = []
+        for subint in subints:
             to_combine = [os.path.join(path, subint) for path in subdirs]
-            outfn = os.path.join(tmpdir, "combined_%s" % subint)
+            outfn = os.path.join(workdir, "combined_%s" % subint)
             cmbsubints.append(outfn)
-            utils.execute(['psradd', '-q', '-R', '-o', outfn] + parargs +
-                          to_combine, stderr=devnull)
-        arf = utils.ArchiveFile(os.path.join(tmpdir, "combined_%s" % subints[0]))
+            jobs.append((outfn, ['-R'] + parargs + to_combine))
+        # Sub-ints are independent. Add their sub-bands concurrently.
+        psradd_concurrently(jobs, progress=True, stderr=devnull)
+        arf = utils.ArchiveFile(os.path.join(workdir, "combined_%s" % subints[0]))
         outfn = os.path.join(outdir, "%s_%s_%s_%05d_%dsubints.cmb" %
                              (arf['name'], arf['band'], arf['yyyymmdd'],
                               arf['secs'], len(subints)))
         utils.print_info("Combining %d sub-ints..." % len(cmbsubints), 1)
-        utils.execute(['psradd', '-q', '-o', outfn] + cmbsubints,
-                      stderr=devnull)
+        tree_add(cmbsubints, outfn, workdir, stderr=devnull)
     except:
         raise # Re-raise the exception
     finally:
-        if debug.is_on('reduce'):
-            warnings.warn("Not cleaning up temporary directory (%s)" % tmpdir, \
+        if normparfn is not None:
+            scratch.release(normparfn)
+        if tmpdir is not None:
+            # The caller cleans up its own directory
+            pass
+        elif debug.is_on('reduce'):
+            warnings.warn("Not cleaning up temporary directory (%s)" % workdir, \
                         errors.CoastGuardWarning)
+            scratch.release(workdir, remove=False)
         else:
-            utils.print_info("Removing temporary directory (%s)" % tmpdir, 2)
-            shutil.rmtree(tmpdir)
+            utils.print_info("Removing temporary directory (%s)" % workdir, 2)
+            scratch.release(workdir)
     return outfn
 
 
@@ -467,13 +795,49 @@ def main():
                               dir=config.tmp_directory)
     # Combine files
     outfns = []
+    nmismatch = 0
     for subints in groups:
-        if not args.no_combine:
+        if args.no_combine:
+            pass
+        elif args.check_inprocess:
+            # Combine the same sub-ints both ways and compare
+            preppeddirs = prepare_subints(usedirs, subints,
+                                          baseoutdir=os.path.join(tmpdir, 'data'),
+                                          trimpcnt=6.25)
+            psraddfn = combine_subints(preppeddirs, subints,
+                                       outdir=tmpdir)
+            shutil.rmtree(os.path.join(tmpdir, 'data'))
             preppeddirs = prepare_subints(usedirs, subints,
                                           baseoutdir=os.path.join(tmpdir, 'data'),
                                           trimpcnt=6.25)
-            outfn = combine_subints(preppeddirs, subints,
-                                    outdir=os.getcwd())
+            checkdir = os.path.join(tmpdir, 'inprocess')
+            os.makedirs(checkdir)
+            inprocfn = combine_subints_inprocess(preppeddirs, subints,
+                                                 outdir=checkdir)
+            diffs = compare_combined(psraddfn, inprocfn)
+            if diffs:
+                print "In-process combining of %d sub-ints (%s...) " \
+                      "doesn't match psradd:" % (len(subints), subints[0])
+                for diff in diffs:
+                    print "    %s" % diff
+                nmismatch += 1
+            else:
+                print "In-process combining of %d sub-ints (%s...) " \
+                      "matches psradd" % (len(subints), subints[0])
+            shutil.rmtree(os.path.join(tmpdir, 'data'))
+            shutil.rmtree(checkdir)
+            os.remove(psraddfn)
+        else:
+            preppeddirs = prepare_subints(usedirs, subints,
+                                          baseoutdir=os.path.join(tmpdir, 'data'),
+                                          trimpcnt=6.25)
+            if args.inprocess:
+                outfn = combine_subints_inprocess(preppeddirs, subints,
+                                                  outdir=os.getcwd())
+            else:
+                outfn = combine_subints(preppeddirs, subints,
+                                        outdir=os.getcwd())
+            shutil.rmtree(os.path.join(tmpdir, 'data'))
             outfns.append(outfn)
         if args.write_listing:
             write_listing(usedirs, subints, "list.txt")
@@ -482,6 +846,8 @@ def main():
         print "Created %d combined files" % len(outfns)
         for outfn in outfns:
             print "    %s" % outfn
+    if nmismatch:
+        sys.exit(1)
 
 
 if __name__=="__main__":
@@ -514,6 +880,18 @@ if __name__=="__main__":
                         default='subint')
     parser.add_argument('--write-listing', dest='write_listing', action='store_true', 
                         help="Write text file containing listing of files to combine.")
+    parser.add_argument('--inprocess', dest='inprocess', action='store_true',
+                        help="Combine sub-ints in memory using PSRCHIVE's "
+                             "python bindings, without writing combined "
+                             "sub-ints. (Default: use psradd)")
+    parser.add_argument('--check-inprocess', dest='check_inprocess',
+                        action='store_true',
+                        help="Combine sub-ints both in memory and with "
+                             "psradd, and check the results match "
+                             "(profiles, weights, frequencies and "
+                             "predictor). Do this on real observations "
+                             "before enabling 'combine_inprocess'. No "
+                             "combined files are kept.")
     parser.add_argument('--no-combine', dest='no_combine', action='store_true',
                         help="Don't actually combine files.")
     args = parser.parse_args()
@@ -167,7 +167,7 @@ def get_correction_string(arfn, obsinfo=None, backend='asterix',
     """
     note = ""
     # Load archive
-    arf = utils.ArchiveFile(arfn)
+    arf = utils.get_archive_file(arfn)
     if receiver is None:
         rcvr = determine_receiver(arf)
     elif receiver in ('P217-3', 'P200-3', 'S110-1', 'S60-2', 'S36-5'):
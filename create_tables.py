@@ -1,18 +1,52 @@
 #!/usr/bin/env python
+import sqlalchemy as sa
+
 import database
 import utils
 import config
 
 
+def create_missing_indexes(engine, metadata):
+    """Create indexes defined in the schema that are missing
+        from the database's existing tables. ('create_all' only
+        creates indexes along with new tables.)
+
+        Inputs:
+            engine: The database engine.
+            metadata: The schema's metadata.
+
+        Output:
+            created: A list of names of indexes created.
+    """
+    inspector = sa.engine.reflection.Inspector.from_engine(engine)
+    tablenames = inspector.get_table_names()
+    created = []
+    for table in metadata.tables.values():
+        if table.name not in tablenames:
+            continue
+        existing = set([index['name'] for index
+                        in inspector.get_indexes(table.name)])
+        for index in table.indexes:
+            if index.name not in existing:
+                utils.print_info("Creating index %s on %s" %
+                                 (index.name, table.name), 1)
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+
 def main():
     engine = database.get_engine(config.dburl)
     database.schema.metadata.create_all(engine)
             # Add this argument to "create_all" to make specific tables:
             # tables=[database.schema.metadata.tables['qctrl'], database.schema.metadata.tables['reattempts']]
+    # Bring tables created by older versions up to date
+    create_missing_indexes(engine, database.schema.metadata)
 
 
 if __name__=='__main__':
     parser = utils.DefaultArguments(\
-                description="Create database tables.")
+                description="Create database tables, and any indexes "
+                            "missing from existing tables.")
     args = parser.parse_args()
     main()
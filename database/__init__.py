@@ -1,3 +1,5 @@
+import os
+import datetime
 import warnings
 import string
 import re
@@ -12,6 +14,17 @@ import obslog
 from coast_guard import utils
 
 null = lambda x: x
+
+# Engines shared by all Database objects of this process, by URL
+__engines = {}
+# The PID of the process the shared engines belong to
+__engines_pid = None
+# Pools inherited from a parent process. They are kept so their
+# connections, which the parent still uses, are never closed
+# by the child.
+__inherited_pools = []
+# URLs of databases known to have tables
+__created_urls = set()
 toround_re = re.compile(r"_R(-?\d+)?$")
 
 
@@ -61,6 +74,10 @@ def before_cursor_execute(conn, cursor, statement, parameters, \
 
         See SQLAlchemy for details about event triggers.
     """
+    # This runs for every query, so only build the
+    # message if it will be printed
+    if not config.debug.QUERIES:
+        return
     # Step back 7 levels through the call stack to find
     # the function that called 'execute'
     msg = str(statement)
@@ -120,6 +137,33 @@ def on_sqlite_connect(dbapi_conn, conn_rec):
     cursor.close()
 
 
+def on_connect(dbapi_conn, conn_rec):
+    """An event to be executed when connections are established.
+        This records the PID of the process that owns the connection.
+
+        See SQLAlchemy for details about event triggers.
+    """
+    conn_rec.info['pid'] = os.getpid()
+
+
+def on_checkout(dbapi_conn, conn_rec, conn_proxy):
+    """An event to be executed when a connection is checked out
+        of a pool. Connections opened by another process (i.e. inherited
+        across a fork) are abandoned, without being closed, and the pool
+        is asked for a new connection.
+
+        See SQLAlchemy for details about event triggers:
+        http://docs.sqlalchemy.org/en/rel_0_9/core/pooling.html
+                        #using-connection-pools-with-multiprocessing
+    """
+    pid = os.getpid()
+    if conn_rec.info.get('pid', pid) != pid:
+        conn_rec.connection = conn_proxy.connection = None
+        raise sa.exc.DisconnectionError("Connection belongs to process "
+                                        "%d, not %d" %
+                                        (conn_rec.info['pid'], pid))
+
+
 def get_engine(url):
     """Given a DB URL string return the corresponding DB engine.
 
@@ -133,6 +177,8 @@ def get_engine(url):
     engine = sa.create_engine(url)
     if engine.name == 'sqlite':
         sa.event.listen(engine, "connect", on_sqlite_connect)
+    sa.event.listen(engine, "connect", on_connect)
+    sa.event.listen(engine, "checkout", on_checkout)
     sa.event.listen(engine, "before_cursor_execute",
                         before_cursor_execute)
     if config.debug.is_on('database'):
@@ -142,6 +188,60 @@ def get_engine(url):
     return engine
 
 
+def get_shared_engine(url):
+    """Get the engine for a DB URL shared by this process.
+        The engine, and its pool of connections, is created the
+        first time it is requested.
+
+        In a forked child process the pools of the engines
+        inherited from the parent are replaced, so the child
+        opens its own connections.
+
+        Input:
+            url: A DB URL string.
+
+        Output:
+            engine: The corresponding DB engine.
+    """
+    global __engines_pid
+    pid = os.getpid()
+    if __engines_pid != pid:
+        if __engines_pid is not None:
+            utils.print_debug("Replacing database connection pools "
+                              "inherited from process %d" % __engines_pid,
+                              'database')
+        for engine in __engines.itervalues():
+            __inherited_pools.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+        __engines_pid = pid
+    if url not in __engines:
+        __engines[url] = get_engine(url)
+    return __engines[url]
+
+
+def check_created(db):
+    """Check that a database has tables. Each database is
+        only checked once per process, since tables are not
+        expected to disappear.
+
+        Input:
+            db: The Database object to check.
+
+        Outputs:
+            None
+    """
+    url = str(db.engine.url)
+    if url in __created_urls:
+        return
+    if not db.is_created():
+        raise errors.DatabaseError("The database (%s) does not appear " \
+                                "to have any tables. Be sure to run " \
+                                "'create_tables.py' before attempting " \
+                                "to connect to the database." % \
+                                        db.engine.url.database)
+    __created_urls.add(url)
+
+
 class Database(object):
     def __init__(self, db='effreduce'):
         """Set up a Database object using SQLAlchemy.
@@ -160,13 +260,8 @@ class Database(object):
         else:
             raise errors.DatabaseError("Database (%s) is not recognized. "
                                        "Cannot connect." % db)
-        self.engine = get_engine(url)
-        if not self.is_created():
-            raise errors.DatabaseError("The database (%s) does not appear " \
-                                    "to have any tables. Be sure to run " \
-                                    "'create_tables.py' before attempting " \
-                                    "to connect to the database." % \
-                                            self.engine.url.database)
+        self.engine = get_shared_engine(url)
+        check_created(self)
 
         # The database description (in metadata)
         self.tables = self.metadata.tables
@@ -211,6 +306,49 @@ class Database(object):
         """
         return self.engine.begin(*args, **kwargs)
 
+    def insert_ignore(self, table):
+        """Return an insert object for the given table that
+            silently skips rows violating unique constraints,
+            if the database dialect supports it.
+
+            Input:
+                table: The table to insert into.
+
+            Outputs:
+                insert: The insert object.
+                ignores: True if the insert ignores duplicate
+                    rows, False if it is a plain insert.
+        """
+        insert = table.insert()
+        if self.engine.name == 'sqlite':
+            return insert.prefix_with("OR IGNORE"), True
+        elif self.engine.name == 'mysql':
+            return insert.prefix_with("IGNORE"), True
+        else:
+            return insert, False
+
+    def time_from_now(self, seconds=0):
+        """Return an expression for the database's current time
+            plus a number of seconds. Hosts whose clocks differ
+            agree on the database's time.
+
+            Input:
+                seconds: The number of seconds to add.
+                    (Default: 0)
+
+            Output:
+                expr: The SQL expression.
+        """
+        seconds = int(seconds)
+        if self.engine.name == 'sqlite':
+            return sa.func.datetime('now', 'localtime',
+                                    '%+d seconds' % seconds)
+        elif self.engine.name == 'mysql':
+            return sa.func.date_add(sa.func.now(),
+                                    sa.text("INTERVAL %d SECOND" % seconds))
+        else:
+            return sa.func.now() + datetime.timedelta(seconds=seconds)
+
     @staticmethod
     def select(*args, **kwargs):
         """A staticmethod for returning a select object.
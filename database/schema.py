@@ -200,4 +200,70 @@ sa.Table('qctrl', metadata,
          sa.Column('last_modified', sa.DateTime, nullable=False,
                    default=sa.func.now()),
          mysql_engine='InnoDB', mysql_charset='ascii')
-         
+
+# Define syscalls table
+# This table is meant to store the resource usage
+# of external commands run while processing files.
+# Block I/O counts only include reads and writes that reached
+# a block device (i.e. not those served by the page cache,
+# nor those to network filesystems).
+sa.Table('syscalls', metadata,
+         sa.Column('syscall_id', sa.Integer, primary_key=True,
+                   autoincrement=True, nullable=False),
+         sa.Column('file_id', sa.Integer,
+                   sa.ForeignKey("files.file_id", name="fk_syscall_file")),
+         sa.Column('obs_id', sa.Integer,
+                   sa.ForeignKey("obs.obs_id", name="fk_syscall_obs")),
+         sa.Column('action', sa.String(32), nullable=False),
+         sa.Column('command', sa.String(64), nullable=False),
+         sa.Column('cmdline', sa.String(NOTELEN), nullable=True),
+         sa.Column('retcode', sa.Integer, nullable=True),
+         sa.Column('wall_time', sa.Float, nullable=True),
+         sa.Column('cpu_time', sa.Float, nullable=True),
+         sa.Column('max_rss', sa.Integer, nullable=True),
+         sa.Column('block_bytes_read', sa.BigInteger, nullable=True),
+         sa.Column('block_bytes_written', sa.BigInteger, nullable=True),
+         sa.Column('added', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         sa.Column('last_modified', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         mysql_engine='InnoDB', mysql_charset='ascii')
+
+# Define claims table
+# This table records which reduce_data.py instance is
+# working on each file (or holds each lock). Claims
+# must be renewed before their lease expires, otherwise
+# the work is assumed to be abandoned.
+sa.Table('claims', metadata,
+         sa.Column('claim_id', sa.Integer, primary_key=True,
+                   autoincrement=True, nullable=False),
+         sa.Column('resource', sa.String(128), nullable=False,
+                   unique=True),
+         sa.Column('file_id', sa.Integer,
+                   sa.ForeignKey("files.file_id", name="fk_claim_file"),
+                   nullable=True),
+         sa.Column('action', sa.String(32), nullable=True),
+         sa.Column('worker', sa.String(128), nullable=False),
+         sa.Column('lease_expires', sa.DateTime, nullable=False),
+         sa.Column('added', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         sa.Column('last_modified', sa.DateTime, nullable=False,
+                   default=sa.func.now()),
+         mysql_engine='InnoDB', mysql_charset='ascii')
+
+# Define indexes
+# These cover the queries the automated reduction runs in
+# every iteration of its main loop, so they stay fast as the
+# tables grow. Databases created before an index was added
+# get it when 'create_tables.py' is run.
+sa.Index('ix_files_status_stage', metadata.tables['files'].c.status,
+         metadata.tables['files'].c.stage,
+         metadata.tables['files'].c.qcpassed)
+sa.Index('ix_files_obs_id', metadata.tables['files'].c.obs_id,
+         metadata.tables['files'].c.file_id)
+sa.Index('ix_obs_current_file_id', metadata.tables['obs'].c.current_file_id)
+sa.Index('ix_obs_sourcename', metadata.tables['obs'].c.sourcename,
+         metadata.tables['obs'].c.rcvr)
+sa.Index('ix_claims_file_id', metadata.tables['claims'].c.file_id)
+sa.Index('ix_claims_lease_expires', metadata.tables['claims'].c.lease_expires)
+sa.Index('ix_syscalls_file_id', metadata.tables['syscalls'].c.file_id)
@@ -22,45 +22,50 @@ modes = [('syscalls', 'Print commands being executed as system calls.'), \
          ('correct', "Print debugging information about correcting header information "
                      "using Efflesberg observing logs. (Relevant for correct.py)"), \
          ('calibrate', "Print debugging information about calibration."),\
+         ('scratch', "Print information about scratch space reservations."),\
+         ('scan', "Print information about scanning directories."),\
         ]
 
 modes.sort()
 
 # By default set all debug modes to False
+# Modes are module attributes (e.g. 'debug.CLEAN'). They are
+# set and looked up through the module's dictionary.
+__modes = globals()
 for ii, (m, desc) in enumerate(modes):
-    exec("%s = False" % m.upper())
+    __modes[m.upper()] = False
 
 
 def set_mode_on(*modes):
     for m in modes:
-        exec "%s = True" % m.upper() in globals() 
+        __modes[m.upper()] = True
 
 
 def set_allmodes_on():
     for m, desc in modes:
-        exec "%s = True" % m.upper() in globals() 
+        __modes[m.upper()] = True
 
 
 def set_allmodes_off():
     for m, desc in modes:
-        exec "%s = False" % m.upper() in globals() 
+        __modes[m.upper()] = False
 
 
 def set_mode_off(*modes):
     for m in modes:
-        exec "%s = False" % m.upper() in globals() 
+        __modes[m.upper()] = False
 
 
 def get_on_modes():
     on_modes = []
     for m, desc in modes:
-        if eval('%s' % m.upper()):
+        if __modes[m.upper()]:
             on_modes.append('debug.%s' % m.upper())
     return on_modes
 
 
 def is_on(mode):
-    return eval('%s' % mode.upper())
+    return __modes[mode.upper()]
 
 
 def print_debug_status():
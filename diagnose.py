@@ -26,6 +26,10 @@ import utils
 import clean_utils
 import config
 import errors
+import scratch
+
+# Scratch space to reserve for a plot file (in bytes)
+PLOT_NBYTES = 16*1024**2
 
 func_info = {'std': ("Standard Deviation", np.ma.std), \
              'mean': ("Average", np.ma.mean), \
@@ -849,22 +853,23 @@ def make_polprofile_plot(arf, preproc='C,D,F,T', outfn=None):
         outfn = "%s.Scyl.ps" % arf.fn
     utils.print_info("Output plot name: %s" % outfn, 2)
     suffix = os.path.splitext(outfn)[-1]
-    handle, tmpfn = tempfile.mkstemp(suffix=suffix)
     
     if suffix == '.ps':
-        grdev = "%s/CPS" % tmpfn
+        devtype = "CPS"
     elif suffix == '.png':
-        grdev = "%s/PNG" % tmpfn
+        devtype = "PNG"
     else:
         raise errors.InputError("Output file name extension for " \
                         "polarization profile plot (%s) is not " \
                         "recognized. Valid " \
                         "extensions are '.png' and '.ps'." % outfn)
 
-    utils.execute(['psrplot', '-p', 'Scyl', '-j', preproc, \
-                            arf.fn, '-D', grdev])
-    # Rename tmpfn to requested output filename
-    shutil.move(tmpfn, outfn)
+    with scratch.scratch_file(PLOT_NBYTES, suffix=suffix) as tmpfn:
+        grdev = "%s/%s" % (tmpfn, devtype)
+        utils.execute(['psrplot', '-p', 'Scyl', '-j', preproc, \
+                                arf.fn, '-D', grdev])
+        # Rename tmpfn to requested output filename
+        shutil.move(tmpfn, outfn)
 
 
 def make_composite_summary_plot(arf, outfn=None):
@@ -989,31 +994,33 @@ def make_composite_summary_plot_psrplot(ar, preproc='C,D', outfn=None):
         outfn = "%s.ps" % ar.fn
     utils.print_info("Output plot name: %s" % outfn, 2)
     suffix = os.path.splitext(outfn)[-1]
-    handle, tmpfn = tempfile.mkstemp(suffix=suffix)
     
     if suffix == '.ps':
-        grdev = "%s/CPS" % tmpfn
+        devtype = "CPS"
     elif suffix == '.png':
-        grdev = "%s/PNG" % tmpfn
+        devtype = "PNG"
     else:
         raise errors.InputError("Output file name extension for " \
                         "composite plot (%s) is not recognized. Valid " \
                         "extensions are '.png' and '.ps'." % outfn)
 
     if (ar['nsub'] > 1) and (ar['nchan'] > 1):
-        __plot_all_psrplot(grdev, ar, preproc)
+        plotfunc = __plot_all_psrplot
     elif (ar['nsub'] > 1) and (ar['nchan'] == 1):
-        __plot_nofreq_psrplot(grdev, ar, preproc)
+        plotfunc = __plot_nofreq_psrplot
     elif (ar['nsub'] == 1) and (ar['nchan'] > 1):
-        __plot_notime_psrplot(grdev, ar, preproc)
+        plotfunc = __plot_notime_psrplot
     elif  (ar['nsub'] == 1) and (ar['nchan'] == 1):
-        __plot_profonly_psrplot(grdev, ar, preproc)
+        plotfunc = __plot_profonly_psrplot
     else:
         raise errors.FileError("Not sure how to plot diagnostic for file. " \
                                 "(nsub: %d; nchan: %d)" % \
                                 (ar['nsub'], ar['nchan']))
-    # Rename tmpfn to requested output filename
-    shutil.move(tmpfn, outfn)
+    with scratch.scratch_file(PLOT_NBYTES, suffix=suffix) as tmpfn:
+        grdev = "%s/%s" % (tmpfn, devtype)
+        plotfunc(grdev, ar, preproc)
+        # Rename tmpfn to requested output filename
+        shutil.move(tmpfn, outfn)
 
 
 def __get_info(ar):
@@ -0,0 +1,300 @@
+"""
+Scan directory trees quickly.
+
+Directory listings are cached, keyed by the directory's
+modification time. A directory's mtime changes whenever entries
+are added to, or removed from, it, so if the mtime is unchanged
+the cached listing is used without reading the directory. The
+cache is persisted between runs (see 'dirscan_cache' in the
+global configurations).
+
+Only listings of directories that are read on every pass (i.e.
+the base and pulsar directories of the raw data tree) should be
+cached. Sub-band directories are only read when they are grouped,
+which happens once, so their listings are read without caching
+(see the 'cache' argument of 'scan').
+
+The cache file is shared by every process scanning the tree. It
+is written once per pass, under a lock, and merged with what
+other processes have written.
+
+'scandir' is used to read directories when it is available. It
+avoids a 'stat' call per entry to determine if it is a directory.
+"""
+import os
+import os.path
+import time
+import errno
+import fcntl
+import fnmatch
+import cPickle
+
+import numpy as np
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from coast_guard import config
+from coast_guard import utils
+
+
+# Cache version. Increment if the cache's format changes.
+CACHE_VERSION = 2
+
+# Listings of directories modified more recently than this
+# many seconds ago are not cached since further changes might
+# not change the directory's mtime.
+MTIME_SETTLE = 2.0
+
+# Maps directory paths to (mtime, dirnames, filenames)
+__cache = None
+# Paths whose listings have changed, or been removed, since
+# the cache was last saved
+__cache_changed = set()
+
+
+def read_cache_file(cachefn):
+    """Read the listing cache from disk.
+
+        Input:
+            cachefn: The cache file.
+
+        Output:
+            cache: The cache dictionary. Empty if the file doesn't
+                exist or can't be read.
+    """
+    if not os.path.isfile(cachefn):
+        return {}
+    try:
+        with open(cachefn, 'rb') as ff:
+            version, cache = cPickle.load(ff)
+    except Exception, exc:
+        utils.print_debug("Could not read directory listing "
+                          "cache (%s): %s" % (cachefn, exc), 'scan')
+        return {}
+    if version != CACHE_VERSION:
+        return {}
+    return cache
+
+
+def get_cache():
+    """Get the listing cache, loading it from disk if necessary.
+
+        Inputs:
+            None
+
+        Output:
+            cache: The cache dictionary.
+    """
+    global __cache
+    if __cache is None:
+        __cache = {}
+        cachefn = config.dirscan_cache
+        if cachefn is not None:
+            __cache = read_cache_file(cachefn)
+        utils.print_debug("Loaded %d cached directory listings" %
+                          len(__cache), 'scan')
+    return __cache
+
+
+def save_cache():
+    """Write the listing cache to disk, if it has changed.
+        Listings other processes have saved since the cache was
+        loaded are kept, unless this process has changed them.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    global __cache
+    cachefn = config.dirscan_cache
+    if (cachefn is None) or (not __cache_changed):
+        return
+    with open(cachefn+".lock", 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            merged = read_cache_file(cachefn)
+            for path in __cache_changed:
+                if path in __cache:
+                    merged[path] = __cache[path]
+                else:
+                    merged.pop(path, None)
+            # Write to a temporary file and rename it so readers
+            # never see a partially written cache.
+            tmpfn = "%s.%d" % (cachefn, os.getpid())
+            with open(tmpfn, 'wb') as ff:
+                cPickle.dump((CACHE_VERSION, merged), ff, 2)
+            os.rename(tmpfn, cachefn)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    __cache = merged
+    __cache_changed.clear()
+    utils.print_debug("Saved %d directory listings to cache (%s)" %
+                      (len(__cache), cachefn), 'scan')
+
+
+def read_directory(path):
+    """Read the contents of a directory.
+
+        Input:
+            path: The directory to read.
+
+        Outputs:
+            dirnames: A sorted list of names of sub-directories.
+            filenames: A sorted list of names of other entries.
+    """
+    dirnames = []
+    filenames = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirnames.append(entry.name)
+            else:
+                filenames.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                dirnames.append(name)
+            else:
+                filenames.append(name)
+    dirnames.sort()
+    filenames.sort()
+    return dirnames, filenames
+
+
+def scan(path, cache=True):
+    """Get the contents of a directory, using the cached listing
+        if the directory hasn't been modified.
+
+        Inputs:
+            path: The directory to list.
+            cache: Cache the directory's listing. Only directories
+                that are read repeatedly should be cached.
+                (Default: True)
+
+        Outputs:
+            dirnames: A sorted list of names of sub-directories.
+            filenames: A sorted list of names of other entries.
+    """
+    if not cache:
+        try:
+            return read_directory(path)
+        except OSError, exc:
+            if exc.errno == errno.ENOENT:
+                return [], []
+            raise
+    path = os.path.abspath(path)
+    listings = get_cache()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError, exc:
+        if exc.errno == errno.ENOENT:
+            if listings.pop(path, None) is not None:
+                __cache_changed.add(path)
+            return [], []
+        raise
+    cached = listings.get(path)
+    if (cached is not None) and (cached[0] == mtime):
+        return cached[1], cached[2]
+    dirnames, filenames = read_directory(path)
+    if mtime < time.time()-MTIME_SETTLE:
+        listings[path] = (mtime, dirnames, filenames)
+        __cache_changed.add(path)
+    return dirnames, filenames
+
+
+def list_dirs(path, pattern=None, cache=True):
+    """List sub-directories of a directory.
+
+        Inputs:
+            path: The directory to list.
+            pattern: A shell-style pattern names must match.
+                (Default: list all sub-directories)
+            cache: Cache the directory's listing (see 'scan').
+                (Default: True)
+
+        Output:
+            dirnames: A sorted list of sub-directory names.
+    """
+    dirnames = scan(path, cache)[0]
+    if pattern is not None:
+        dirnames = match(dirnames, pattern)
+    return dirnames
+
+
+def list_files(path, pattern=None, cache=True):
+    """List files of a directory.
+
+        Inputs:
+            path: The directory to list.
+            pattern: A shell-style pattern names must match.
+                (Default: list all files)
+            cache: Cache the directory's listing (see 'scan').
+                (Default: True)
+
+        Output:
+            filenames: A sorted list of file names.
+    """
+    filenames = scan(path, cache)[1]
+    if pattern is not None:
+        filenames = match(filenames, pattern)
+    return filenames
+
+
+def match(names, pattern):
+    """Filter names with a shell-style pattern. Like 'glob',
+        hidden names only match patterns beginning with '.'.
+
+        Inputs:
+            names: A list of names.
+            pattern: The pattern to match.
+
+        Output:
+            matches: A list of matching names.
+    """
+    if not pattern.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    return fnmatch.filter(names, pattern)
+
+
+def get_subint_times(subints):
+    """Get the start times of sub-ints from their names,
+        which have the format 'YYYY-MM-DD-HH:MM:SS.ar'.
+
+        Input:
+            subints: A list of sub-int file names (no path).
+
+        Output:
+            times: A numpy array of datetime64 start times.
+    """
+    # Convert 'YYYY-MM-DD-HH:MM:SS.ar' to ISO 8601 'YYYY-MM-DDTHH:MM:SS'
+    # and let numpy parse all of the strings at once, instead of
+    # calling 'strptime' for each name
+    isotimes = []
+    for subint in subints:
+        name = os.path.basename(subint)
+        isotimes.append(name[:10]+'T'+name[11:19])
+    return np.array(isotimes, dtype='datetime64[s]')
+
+
+def get_subint_seconds(subints):
+    """Get the start times of sub-ints from their names as
+        seconds since the first sub-int listed.
+
+        Input:
+            subints: A list of sub-int file names (no path).
+
+        Output:
+            secs: A numpy array of start times in seconds.
+    """
+    if not len(subints):
+        return np.array([], dtype=float)
+    times = get_subint_times(subints)
+    return (times - times[0]).astype(float)
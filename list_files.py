@@ -2,6 +2,8 @@
 
 import os.path
 
+import sqlalchemy as sa
+
 from coast_guard import database
 from coast_guard import utils
 
@@ -135,6 +137,15 @@ def get_files_by_type(psrnames, filetype, rcvr=None):
     if rcvr is not None:
         whereclause &= (db.obs.c.rcvr == rcvr)
 
+    from_obj = [db.files.outerjoin(db.obs,
+                    onclause=(db.files.c.obs_id == db.obs.c.obs_id))]
+    # Only keep most recently added file for each
+    # observation. File IDs increase as files are added.
+    latest = db.select([sa.func.max(db.files.c.file_id)],
+                       from_obj=from_obj).\
+                where(whereclause).\
+                group_by(db.files.c.obs_id)
+
     with db.transaction() as conn:
         select = db.select([db.files, 
                             db.obs.c.dir_id,
@@ -148,24 +159,12 @@ def get_files_by_type(psrnames, filetype, rcvr=None):
                             db.obs.c.nsubbands,
                             db.obs.c.obsband,
                             db.obs.c.rcvr],
-                    from_obj=[db.files.\
-                        outerjoin(db.obs,
-                            onclause=(db.files.c.obs_id ==
-                                        db.obs.c.obs_id))]).\
-                    where(whereclause).\
+                    from_obj=from_obj).\
+                    where(db.files.c.file_id.in_(latest)).\
                     order_by(db.files.c.added.asc())
         result = conn.execute(select)
         rows = result.fetchall()
         result.close()
-   
-    # Only keep most recently added file for each
-    # observation. Rows are sorted in the query above.
-    obs_ids = []
-    for ii in reversed(range(len(rows))):
-        if rows[ii]['obs_id'] in obs_ids:
-            rows.pop(ii)
-        else:
-            obs_ids.append(rows[ii]['obs_id'])
     return rows
 
 
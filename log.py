@@ -1,6 +1,26 @@
+"""
+Logging for the CoastGuard timing pipeline.
+
+Each process logs to one file at a time (usually the log of the
+observation being reduced). Records are handed to a background
+writer thread through a queue, so logging never waits for the
+(possibly shared, possibly slow) file system. The writer buffers
+its writes, flushes periodically and rotates the file once it
+grows too large.
+
+Records are written as JSON lines by default, and carry the
+context set with 'setup_logger' or 'set_context' (e.g. obs and
+file IDs), so logs can be indexed and searched.
+"""
 import os
-import logging
+import sys
+import json
 import stat
+import atexit
+import Queue
+import logging
+import datetime
+import threading
 
 
 levels = {'debug': logging.DEBUG, \
@@ -9,17 +29,180 @@ levels = {'debug': logging.DEBUG, \
           'error': logging.ERROR, \
           'critical': logging.CRITICAL}
 
+TEXT_FMT = "%(levelname)s - %(asctime)s\n%(message)s\n"
+TEXT_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+# Context added to every record logged by this process
+__context = {}
+# The writer of this process' log file
+__writer = None
+# Writers inherited from a parent process. Their buffers hold
+# the parent's records, so they must never be flushed (or closed).
+__inherited_writers = []
 
-PERMS = {"w": stat.S_IWGRP,                 
-         "r": stat.S_IRGRP,                 
-         "x": stat.S_IXGRP}                 
-def add_group_permissions(fn, perms=""):    
+
+PERMS = {"w": stat.S_IWGRP,
+         "r": stat.S_IRGRP,
+         "x": stat.S_IXGRP}
+def add_group_permissions(fn, perms=""):
     mode = os.stat(fn)[stat.ST_MODE]
     for perm in perms:
         mode |= PERMS[perm]
     os.chmod(fn, mode)
 
 
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects.
+    """
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).\
+                            strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                 'level': record.levelname,
+                 'pid': record.process,
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'context', {}))
+        return json.dumps(entry, sort_keys=True)
+
+
+def get_formatter(fmt):
+    """Get the formatter for a log format.
+
+        Input:
+            fmt: The name of the format. Either 'json' or 'text'.
+
+        Output:
+            formatter: A logging.Formatter instance.
+    """
+    if fmt == 'json':
+        return JsonFormatter()
+    elif fmt == 'text':
+        return logging.Formatter(datefmt=TEXT_DATEFMT, fmt=TEXT_FMT)
+    else:
+        raise ValueError("Log format (%s) is not recognized. "
+                         "Options are 'json' and 'text'." % fmt)
+
+
+class FlushRequest(object):
+    """Queued to ask a LogWriter to flush its file.
+        'done' is set once it has.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class LogWriter(threading.Thread):
+    def __init__(self, logfn, formatter, max_bytes=None, backup_count=0,
+                 flush_interval=1.0):
+        """A thread writing queued log records to a file.
+
+            Inputs:
+                logfn: The file to write to.
+                formatter: The logging.Formatter to use.
+                max_bytes: Rotate the file before it grows larger
+                    than this many bytes. (Default: never rotate)
+                backup_count: Number of rotated files to keep.
+                    They are named <logfn>.1, <logfn>.2, etc.
+                    (Default: 0 - i.e. start the file over)
+                flush_interval: Maximum number of seconds records
+                    are buffered before being written. (Default: 1)
+        """
+        super(LogWriter, self).__init__(name="LogWriter")
+        self.daemon = True
+        self.logfn = logfn
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.queue = Queue.Queue()
+        self.stream = open(self.logfn, 'a', 64*1024)
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                self.stream.flush()
+                continue
+            if item is None:
+                break
+            elif isinstance(item, FlushRequest):
+                self.stream.flush()
+                item.done.set()
+            else:
+                try:
+                    self.write(item)
+                except Exception:
+                    # Logging must never bring down the process
+                    sys.stderr.write("Could not write log record to %s: "
+                                     "%s\n" % (self.logfn, sys.exc_info()[1]))
+        self.stream.close()
+
+    def write(self, record):
+        line = self.formatter.format(record) + '\n'
+        if self.max_bytes and \
+                (self.stream.tell()+len(line) > self.max_bytes) and \
+                self.stream.tell():
+            self.rotate()
+        self.stream.write(line)
+
+    def rotate(self):
+        """Rotate the log file, keeping 'backup_count' old files.
+        """
+        self.stream.close()
+        for ii in reversed(range(1, self.backup_count)):
+            src = "%s.%d" % (self.logfn, ii)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.logfn, ii+1))
+        if self.backup_count:
+            os.rename(self.logfn, self.logfn+".1")
+        self.stream = open(self.logfn, 'w', 64*1024)
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def flush(self, timeout=None):
+        """Wait until queued records are written to the file.
+        """
+        if self.is_alive():
+            request = FlushRequest()
+            self.queue.put(request)
+            request.done.wait(timeout)
+
+    def stop(self, timeout=None):
+        """Write queued records, close the file and stop the thread.
+        """
+        self.queue.put(None)
+        self.join(timeout)
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, writer):
+        """A logging handler passing records on to a LogWriter,
+            without waiting for them to be written.
+
+            Input:
+                writer: The LogWriter to use.
+        """
+        super(QueueHandler, self).__init__()
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            # Format the message now. Its arguments might change
+            # before the writer gets to it.
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.msg += '\n' + logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            record.context = get_context()
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+
 def get_logger():
     """Get a logger instance. The name of the logger
         is automatically determined using the current
@@ -36,28 +219,77 @@ def get_logger():
     return logger
 
 
-def setup_logger(logfn):
-    """Set up a logging.Logger instance for the current thread.
-        Install a FileHandler using the file name provided.
+def get_context():
+    """Return (a copy of) the context added to log records.
+    """
+    return dict(__context)
 
-        Input:
+
+def set_context(**context):
+    """Replace the context added to log records (e.g. obs_id,
+        file_id).
+
+        Inputs:
+            **context: Names and values to add to records.
+
+        Outputs:
+            None
+    """
+    __context.clear()
+    __context.update(context)
+
+
+def get_logfn():
+    """Return the name of the file this process logs to, or
+        None if logging isn't set up.
+    """
+    if (__writer is not None) and (__writer.pid == os.getpid()):
+        return __writer.logfn
+    return None
+
+
+def get_rotated_fns(logfn):
+    """Return the names of rotated files of a log, oldest last.
+    """
+    logdir, logname = os.path.split(logfn)
+    suffixes = [fn[len(logname)+1:] for fn in os.listdir(logdir or '.')
+                if fn.startswith(logname+'.')]
+    return ["%s.%s" % (logfn, suffix) for suffix
+            in sorted([suffix for suffix in suffixes if suffix.isdigit()],
+                      key=int)]
+
+
+def setup_logger(logfn, **context):
+    """Set up a logging.Logger instance for the current process.
+        Records are written to the file provided by a background
+        thread.
+
+        Inputs:
             logfn: File to receive log entries.
+            **context: Names and values to add to every record
+                (e.g. obs_id, file_id).
 
         Outputs:
             None
     """
+    global __writer
+    import config
     logger = get_logger()
     # Remove any existing handlers
-    disconnect_logger() 
-    # What gets logged is determined by if-clauses that 
-    # check the current verbosity level and debugging state, 
-    # not logging's level, so let everything be logged. 
-    logger.setLevel(logging.DEBUG) 
-    logfile = logging.FileHandler(filename=logfn)
-    formatter = logging.Formatter(datefmt="%Y-%m-%d %H:%M:%S", \
-                fmt="%(levelname)s - %(asctime)s\n%(message)s\n")
-    logfile.setFormatter(formatter)
-    logger.addHandler(logfile)
+    disconnect_logger()
+    # What gets logged is determined by if-clauses that
+    # check the current verbosity level and debugging state,
+    # not logging's level, so let everything be logged.
+    logger.setLevel(logging.DEBUG)
+    # Records are only handled by this process' logger
+    logger.propagate = False
+    __writer = LogWriter(logfn, get_formatter(config.log_format),
+                         max_bytes=config.log_max_bytes,
+                         backup_count=config.log_backup_count,
+                         flush_interval=config.log_flush_interval)
+    __writer.start()
+    logger.addHandler(QueueHandler(__writer))
+    set_context(**context)
     try:
         add_group_permissions(logfn, "rw")
     except:
@@ -65,7 +297,8 @@ def setup_logger(logfn):
 
 
 def disconnect_logger():
-    """Disconnect logger from any handlers.
+    """Disconnect logger from any handlers. Queued records
+        are written first.
 
         Inputs:
             None
@@ -73,11 +306,83 @@ def disconnect_logger():
         Outputs:
             None
     """
+    global __writer
     logger = get_logger()
-    for handler in logger.handlers:
+    for handler in list(logger.handlers):
         logger.removeHandler(handler)
+        handler.close()
+    if __writer is not None:
+        if __writer.pid == os.getpid():
+            __writer.stop()
+        else:
+            # Inherited across a fork. The thread didn't survive.
+            __inherited_writers.append(__writer)
+        __writer = None
+    set_context()
+
+
+# Write queued records before the process exits
+atexit.register(disconnect_logger)
+
+
+def flush(timeout=None):
+    """Wait until the records logged so far are written to the
+        log file (e.g. before copying or moving it).
+
+        Input:
+            timeout: Maximum number of seconds to wait.
+                (Default: wait until done)
+
+        Outputs:
+            None
+    """
+    if (__writer is not None) and (__writer.pid == os.getpid()):
+        __writer.flush(timeout)
+
+
+def is_enabled(levelname):
+    """Return True if messages of the given level would be
+        logged by the current process' logger.
+
+        Input:
+            levelname: The name of the logging level.
+
+        Output:
+            enabled: True if the messages would be logged.
+    """
+    logger = get_logger()
+    return logger.isEnabledFor(levels[levelname])
 
 
 def log(msg, levelname):
     logger = get_logger()
     logger.log(levels[levelname], msg)
+
+
+def format_log(text):
+    """Make the contents of a log file readable. JSON records
+        are shown the way the 'text' format would show them.
+        Other lines are left as they are.
+
+        Input:
+            text: The contents of a log file.
+
+        Output:
+            readable: The readable contents.
+    """
+    lines = []
+    for line in text.splitlines():
+        try:
+            entry = json.loads(line)
+            header = "%s - %s" % (entry.pop('level'),
+                                  entry.pop('time').replace('T', ' ')[:19])
+            message = entry.pop('message')
+        except (ValueError, KeyError, AttributeError):
+            lines.append(line)
+            continue
+        entry.pop('pid', None)
+        if entry:
+            header += " (%s)" % ", ".join(["%s: %s" % item for item
+                                           in sorted(entry.items())])
+        lines.extend([header, message, ""])
+    return "\n".join(lines)
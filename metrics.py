@@ -0,0 +1,266 @@
+"""
+Metrics describing the throughput and latency of the automated
+data reduction (reduce_data.py).
+
+The scheduler loop records the number of files waiting for each
+action, and the tasks it launches and collects. The metrics are
+exported in Prometheus' text format, either by writing them to a
+file (e.g. for node_exporter's textfile collector) or by serving
+them over HTTP.
+"""
+import os
+import time
+import tempfile
+import threading
+import BaseHTTPServer
+
+from coast_guard import utils
+
+
+# Upper bounds, in seconds, of the task duration histogram's buckets
+DURATION_BUCKETS = [10, 30, 60, 120, 300, 600, 1200, 1800,
+                    3600, 7200, 14400, 28800, 86400]
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def get_error_type(error):
+    """Get the name of the exception type from a task's error.
+
+        Input:
+            error: The error message reported for the task
+                (usually a traceback).
+
+        Output:
+            errtype: The name of the exception type.
+    """
+    if error.startswith("Worker (PID:"):
+        # The worker died (see 'workers.WorkerPool.collect')
+        return "WorkerLost"
+    lines = error.strip().splitlines()
+    if not lines:
+        return "Unknown"
+    # The last line of a traceback is "<type>: <message>"
+    errtype = lines[-1].split(':', 1)[0].strip()
+    if (not errtype) or (' ' in errtype):
+        return "Unknown"
+    # Remove the module path (e.g. 'coast_guard.errors.')
+    return errtype.split('.')[-1]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+                replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    # Avoid the 'L' suffix of long integers
+    return str(value)
+
+
+class Metrics(object):
+    def __init__(self, buckets=DURATION_BUCKETS):
+        """Metrics of the tasks run by the scheduler.
+
+            Input:
+                buckets: Upper bounds, in seconds, of the task
+                    duration histogram's buckets.
+                    (Default: DURATION_BUCKETS)
+        """
+        self.buckets = sorted(buckets)
+        # Metrics are rendered by the HTTP server's thread
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Maps actions to the number of files waiting for them
+        self.queue_depths = {}
+        # Maps task names to (action, start time, input bytes)
+        self.running = {}
+        # Map actions to the number of tasks launched, and
+        # to the number of input bytes of tasks that succeeded
+        self.launched = {}
+        self.bytes_processed = {}
+        # Maps (action, outcome) to [bucket counts, sum, count]
+        self.durations = {}
+        # Maps (action, error type) to number of failed tasks
+        self.failures = {}
+
+    def set_queue_depth(self, action, depth):
+        """Record the number of files waiting for an action.
+        """
+        with self.lock:
+            self.queue_depths[action] = depth
+
+    def task_started(self, name, action, nbytes=0):
+        """Record a task being launched.
+
+            Inputs:
+                name: The name of the task.
+                action: The (first) action the task performs.
+                nbytes: The size of the task's input file.
+                    (Default: 0)
+
+            Outputs:
+                None
+        """
+        with self.lock:
+            self.running[name] = (action, time.time(), nbytes or 0)
+            self.launched[action] = self.launched.get(action, 0)+1
+
+    def task_finished(self, name, error=None):
+        """Record a task finishing.
+
+            Inputs:
+                name: The name of the task.
+                error: The task's error message, or None if it
+                    succeeded. (Default: None)
+
+            Outputs:
+                None
+        """
+        with self.lock:
+            if name not in self.running:
+                return
+            action, start, nbytes = self.running.pop(name)
+            duration = time.time()-start
+            if error is None:
+                outcome = 'success'
+                self.bytes_processed[action] = \
+                        self.bytes_processed.get(action, 0)+nbytes
+            else:
+                outcome = 'failure'
+                key = (action, get_error_type(error))
+                self.failures[key] = self.failures.get(key, 0)+1
+            hist = self.durations.setdefault((action, outcome),
+                                             [[0]*len(self.buckets), 0.0, 0])
+            for ii, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    hist[0][ii] += 1
+            hist[1] += duration
+            hist[2] += 1
+
+    def render(self):
+        """Render the metrics in Prometheus' text format.
+
+            Inputs:
+                None
+
+            Output:
+                text: The metrics.
+        """
+        lines = []
+        def add(name, mtype, helpstr, samples):
+            lines.append("# HELP %s %s" % (name, helpstr))
+            lines.append("# TYPE %s %s" % (name, mtype))
+            for suffix, labels, value in samples:
+                labelstr = ",".join(['%s="%s"' % (key, escape_label(val))
+                                     for key, val in labels])
+                if labelstr:
+                    labelstr = "{%s}" % labelstr
+                lines.append("%s%s%s %s" % (name, suffix, labelstr,
+                                            format_value(value)))
+        with self.lock:
+            now = time.time()
+            running = {}
+            for action, start, nbytes in self.running.values():
+                running[action] = running.get(action, 0)+1
+            add("coastguard_queue_depth", "gauge",
+                "Number of files waiting for an action.",
+                [("", [("action", action)], depth) for action, depth
+                 in sorted(self.queue_depths.items())])
+            add("coastguard_tasks_running", "gauge",
+                "Number of tasks launched and not finished.",
+                [("", [("action", action)], num) for action, num
+                 in sorted(running.items())])
+            add("coastguard_tasks_launched_total", "counter",
+                "Number of tasks launched.",
+                [("", [("action", action)], num) for action, num
+                 in sorted(self.launched.items())])
+            add("coastguard_task_failures_total", "counter",
+                "Number of failed tasks, by exception type.",
+                [("", [("action", action), ("type", errtype)], num)
+                 for (action, errtype), num
+                 in sorted(self.failures.items())])
+            add("coastguard_processed_bytes_total", "counter",
+                "Size of the input files of tasks that succeeded.",
+                [("", [("action", action)], num) for action, num
+                 in sorted(self.bytes_processed.items())])
+            samples = []
+            for (action, outcome), (counts, total, num) in \
+                        sorted(self.durations.items()):
+                labels = [("action", action), ("outcome", outcome)]
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(("_bucket", labels+[("le", "%g" % bound)],
+                                    count))
+                samples.append(("_bucket", labels+[("le", "+Inf")], num))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, num))
+            add("coastguard_task_duration_seconds", "histogram",
+                "Time from launching a task until it finished.", samples)
+            add("coastguard_uptime_seconds", "gauge",
+                "Seconds since the scheduler started.",
+                [("", [], now-self.started)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, fn):
+        """Write the metrics to a file. The file is replaced
+            atomically, so readers never see a partial file.
+
+            Input:
+                fn: The name of the file.
+
+            Outputs:
+                None
+        """
+        outdir, outname = os.path.split(os.path.abspath(fn))
+        tmpfile, tmpfn = tempfile.mkstemp(prefix=outname, dir=outdir)
+        try:
+            with os.fdopen(tmpfile, 'w') as ff:
+                ff.write(self.render())
+            os.chmod(tmpfn, 0644)
+            os.rename(tmpfn, fn)
+        except:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            raise
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        utils.print_debug("Metrics request: %s" % (fmt % args), 'reduce')
+
+
+class MetricsServer(threading.Thread):
+    def __init__(self, metrics, port, host=''):
+        """A thread serving metrics over HTTP.
+
+            Inputs:
+                metrics: The Metrics object to serve.
+                port: The port to listen on.
+                host: The address to listen on.
+                    (Default: all addresses)
+        """
+        super(MetricsServer, self).__init__(name="MetricsServer")
+        self.daemon = True
+        self.httpd = BaseHTTPServer.HTTPServer((host, port),
+                                               MetricsRequestHandler)
+        self.httpd.metrics = metrics
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
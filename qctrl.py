@@ -15,6 +15,8 @@ import tempfile
 import shutil
 import warnings
 
+import sqlalchemy as sa
+
 from PyQt4 import QtGui as qtgui
 from PyQt4 import QtCore as qtcore
 
@@ -25,6 +27,9 @@ from coast_guard import errors
 from coast_guard import reduce_data
 from coast_guard import add_missing_summary_plots as amsp
 
+# Number of files to fetch from the database at a time
+QC_BATCH_SIZE = 50
+
 class QualityControl(qtgui.QWidget):
     """Quality control window.
     """
@@ -46,6 +51,10 @@ class QualityControl(qtgui.QWidget):
         self.idiag = 0
         self.file_id = None
         self.diagplots = []
+        self.files_to_check = []
+        self.files_seen = set()
+        self.nleft = 0
+        self.qc_whereclause = None
 
     def __setup(self):
         # Geometry arguments: x, y, width, height (all in px)
@@ -230,11 +239,15 @@ class QualityControl(qtgui.QWidget):
 
     def advance_file(self):
         self.idiag = 0
+        if not self.files_to_check and self.nleft:
+            self.fetch_files_to_check()
         if self.files_to_check:
             file_id = self.files_to_check.pop()
+            self.files_seen.add(file_id)
             self.set_file(file_id)
             # Decrement number of files left
-            self.lcd.display(len(self.files_to_check)+1)
+            self.lcd.display(self.nleft)
+            self.nleft -= 1
         else:
             self.file_id = None
             self.diagplots = []
@@ -369,21 +382,56 @@ class QualityControl(qtgui.QWidget):
             for prioritizer, cfgstr in priority_list[1:]:
                 tmp |= prioritizer(self.db, cfgstr)
             whereclause &= tmp
+        self.qc_whereclause = whereclause
+        self.files_to_check = []
+        self.files_seen = set()
+        self.nleft = self.count_files_to_check()
+        self.advance_file()
+
+    def get_qc_from_obj(self):
+        return [self.db.obs.outerjoin(self.db.files,
+                    onclause=self.db.files.c.file_id ==
+                            self.db.obs.c.current_file_id)]
+
+    def count_files_to_check(self):
+        """Count the files left to check, so the number can be
+            displayed without fetching them all.
+        """
+        with self.db.transaction() as conn:
+            select = self.db.select([sa.func.count()],
+                        from_obj=self.get_qc_from_obj()).\
+                        where(self.qc_whereclause)
+            result = conn.execute(select)
+            count = result.scalar()
+            result.close()
+        return count
+
+    def fetch_files_to_check(self):
+        """Fetch the next batch of files to check. Calibrator
+            scans come before pulsar observations (which need
+            them to be calibrated), then files are checked in
+            the order they were added.
+        """
+        whereclause = self.qc_whereclause
+        if self.files_seen:
+            # Files already checked might not have been updated
+            # (e.g. if they were skipped)
+            whereclause &= ~self.db.files.c.file_id.in_(self.files_seen)
         with self.db.transaction() as conn:
             select = self.db.select([self.db.files.c.file_id],
-                        from_obj=[self.db.obs.\
-                            outerjoin(self.db.files,
-                                onclause=self.db.files.c.file_id ==
-                                        self.db.obs.c.current_file_id)]).\
+                        from_obj=self.get_qc_from_obj()).\
                         where(whereclause).\
-                        order_by(self.db.obs.c.obstype.asc())
+                        order_by(sa.case([(self.db.obs.c.obstype == 'cal',
+                                           0)], else_=1),
+                                 self.db.files.c.file_id.asc()).\
+                        limit(QC_BATCH_SIZE)
             result = conn.execute(select)
             rows = result.fetchall()
             result.close()
-        self.files_to_check = [row['file_id'] for row in rows]
-#        self.files_to_check.sort()
-#        self.files_to_check.reverse()
-        self.advance_file()
+        # Files are popped off the end of the list
+        self.files_to_check = [row['file_id'] for row in reversed(rows)]
+        if not self.files_to_check:
+            self.nleft = 0
 
     def zap_file_manually(self, reset_weights=False):
         arfn = os.path.join(self.fileinfo['filepath'],
@@ -2,6 +2,7 @@
 
 import multiprocessing
 import traceback
+import functools
 import warnings
 import tempfile
 import datetime
@@ -11,6 +12,10 @@ import time
 import glob
 import sys
 import os
+import errno
+import fcntl
+import signal
+import sqlalchemy as sa
 
 
 import toaster.config
@@ -24,11 +29,20 @@ from coast_guard import diagnose
 from coast_guard import cleaners
 from coast_guard import combine
 from coast_guard import database
+from coast_guard.database import schema
 from coast_guard import errors
 from coast_guard import debug
 from coast_guard import log
 from coast_guard import correct
 from coast_guard import calibrate
+from coast_guard import archive_server
+from coast_guard import scratch
+from coast_guard import dirscan
+from coast_guard import watcher
+from coast_guard import workers
+from coast_guard import scheduling
+from coast_guard import claims
+from coast_guard import metrics
 
 import pyriseset as rs
 
@@ -38,6 +52,8 @@ os.umask(0007)
 # A lock for each calibrator database file
 # The multiprocessing.Lock objects are created on demand
 CALDB_LOCKS = {}
+# Manager providing caldb locks that can be sent to pool workers
+CALDB_LOCK_MANAGER = None
 
 STAGE_TO_EXT = {'combined': '.cmb',
                 'grouped': '.list.txt',
@@ -46,6 +62,10 @@ STAGE_TO_EXT = {'combined': '.cmb',
 
 MINUTES_PER_DAY = 60.0*24.0
 
+# When memory admission is on, consider this many tasks per
+# free slot, since large tasks might be skipped
+ADMISSION_CANDIDATES = 10
+
 SOURCELISTS = {'epta': ['J0030+0451', 'J0218+4232', 'J0613-0200', 
                         'J0621+1002', 'J0751+1807', 'J1012+5307', 
                         'J1022+1001', 'J1024-0719', 'J1600-3053', 
@@ -241,31 +261,134 @@ def load_directories(db, force=False, *args, **kwargs):
     else:
         most_recent_addtime = time.mktime(row['added'].timetuple())
 
-    ninserts = 0
     dirs = get_rawdata_dirs(*args, **kwargs)
     nn = len(dirs)
+    candidates = []
     for ii, path in utils.show_progress(enumerate(dirs), tot=nn, width=50):
         if force or (os.path.getmtime(path) > most_recent_addtime):
             # Only try to add new entries
-            try:
-                with db.transaction() as conn:
-                    insert = db.directories.insert().\
-                            values(path=path)
-                    # 'directories.path' is constrained to be unique, so
-                    # trying to insert a directory that already exists
-                    # will result in an error, which will be automatically
-                    # rolled back by the context manager (i.e. no new
-                    # database entry will be inserted)
-                    conn.execute(insert)
-            except:
-                pass
-            else:
-                # The following line is only reached if the execution
-                # above doesn't raise an exception
-                ninserts += 1
+            candidates.append(path)
+    return load_many_directories(db, candidates)
+
+
+def load_many_directories(db, paths):
+    """Insert rows for raw data directories into the database
+        with a constant number of queries. Directories that 
+        already have rows are skipped.
+
+        Inputs:
+            db: Database object to use.
+            paths: The directories to insert.
+
+        Output:
+            ninserts: Number of new directories inserted.
+    """
+    with db.transaction() as conn:
+        select = db.select([db.directories.c.path])
+        results = conn.execute(select)
+        known = set([row['path'] for row in results])
+        results.close()
+    toinsert = []
+    for path in paths:
+        if path not in known:
+            toinsert.append(path)
+            known.add(path)
+    if not toinsert:
+        return 0
+    insert, ignores = db.insert_ignore(db.directories)
+    if ignores:
+        # Directories inserted concurrently (e.g. by another
+        # scheduler) are skipped by the database
+        with db.transaction() as conn:
+            result = conn.execute(insert, [{'path': path}
+                                           for path in toinsert])
+            ninserts = result.rowcount
+    else:
+        try:
+            with db.transaction() as conn:
+                conn.execute(insert, [{'path': path} for path in toinsert])
+        except sa.exc.IntegrityError:
+            # Some directories were inserted concurrently. 
+            # Fall back to inserting one at a time.
+            ninserts = 0
+            for path in toinsert:
+                if load_directory(db, path):
+                    ninserts += 1
+        else:
+            ninserts = len(toinsert)
     return ninserts
 
 
+def load_directory(db, path):
+    """Insert a row for a raw data directory into the database,
+        unless one already exists.
+
+        Inputs:
+            db: Database object to use.
+            path: The directory to insert.
+
+        Output:
+            inserted: True if a new row was inserted.
+    """
+    try:
+        with db.transaction() as conn:
+            insert = db.directories.insert().\
+                    values(path=path)
+            # 'directories.path' is constrained to be unique, so
+            # trying to insert a directory that already exists
+            # will result in an error, which will be automatically
+            # rolled back by the context manager (i.e. no new
+            # database entry will be inserted)
+            conn.execute(insert)
+    except:
+        return False
+    else:
+        # The following line is only reached if the execution
+        # above doesn't raise an exception
+        return True
+
+
+def ingest_new_directories(db, watcher, timeout, wakefds=()):
+    """Wait for the watcher to report changes to the raw data
+        directories. New directories are inserted into the
+        database right away, and are grouped once they have
+        settled.
+
+        Inputs:
+            db: Database object to use.
+            watcher: A watcher.Watcher object.
+            timeout: Maximum number of seconds to wait.
+            wakefds: File descriptors that end the wait early
+                when they become readable. (Default: None)
+
+        Outputs:
+            ngrouped: The number of directories grouped.
+    """
+    newdirs, settled = watcher.wait(timeout, wakefds)
+    for path in newdirs:
+        if load_directory(db, path):
+            utils.print_info("Inserted new raw data directory: %s" % path, 1)
+    ngrouped = 0
+    for path in settled:
+        with db.transaction() as conn:
+            select = db.select([db.directories]).\
+                        where((db.directories.c.path == path) &
+                              (db.directories.c.status == 'new'))
+            results = conn.execute(select)
+            dirrow = results.fetchone()
+            results.close()
+        if dirrow is None:
+            continue
+        utils.print_info("Grouping sub-ints in %s" % path, 1)
+        try:
+            load_groups(dirrow)
+        except errors.CoastGuardError:
+            sys.stderr.write("".join(traceback.format_exception(*sys.exc_info())))
+        else:
+            ngrouped += 1
+    return ngrouped
+
+
 def load_groups(dirrow):
     """Given a row from the DB's directories table create a group 
         listing from the asterix data stored in the directories 
@@ -280,24 +403,28 @@ def load_groups(dirrow):
     tmplogfile, tmplogfn = tempfile.mkstemp(suffix='.log',
                                             dir=config.tmp_directory)
     os.close(tmplogfile)
-    log.setup_logger(tmplogfn)
+    log.setup_logger(tmplogfn, dir_id=dirrow['dir_id'])
 
     db = database.Database()
     path = dirrow['path']
     dir_id = dirrow['dir_id']
-    # Mark as running
-    with db.transaction() as conn:
-        update = db.directories.update().\
-                    where(db.directories.c.dir_id == dir_id).\
-                    values(status='running',
-                            last_modified=datetime.datetime.now())
-        conn.execute(update)
+    # Mark as running, unless another process got to it first
+    claimed = claims.claim_directory(db, dir_id)
     if dirrow['status'] != 'new':
         return errors.BadStatusError("Groupings can only be "
                                      "generated for 'directory' entries "
                                      "with status 'new'. (The status of "
                                      "Dir ID %d is '%s'.)" %
                                      (dir_id, dirrow['status']))
+    if not claimed:
+        utils.print_debug("Dir ID %d is already being grouped by "
+                          "another process" % dir_id, 'reduce')
+        return 0
+    # Hold on to the claim while grouping, so the directory is
+    # put back in the queue if this process dies
+    resource = claims.get_dir_resource(dir_id)
+    renewer = claims.LeaseRenewer(resource)
+    renewer.start()
     try:
         ninserts = 0
         values = []
@@ -328,8 +455,12 @@ def load_groups(dirrow):
             listfn = os.path.join(listoutdir, baseoutname+'.txt')
             logfn = os.path.join(logoutdir, baseoutname+'.log')
             logfns.append(logfn)
-            combine.write_listing(dirs, fns, listfn)
             listpath, listname = os.path.split(listfn)
+            if os.path.exists(listfn) and \
+                    not is_file_loaded(db, listpath, listname):
+                # Left behind by an attempt that was interrupted
+                os.remove(listfn)
+            combine.write_listing(dirs, fns, listfn)
             if arf['name'].endswith("_R"):
                 obstype = 'cal'
             else:
@@ -358,6 +489,7 @@ def load_groups(dirrow):
     except Exception as exc:
         utils.print_info("Exception caught while working on Dir ID %d" %
                             dir_id, 0)
+        log.flush()
         shutil.copy(tmplogfn, os.path.join(config.output_location, 'logs',
                                            "dir%d.log" % dir_id))
         # Add ID number to exception arguments
@@ -380,41 +512,162 @@ def load_groups(dirrow):
     else:
         with db.transaction() as conn:
             version_id = utils.get_version_id(db)
-            for obs, vals, logfn in zip(obsinfo, values, logfns):
-                # Insert obs
-                insert = db.obs.insert().\
-                            values(dir_id=dir_id)
-                result = conn.execute(insert, obs)
-                obs_id = result.inserted_primary_key[0]
-                # Insert file
-                insert = db.files.insert().\
-                            values(obs_id=obs_id)
-                result = conn.execute(insert, vals)
-                file_id = result.inserted_primary_key[0]
-                # Update obs to have current_file_id set
-                update = db.obs.update().\
-                            where(db.obs.c.obs_id == obs_id).\
-                            values(current_file_id=file_id)
-                result = conn.execute(update)
-                # Insert log
-                shutil.copy(tmplogfn, logfn)
-                insert = db.logs.insert().\
-                            values(obs_id=obs_id,
-                                   logpath=os.path.dirname(logfn),
-                                   logname=os.path.basename(logfn))
-                conn.execute(insert)
+            if values:
+                insert_groups(db, conn, dir_id, obsinfo, values, logfns)
             update = db.directories.update().\
                         where(db.directories.c.dir_id == dir_id).\
                         values(status='processed',
                                 last_modified=datetime.datetime.now())
             conn.execute(update)
         ninserts += len(values)
+        # Only put logs in place once the rows referring to
+        # them are committed
+        log.flush()
+        for logfn in logfns:
+            shutil.copy(tmplogfn, logfn)
     finally:
+        renewer.stop()
+        try:
+            claims.release(db, resource, claims.get_worker_id())
+        except Exception:
+            # The claim will expire
+            warnings.warn("Could not release claim on Dir ID %d!\n%s" %
+                          (dir_id, traceback.format_exc()),
+                          errors.CoastGuardWarning)
+        log.disconnect_logger()
         if os.path.isfile(tmplogfn):
             os.remove(tmplogfn)
     return ninserts
 
 
+def is_file_loaded(db, filepath, filename):
+    """Return True if a file is recorded in the files table.
+
+        Inputs:
+            db: A Database object to use.
+            filepath: The file's directory.
+            filename: The file's name.
+
+        Output:
+            loaded: True if the file has a row.
+    """
+    with db.transaction() as conn:
+        select = db.select([db.files.c.file_id]).\
+                    where((db.files.c.filepath == filepath) &
+                          (db.files.c.filename == filename)).\
+                    limit(1)
+        results = conn.execute(select)
+        row = results.fetchone()
+        results.close()
+    return row is not None
+
+
+def insert_groups(db, conn, dir_id, obsinfo, values, logfns):
+    """Insert obs, files and logs rows for the groups of a
+        directory. The number of queries doesn't depend on the
+        number of groups.
+
+        Inputs:
+            db: Database object to use.
+            conn: The connection (with a transaction established)
+                to use.
+            dir_id: The ID of the directory the groups belong to.
+            obsinfo: A list of obs rows' values, one per group.
+            values: A list of files rows' values, one per group.
+            logfns: A list of log file names, one per group.
+
+        Outputs:
+            None
+    """
+    # Insert obs
+    conn.execute(db.obs.insert(),
+                 [dict(obs, dir_id=dir_id) for obs in obsinfo])
+    # Rows are inserted in order, so their IDs are too
+    select = db.select([db.obs.c.obs_id]).\
+                where((db.obs.c.dir_id == dir_id) &
+                      (db.obs.c.current_file_id == None)).\
+                order_by(db.obs.c.obs_id.asc())
+    results = conn.execute(select)
+    obs_ids = [row['obs_id'] for row in results]
+    results.close()
+    if len(obs_ids) != len(obsinfo):
+        raise errors.DatabaseError("Unexpected number of obs rows for "
+                                   "Dir ID %d (%d inserted, %d found)!" %
+                                   (dir_id, len(obsinfo), len(obs_ids)))
+    # Insert files
+    conn.execute(db.files.insert(),
+                 [dict(vals, obs_id=obs_id)
+                  for obs_id, vals in zip(obs_ids, values)])
+    select = db.select([db.files.c.file_id, db.files.c.obs_id]).\
+                where(db.files.c.obs_id.in_(obs_ids))
+    results = conn.execute(select)
+    file_ids = dict([(row['obs_id'], row['file_id']) for row in results])
+    results.close()
+    # Update obs to have current_file_id set
+    update = db.obs.update().\
+                where(db.obs.c.obs_id == sa.bindparam('b_obs_id')).\
+                values(current_file_id=sa.bindparam('b_file_id'))
+    conn.execute(update, [{'b_obs_id': obs_id,
+                           'b_file_id': file_ids[obs_id]}
+                          for obs_id in obs_ids])
+    # Insert logs
+    conn.execute(db.logs.insert(),
+                 [{'obs_id': obs_id,
+                   'logpath': os.path.dirname(logfn),
+                   'logname': os.path.basename(logfn)}
+                  for obs_id, logfn in zip(obs_ids, logfns)])
+
+
+def commit_stage(db, parent_file_id, obs_id, values, diagvals,
+                 obsvalues=None):
+    """Record the successful completion of a reduction stage.
+        All writes are done in a single transaction: the new
+        file and its diagnostics are inserted, the observation
+        is updated to refer to the new file, and the parent file
+        is marked as processed.
+
+        Inputs:
+            db: Database object to use.
+            parent_file_id: The ID of the file the stage processed.
+            obs_id: The ID of the observation.
+            values: The new files row's values.
+            diagvals: A list of the new diagnostics rows' values.
+            obsvalues: Other obs row values to update.
+                (Default: None)
+
+        Output:
+            file_id: The ID of the new file.
+    """
+    # Get the version ID first. It might need its own transaction.
+    version_id = utils.get_version_id(db)
+    now = datetime.datetime.now()
+    with db.transaction() as conn:
+        # Insert new entry
+        result = conn.execute(db.files.insert(),
+                              dict(values, version_id=version_id,
+                                   obs_id=obs_id))
+        file_id = result.inserted_primary_key[0]
+        result.close()
+        if diagvals:
+            # Insert diagnostic entries
+            conn.execute(db.diagnostics.insert(),
+                         [dict(diag, file_id=file_id) for diag in diagvals])
+        # Update observation to refer to the new file
+        update = db.obs.update().\
+                    where(db.obs.c.obs_id == obs_id).\
+                    values(current_file_id=file_id,
+                           last_modified=now,
+                           **(obsvalues or {}))
+        conn.execute(update)
+        # Update parent file
+        update = db.files.update().\
+                    where(db.files.c.file_id == parent_file_id).\
+                    values(status='processed',
+                           last_modified=now)
+        conn.execute(update)
+    return file_id
+
+
 def load_combined_file(filerow):
     """Given a row from the DB's files table create a combined
         archive and load it into the database.
@@ -432,7 +685,7 @@ def load_combined_file(filerow):
     logrow = get_log(db, obs_id)
     log_id = logrow['log_id']
     logfn = os.path.join(logrow['logpath'], logrow['logname'])
-    log.setup_logger(logfn)
+    log.setup_logger(logfn, obs_id=obs_id, file_id=parent_file_id)
 
     # Mark as running
     with db.transaction() as conn:
@@ -467,7 +720,7 @@ def load_combined_file(filerow):
 
         # Pre-compute values to insert because some might be
         # slow to generate
-        arf = utils.ArchiveFile(cmbfn)
+        arf = utils.get_archive_file(cmbfn)
         if (arf['backend'] == 'ASTERIX') and (arf['nchan'] > 512):
             factor = 0.015625*arf['nchan']/len(subdirs)
             new_nchan = arf['nchan']/factor
@@ -475,9 +728,13 @@ def load_combined_file(filerow):
             utils.print_info("Reducing %s from %d to %g channels" %
                              (cmbfn, arf['nchan'], new_nchan), 2)
             # Scrunch channels
-            utils.execute(['pam', '-m', '--setnchn', "%d" % new_nchan, cmbfn])
+            if config.use_archive_server:
+                archive_server.call('setnchan', cmbfn, new_nchan)
+            else:
+                utils.execute(['pam', '-m', '--setnchn', "%d" % new_nchan,
+                               cmbfn])
             # Re-load archive file
-            arf = utils.ArchiveFile(cmbfn)
+            arf = utils.get_archive_file(cmbfn)
         else:
             note = None
 
@@ -523,32 +780,10 @@ def load_combined_file(filerow):
             conn.execute(update)
         raise
     else:
-        with db.transaction() as conn:
-            version_id = utils.get_version_id(db)
-            # Insert new entry
-            insert = db.files.insert().\
-                    values(version_id=version_id, \
-                            obs_id=obs_id)
-            result = conn.execute(insert, values)
-            new_file_id = result.inserted_primary_key[0]
-            # Insert diagnostic entries
-            insert = db.diagnostics.insert().\
-                    values(file_id=new_file_id)
-            result = conn.execute(insert, diagvals)
-            # Update status of parent file's entry
-            update = db.files.update(). \
-                        where(db.files.c.file_id==parent_file_id).\
-                        values(status='processed', \
-                                last_modified=datetime.datetime.now())
-            conn.execute(update)
-            # Update observation length
-            update = db.obs.update().\
-                        where(db.obs.c.obs_id==obs_id).\
-                        values(length=arf['length'],
-                               bw=arf['bw'],
-                               current_file_id=new_file_id,
-                               last_modified=datetime.datetime.now())
-            conn.execute(update)
+        new_file_id = commit_stage(db, parent_file_id, obs_id, values,
+                                   diagvals,
+                                   obsvalues={'length': arf['length'],
+                                              'bw': arf['bw']})
     return new_file_id
 
 
@@ -571,7 +806,7 @@ def load_corrected_file(filerow):
     logrow = get_log(db, obs_id)
     log_id = logrow['log_id']
     logfn = os.path.join(logrow['logpath'], logrow['logname'])
-    log.setup_logger(logfn)
+    log.setup_logger(logfn, obs_id=obs_id, file_id=parent_file_id)
 
     # Mark as running
     with db.transaction() as conn:
@@ -610,6 +845,9 @@ def load_corrected_file(filerow):
         else:
             rcvr = None # Receiver will be determined automatically
         corrfn, corrstr, note = correct.correct_header(infn, receiver=rcvr)
+        # Hash the corrected file right after 'psredit' wrote it,
+        # while its data are likely still in the page cache
+        md5sum = utils.get_md5sum(corrfn)
 
         arf = utils.ArchiveFile(corrfn)
 
@@ -623,7 +861,11 @@ def load_corrected_file(filerow):
         except OSError:
             # Directory already exists
             pass
-        shutil.move(corrfn, os.path.join(archivedir, archivefn))
+        # The file is renamed if possible, so it isn't hashed
+        # again. A copy (across file systems) is verified against
+        # the checksum in the same pass.
+        utils.move_file_md5sum(corrfn, os.path.join(archivedir, archivefn),
+                               md5sum=md5sum)
         # Update 'corrfn' so it still refers to the file
         corrfn = os.path.join(archivedir, archivefn)
         arf.fn = corrfn
@@ -633,12 +875,12 @@ def load_corrected_file(filerow):
 
         # Pre-compute values to insert because some might be
         # slow to generate
-        arf = utils.ArchiveFile(corrfn)
+        arf = utils.get_archive_file(corrfn)
         values = {'filepath': archivedir,
                   'filename': archivefn,
                   'stage': 'corrected',
                   'note': note,
-                  'md5sum': utils.get_md5sum(corrfn),
+                  'md5sum': md5sum,
                   'filesize': os.path.getsize(corrfn),
                   'parent_file_id': parent_file_id,
                   'coords': arf['coords'],
@@ -675,31 +917,8 @@ def load_corrected_file(filerow):
         raise
     else:
         # Success!
-        with db.transaction() as conn:
-            version_id = utils.get_version_id(db)
-            # Insert new entry
-            insert = db.files.insert().\
-                    values(version_id = version_id,
-                           obs_id=obs_id)
-            result = conn.execute(insert, values)
-            file_id = result.inserted_primary_key[0]
-            # Insert diagnostic entries
-            insert = db.diagnostics.insert().\
-                    values(file_id=file_id)
-            result = conn.execute(insert, diagvals)
-            # Update observation to include correct receiver
-            update = db.obs.update().\
-                        where(db.obs.c.obs_id == obs_id).\
-                        values(rcvr=arf['rcvr'],
-                               current_file_id=file_id,
-                               last_modified=datetime.datetime.now())
-            conn.execute(update)
-            # Update parent file
-            update = db.files.update().\
-                        where(db.files.c.file_id == parent_file_id).\
-                        values(status='processed',
-                               last_modified=datetime.datetime.now())
-            conn.execute(update)
+        file_id = commit_stage(db, parent_file_id, obs_id, values,
+                               diagvals, obsvalues={'rcvr': arf['rcvr']})
 
         rows = get_files(db, obs_id)
         for row in get_files(db, obs_id):
@@ -729,7 +948,7 @@ def load_cleaned_file(filerow):
     logrow = get_log(db, obs_id)
     log_id = logrow['log_id']
     logfn = os.path.join(logrow['logpath'], logrow['logname'])
-    log.setup_logger(logfn)
+    log.setup_logger(logfn, obs_id=obs_id, file_id=parent_file_id)
 
     with db.transaction() as conn:
         update = db.files.update().\
@@ -745,7 +964,7 @@ def load_cleaned_file(filerow):
                         (parent_file_id, filerow['status'], filerow['stage']))
     infn = os.path.join(filerow['filepath'], filerow['filename'])
     try:
-        arf = utils.ArchiveFile(infn)
+        arf = utils.get_archive_file(infn)
         # Clean the data file
         config.cfg.load_configs_for_archive(arf)
         cleaner_queue = [cleaners.load_cleaner('rcvrstd'),
@@ -814,30 +1033,7 @@ def load_cleaned_file(filerow):
             conn.execute(update)
         raise
     else:
-        with db.transaction() as conn:
-            version_id = utils.get_version_id(db)
-            # Insert new entry
-            insert = db.files.insert().\
-                    values(version_id=version_id,
-                            obs_id=obs_id)
-            result = conn.execute(insert, values)
-            file_id = result.inserted_primary_key[0]
-            # Update current file ID for obs
-            update = db.obs.update().\
-                        where(db.obs.c.obs_id == obs_id).\
-                        values(current_file_id=file_id,
-                               last_modified=datetime.datetime.now())
-            conn.execute(update)
-            # Insert diagnostic entries
-            insert = db.diagnostics.insert().\
-                    values(file_id=file_id)
-            result = conn.execute(insert, diagvals)
-            # Update parent file
-            update = db.files.update(). \
-                        where(db.files.c.file_id == parent_file_id).\
-                        values(status='processed',
-                                last_modified=datetime.datetime.now())
-            conn.execute(update)
+        file_id = commit_stage(db, parent_file_id, obs_id, values, diagvals)
     return file_id
 
 
@@ -870,7 +1066,7 @@ def load_calibrated_file(filerow, lock):
     logrow = get_log(db, obs_id)
     log_id = logrow['log_id']
     logfn = os.path.join(logrow['logpath'], logrow['logname'])
-    log.setup_logger(logfn)
+    log.setup_logger(logfn, obs_id=obs_id, file_id=parent_file_id)
 
     with db.transaction() as conn:
         update = db.files.update().\
@@ -893,14 +1089,13 @@ def load_calibrated_file(filerow, lock):
     try:
         # Check if file has already been calibrated and failed
         cal_already_failed = False
-        with db.transaction() as conn:
-            family = get_all_obs_files(filerow['file_id'], db)
-            for member in family:
-                if (member['stage'] == 'calibrated') and (member['qcpassed'] == False):
-                    cal_already_failed = True
-                    raise errors.CalibrationError("Obs (ID: %d) has previously been calibrated "
-                                                  "and failed (file ID: %d). Will not try again." % 
-                                                  (filerow['obs_id'], filerow['file_id']))
+        family = get_all_obs_files(filerow['file_id'], db)
+        for member in family:
+            if (member['stage'] == 'calibrated') and (member['qcpassed'] == False):
+                cal_already_failed = True
+                raise errors.CalibrationError("Obs (ID: %d) has previously been calibrated "
+                                              "and failed (file ID: %d). Will not try again." % 
+                                              (filerow['obs_id'], filerow['file_id']))
 
         arf = utils.ArchiveFile(infn)
         # Reduce data to the equivalent of 128 channels over 200 MHz
@@ -1019,31 +1214,7 @@ def load_calibrated_file(filerow, lock):
             conn.execute(update)
         raise
     else:
-        with db.transaction() as conn:
-            version_id = utils.get_version_id(db)
-            # Insert new entry
-            insert = db.files.insert().\
-                    values(version_id=version_id,
-                            obs_id=obs_id)
-            result = conn.execute(insert, values)
-            file_id = result.inserted_primary_key[0]
-            # Update current file ID for obs
-            update = db.obs.update().\
-                        where(db.obs.c.obs_id == obs_id).\
-                        values(current_file_id=file_id,
-                               last_modified=datetime.datetime.now())
-            conn.execute(update)
-            if diagvals:
-                # Insert diagnostic entries
-                insert = db.diagnostics.insert().\
-                        values(file_id=file_id)
-                result = conn.execute(insert, diagvals)
-            # Update parent file
-            update = db.files.update(). \
-                        where(db.files.c.file_id == parent_file_id).\
-                        values(status='processed',
-                                last_modified=datetime.datetime.now())
-            conn.execute(update)
+        file_id = commit_stage(db, parent_file_id, obs_id, values, diagvals)
         if filerow['obstype'] == 'cal':
             # Update the calibrator database
             try:
@@ -1088,9 +1259,10 @@ def reattempt_calibration(db, sourcename):
         rows = result.fetchall()
         result.close()
         # Now update rows
-        for row in rows:
+        if rows:
             update = db.files.update().\
-                    where(db.files.c.file_id == row['file_id']).\
+                    where(db.files.c.file_id.in_([row['file_id']
+                                                  for row in rows])).\
                     values(status='new',
                             note='Reattempting calibration',
                             last_modified=datetime.datetime.now())
@@ -1433,7 +1605,15 @@ def move_log(db, log_id, destdir, destfn=None):
         except OSError:
             # Directory already exists
             pass
+        # Records might still be queued for the log
+        logging_to_src = (log.get_logfn() == src)
+        if logging_to_src:
+            log.flush()
         shutil.copy(src, dest)
+        # Rotated files go along with the log
+        rotated = log.get_rotated_fns(src)
+        for fn in rotated:
+            shutil.copy(fn, dest+fn[len(src):])
         # Update database
         update = db.logs.update().\
                     where(db.logs.c.log_id == log_id).\
@@ -1443,6 +1623,11 @@ def move_log(db, log_id, destdir, destfn=None):
         conn.execute(update)
         # Remove original
         os.remove(src)
+        for fn in rotated:
+            os.remove(fn)
+        if logging_to_src:
+            # Keep logging to the moved file
+            log.setup_logger(dest, **log.get_context())
         utils.print_info("Moved log from %s to %s. The database "
                          "has been updated accordingly." % (src, dest))
 
@@ -1521,7 +1706,14 @@ def move_file(db, file_id, destdir, destfn=None):
             except OSError:
                 # Directory already exists
                 pass
-            shutil.copy(src, dest)
+            # Verify the copy using the checksum computed
+            # while copying
+            md5sum = utils.copy_file_md5sum(src, dest)
+            if md5sum != ff['md5sum']:
+                os.remove(dest)
+                raise errors.BadFile("MD5 sum of copied file (%s) doesn't "
+                                     "match the database (%s != %s)!" %
+                                     (dest, md5sum, ff['md5sum']))
             # Update database
             update = db.files.update().\
                         where(db.files.c.file_id == file_id).\
@@ -1557,18 +1749,19 @@ def get_rawdata_dirs(basedirs=None, priority=[]):
             # use wildcard to match all
             priority = ["*"]
         for name in priority:
-            indirs.extend(glob.glob(os.path.join(basedir, name)))
+            indirs.extend([os.path.join(basedir, psrdir) for psrdir
+                           in dirscan.list_dirs(basedir, name)])
     for path in indirs:
-        subdirs = glob.glob(os.path.join(path, "*"))
-        for subdir in subdirs:
-            if os.path.isdir(subdir):
-                try:
-                    datetime.datetime.strptime(os.path.basename(subdir), "%Y%m%d")
-                except:
-                    pass
-                else:
-                    # Is a directory whose name has the required format
-                    outdirs.append(subdir)
+        # Listings of unchanged directories are cached
+        for subdir in dirscan.list_dirs(path, "[0-9]"*8):
+            try:
+                datetime.datetime.strptime(subdir, "%Y%m%d")
+            except:
+                pass
+            else:
+                # Is a directory whose name has the required format
+                outdirs.append(os.path.join(path, subdir))
+    dirscan.save_cache()
     return outdirs
 
 
@@ -1596,7 +1789,8 @@ def make_groups(path):
     # Try L-band, S-band, and C-band
     for band, subdir_pattern in \
                     zip(['Lband', 'Sband', 'Cband'], ['1'+'[0-9]'*3, '2'+'[0-9]'*3, '[45]'+'[0-9]'*3]):
-        subdirs = glob.glob(os.path.join(path, subdir_pattern))
+        subdirs = [os.path.join(path, subdir) for subdir
+                   in dirscan.list_dirs(path, subdir_pattern, cache=False)]
         if subdirs:
             utils.print_info("Found %d freq sub-band dirs for %s in %s. "
                              "Will group sub-ints contained" %
@@ -1629,25 +1823,36 @@ def make_combined_file(subdirs, subints, outdir, parfn=None, effix=False, backen
         Outputs:
             outfn: The name of the combined archive.
     """
-    # Work in a temporary directory
-    tmpdir = tempfile.mkdtemp(suffix="_combine",
-                              dir=config.tmp_directory)
+    inprocess = config.cfg.combine_inprocess
+    # Work in a temporary directory. Prepared sub-ints, combined
+    # sub-ints and intermediate combined files are written there.
+    # Only prepared sub-ints are written when combining in memory.
+    nbytes = combine.get_input_size(subdirs, subints)
+    tmpdir = scratch.mkdtemp(nbytes=(1 if inprocess else 3)*nbytes,
+                             suffix="_combine")
     try:
         # Prepare subints
         preppeddirs = combine.prepare_subints(subdirs, subints,
                                       baseoutdir=os.path.join(tmpdir, 'data'),
                                       trimpcnt=6.25, effix=effix, 
                                       backend=backend)
-        cmbfn = combine.combine_subints(preppeddirs, subints,
-                                        parfn=parfn, outdir=outdir)
+        if inprocess:
+            cmbfn = combine.combine_subints_inprocess(preppeddirs, subints,
+                                                      parfn=parfn,
+                                                      outdir=outdir)
+        else:
+            cmbfn = combine.combine_subints(preppeddirs, subints,
+                                            parfn=parfn, outdir=outdir,
+                                            tmpdir=tmpdir)
     except:
         raise # Re-raise the exception
     finally:
         if debug.is_on('reduce'):
             warnings.warn("Not cleaning up temporary directory (%s)" % tmpdir)
+            scratch.release(tmpdir, remove=False)
         else:
             utils.print_info("Removing temporary directory (%s)" % tmpdir, 2)
-            shutil.rmtree(tmpdir)
+            scratch.release(tmpdir)
     return cmbfn
 
 
@@ -1663,7 +1868,6 @@ def make_summary_plots(arf):
             lowresfn: The name of the low-resolution summary plot file.
     """
     fullresfn = arf.fn+".png"
-    diagnose.make_composite_summary_plot_psrplot(arf, outfn=fullresfn)
 
     # 6.25 MHz channels
     nchans = arf['bw']/6.25
@@ -1672,7 +1876,14 @@ def make_summary_plots(arf):
         # one minute subintegrations
         preproc += ",T %d" % (arf['length']/60)
     lowresfn = arf.fn+".scrunched.png"
-    diagnose.make_composite_summary_plot_psrplot(arf, preproc, outfn=lowresfn)
+
+    # The plots are independent. Make them concurrently.
+    utils.run_concurrently([
+            functools.partial(diagnose.make_composite_summary_plot_psrplot,
+                              arf, outfn=fullresfn),
+            functools.partial(diagnose.make_composite_summary_plot_psrplot,
+                              arf, preproc, outfn=lowresfn)],
+            raise_errors=True)
     
     # Make sure plots are group-readable
     utils.add_group_permissions(fullresfn, "r")
@@ -1695,11 +1906,17 @@ def make_polprofile_plots(arf):
                 profile plot file.
     """
     fullresfn = arf.fn+".Scyl.png"
-    diagnose.make_polprofile_plot(arf, outfn=fullresfn)
 
     preproc = 'C,D,T,F,B 128'
     lowresfn = arf.fn+".Scyl.scrunched.png"
-    diagnose.make_polprofile_plot(arf, preproc, outfn=lowresfn)
+
+    # The plots are independent. Make them concurrently.
+    utils.run_concurrently([
+            functools.partial(diagnose.make_polprofile_plot,
+                              arf, outfn=fullresfn),
+            functools.partial(diagnose.make_polprofile_plot,
+                              arf, preproc, outfn=lowresfn)],
+            raise_errors=True)
 
     # Make sure plots are group-readable
     utils.add_group_permissions(fullresfn, "r")
@@ -1721,13 +1938,12 @@ def make_stokes_plot(arf):
     outfn = "%s.stokes.png" % arf.fn
     utils.print_info("Output plot name: %s" % outfn, 2)
     suffix = os.path.splitext(outfn)[-1]
-    handle, tmpfn = tempfile.mkstemp(suffix=suffix)
-
-    grdev = "%s/PNG" % tmpfn
-    utils.execute(['psrplot', '-p', 'stokes', '-j', 'CDTF',
-                  arf.fn, '-D', grdev])
-    # Rename tmpfn to requested output filename
-    shutil.move(tmpfn, outfn)
+    with scratch.scratch_file(diagnose.PLOT_NBYTES, suffix=suffix) as tmpfn:
+        grdev = "%s/PNG" % tmpfn
+        utils.execute(['psrplot', '-p', 'stokes', '-j', 'CDTF',
+                      arf.fn, '-D', grdev])
+        # Rename tmpfn to requested output filename
+        shutil.move(tmpfn, outfn)
 
     # Make sure plot is group-readable
     utils.add_group_permissions(outfn, "r")
@@ -1753,11 +1969,28 @@ def get_togroup(db):
     return rows
 
 
-def get_toload(db):
+def get_toload_whereclause(db):
+    """Get the condition files to load into the TOASTER DB satisfy.
+
+        Input:
+            db: A Database object to use.
+
+        Output:
+            whereclause: The condition.
+    """
+    return (db.files.c.status == 'toload') | \
+           ((db.files.c.status == 'new') &
+            (db.files.c.qcpassed == True) &
+            (db.files.c.stage == 'calibrated'))
+
+
+def get_toload(db, limit=None):
     """Get a list of rows to load into the TOASTER DB.
 
         Inputs:
             db: A Database object to use.
+            limit: The maximum number of rows to return.
+                (Default: no limit)
 
         Output:
             rows: A list database rows to be reduced.
@@ -1772,10 +2005,10 @@ def get_toload(db):
                         outerjoin(db.files,
                             onclause=db.files.c.file_id ==
                                     db.obs.c.current_file_id)]).\
-                            where((db.files.c.status == 'toload') |
-                                  ((db.files.c.status == 'new') & 
-                                   (db.files.c.qcpassed == True) &
-                                   (db.files.c.stage == 'calibrated')))
+                            where(get_toload_whereclause(db)).\
+                            order_by(db.files.c.file_id.asc())
+        if limit is not None:
+            select = select.limit(limit)
         results = conn.execute(select)
         rows = results.fetchall()
         results.close()
@@ -1783,24 +2016,57 @@ def get_toload(db):
     return rows
 
 
-def get_todo(db, action, priorities=None):
-    """Get a list of rows to reduce.
-        
+def select_tasks(db, whereclause):
+    """Build a query for rows of files to process, along with
+        the information about their observations that actions
+        need.
+
+        Inputs:
+            db: A Database object to use.
+            whereclause: The condition rows must satisfy.
+
+        Output:
+            select: The select statement.
+    """
+    select = db.select([db.files,
+                        db.obs.c.dir_id,
+                        db.obs.c.sourcename,
+                        db.obs.c.obstype,
+                        db.obs.c.obsband,
+                        db.obs.c.rcvr,
+                        db.obs.c.backend,
+                        db.obs.c.start_mjd,
+                        db.obs.c.length,
+                        db.obs.c.nsubints,
+                        db.obs.c.nsubbands,
+                        db.obs.c.added.label('obs_added')],
+                from_obj=[db.obs.\
+                    outerjoin(db.files,
+                        onclause=db.files.c.file_id ==
+                                db.obs.c.current_file_id)]).\
+                        where(whereclause)
+    return select
+
+
+def get_todo_whereclause(db, action, priorities=None):
+    """Get the condition files waiting for an action satisfy.
+
         Inputs:
             db: A Database object to use.
             action: The action to perform.
             priorities: A list of source names to reduce.
-                NOTE: sources not listed in priorities will never be reduced
                 (Default: Reduce all sources).
 
-        Outputs:
-            rows: A list database rows to be reduced.
+        Output:
+            whereclause: The condition.
     """
     if action not in ACTIONS:
         raise errors.UnrecognizedValueError("The file action '%s' is not "
                                             "recognized. Valid file actions "
                                             "are '%s'." %
                                             "', '".join(ACTIONS.keys()))
+    if action == 'load':
+        return get_toload_whereclause(db)
 
     target_stages, qcpassed_only, withlock, actfunc = ACTIONS[action]
     whereclause = db.files.c.status == 'new'
@@ -1814,40 +2080,87 @@ def get_todo(db, action, priorities=None):
         for prioritizer, cfgstr in priorities[1:]:
             tmp |= prioritizer(db, cfgstr)
         whereclause &= tmp
+    return whereclause
+
+
+def get_queue_depths(db, actions, priorities=None):
+    """Count the files waiting for each action.
+
+        Inputs:
+            db: A Database object to use.
+            actions: The actions to count files for.
+            priorities: A list of source names to reduce.
+                (Default: Reduce all sources).
+
+        Output:
+            depths: A dictionary mapping actions to numbers of files.
+    """
+    depths = {}
     with db.transaction() as conn:
-        select = db.select([db.files,
-                            db.obs.c.dir_id,
-                            db.obs.c.sourcename,
-                            db.obs.c.obstype,
-                            db.obs.c.obsband,
-                            db.obs.c.rcvr,
-                            db.obs.c.backend,
-                            db.obs.c.start_mjd],
-                    from_obj=[db.obs.\
-                        outerjoin(db.files,
-                            onclause=db.files.c.file_id ==
-                                    db.obs.c.current_file_id)]).\
-                            where(whereclause)
-        if action == 'calibrate':
-            select = select.order_by(db.obs.c.obstype.desc())
+        for action in actions:
+            select = db.select([sa.func.count()],
+                        from_obj=[db.obs.\
+                            outerjoin(db.files,
+                                onclause=db.files.c.file_id ==
+                                        db.obs.c.current_file_id)]).\
+                        where(get_todo_whereclause(db, action, priorities))
+            result = conn.execute(select)
+            depths[action] = result.scalar()
+            result.close()
+    return depths
+
+
+def get_todo(db, action, priorities=None, policy=None, limit=None):
+    """Get a list of rows to reduce.
+        
+        Inputs:
+            db: A Database object to use.
+            action: The action to perform.
+            priorities: A list of source names to reduce.
+                NOTE: sources not listed in priorities will never be reduced
+                (Default: Reduce all sources).
+            policy: The scheduling policy used to order the rows.
+                (Default: config.scheduling_policy)
+            limit: The maximum number of rows to return.
+                (Default: no limit)
+
+        Outputs:
+            rows: A list database rows to be reduced, in the order
+                they should be launched.
+    """
+    whereclause = get_todo_whereclause(db, action, priorities)
+    with db.transaction() as conn:
+        select = select_tasks(db, whereclause).\
+                    order_by(*scheduling.get_order_by(db, action, policy))
+        if limit is not None:
+            select = select.limit(scheduling.get_candidate_limit(limit,
+                                                                 policy))
         results = conn.execute(select)
         rows = results.fetchall()
         results.close()
+    rows = scheduling.order_tasks(db, action, rows, policy)
+    if limit is not None:
+        rows = rows[:limit]
     utils.print_info("Got %d rows for '%s' action (priority: %s)" %
                         (len(rows), action, priorities), 2)
     return rows
 
 
-def launch_task(db, action, row):
+def launch_task(db, action, row, pool, chain=None):
     """Launch a single task acting on the relevant file.
 
         Inputs:
             db: A Database object to use.
             action: The action to perform.
             row: A single row representing a taks to launch
+            pool: The workers.WorkerPool to run the task.
+            chain: A list of actions to perform after 'action',
+                each on the file produced by the previous one.
+                (Default: only perform 'action')
 
         Outputs:
-            proc: The started multiprocessing.Process object
+            name: The name of the task, or None if the file was
+                already claimed by another task.
     """
     if action not in ACTIONS:
         raise errors.UnrecognizedValueError("The file action '%s' is not "
@@ -1856,23 +2169,256 @@ def launch_task(db, action, row):
                                             "', '".join(ACTIONS.keys()))
 
     target_stages, qcpassed_only, withlock, actfunc = ACTIONS[action]
-    results = []
-    with db.transaction() as conn:
-        update = db.files.update().\
-                    where(db.files.c.file_id == row['file_id']).\
-                    values(status='submitted',
-                            last_modified=datetime.datetime.now())
-        conn.execute(update)
+    if not claims.claim_file(db, row['file_id'], action, row['status']):
+        utils.print_debug("File ID %d has already been claimed. Not "
+                          "launching '%s' task." % (row['file_id'], action),
+                          'reduce')
+        return None
+    # Rows are sent to the worker through a queue, so pass
+    # a plain (picklable) dictionary
+    row = dict(row.items())
     if withlock:
         lock = get_caldb_lock(row['sourcename'])
         args = (row,lock)
     else:
         args = (row,)
-    name = "%s.file_id:%d" % (action, row['file_id'])
-    proc = multiprocessing.Process(group=None, target=actfunc,
-                                   name=name, args=args)
-    proc.start()
-    return proc
+    actions = [action] + list(chain or [])
+    name = "%s.file_id:%d" % ("+".join(actions), row['file_id'])
+    pool.submit(name, actions, *args)
+    return name
+
+
+def get_chain(action, actions_to_perform):
+    """Get the actions that can be performed directly after
+        'action' by the same task.
+
+        Inputs:
+            action: The first action.
+            actions_to_perform: The actions that are enabled.
+
+        Output:
+            chain: A list of actions to perform after 'action'.
+    """
+    chain = []
+    if action in CHAINABLE:
+        for nextact in CHAINABLE[CHAINABLE.index(action)+1:]:
+            if nextact not in actions_to_perform:
+                break
+            chain.append(nextact)
+    return chain
+
+
+class Wakeup(object):
+    def __init__(self, signums=(signal.SIGCHLD, signal.SIGUSR1)):
+        """Wake the main loop up when signals are received. 
+            SIGCHLD is sent whenever a task process ends, and 
+            SIGUSR1 can be sent to request an immediate pass 
+            over the database (e.g. after editing it by hand).
+
+            Signals are delivered through a pipe (see 
+            'signal.set_wakeup_fd') so none are missed while
+            the main loop is busy.
+
+            NOTE: Must be created in the main thread.
+
+            Input:
+                signums: The signals to wake up for.
+                    (Default: SIGCHLD and SIGUSR1)
+        """
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wfd)
+        for signum in signums:
+            signal.signal(signum, self.handler)
+            # Restart interrupted system calls
+            signal.siginterrupt(signum, False)
+
+    @staticmethod
+    def handler(signum, frame):
+        # Nothing to do. Receiving the signal writes to the pipe.
+        pass
+
+    @staticmethod
+    def reset_in_child():
+        """Stop task processes, which inherit the main process'
+            signal handling, from waking up the main loop.
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+    def fileno(self):
+        return self.rfd
+
+    def clear(self):
+        """Discard pending wake-ups."""
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError, exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """Wait until a signal is received, or 'timeout' 
+            seconds elapse.
+
+            Input:
+                timeout: Maximum number of seconds to wait.
+
+            Output:
+                woken: True if a signal was received.
+        """
+        ready = watcher.wait_readable([self.rfd], timeout)
+        self.clear()
+        return (ready is None) or bool(ready)
+
+
+def init_worker(fingerprint):
+    """Prepare a worker process to run tasks.
+
+        Input:
+            fingerprint: The code version fingerprint, computed
+                once by the main process.
+
+        Outputs:
+            None
+    """
+    Wakeup.reset_in_child()
+    utils.set_fingerprint(fingerprint)
+
+
+def run_task(action, row, *args):
+    """Perform an action on a file. The resource usage of
+        external commands run along the way is recorded in
+        the database.
+
+        Inputs:
+            action: The action to perform.
+            row: A single row representing the task.
+            *args: Additional arguments to pass to the
+                action's function.
+
+        Output:
+            retval: The value returned by the action's function.
+    """
+    target_stages, qcpassed_only, withlock, actfunc = ACTIONS[action]
+    Wakeup.reset_in_child()
+    # Hold on to the file's claim while working on it. It was
+    # taken out by the scheduler, so record who is doing the work.
+    resource = claims.get_file_resource(row['file_id'])
+    if not claims.take_over(database.Database(), resource):
+        utils.print_info("Claim on %s has been lost" % resource, 0)
+    renewer = claims.LeaseRenewer(resource)
+    renewer.start()
+    utils.start_syscall_accounting()
+    try:
+        return actfunc(row, *args)
+    finally:
+        renewer.stop()
+        try:
+            # Leave the claim alone if another worker has taken it
+            claims.release(database.Database(), resource,
+                           claims.get_worker_id())
+        except Exception:
+            # The claim will expire
+            warnings.warn("Could not release claim on File ID %d!\n%s" %
+                          (row['file_id'], traceback.format_exc()),
+                          errors.CoastGuardWarning)
+        records = utils.stop_syscall_accounting()
+        # Write out the task's log before the next task starts
+        log.flush()
+        try:
+            record_syscalls(action, row, records)
+        except Exception:
+            warnings.warn("Could not record resource usage of %d "
+                          "commands for File ID %d!\n%s" %
+                          (len(records), row['file_id'],
+                           traceback.format_exc()),
+                          errors.CoastGuardWarning)
+
+
+def run_chain(actions, row, *args):
+    """Perform a sequence of actions on an observation in the
+        current process. Each action works on the file produced by
+        the previous one, which is claimed directly instead of
+        waiting for the main loop to launch a new task. Every
+        file is still written and loaded into the database as if
+        the actions were performed separately.
+
+        While chaining, ArchiveFile objects are kept in memory
+        so each file's header values are only read once.
+
+        Inputs:
+            actions: The list of actions to perform.
+            row: A single row representing the first task.
+            *args: Additional arguments to pass to the first
+                action's function.
+
+        Output:
+            file_id: The ID of the last file produced.
+    """
+    if len(actions) > 1:
+        utils.start_archive_caching()
+    try:
+        file_id = run_task(actions[0], row, *args)
+        for action in actions[1:]:
+            if not isinstance(file_id, (int, long)):
+                # The previous action didn't produce a file
+                break
+            db = database.Database()
+            with db.transaction() as conn:
+                results = conn.execute(select_tasks(db, 
+                                db.files.c.file_id == file_id))
+                row = results.fetchone()
+                results.close()
+            if (row is None) or not claims.claim_file(db, file_id, action):
+                # The observation's current file has changed,
+                # or the main loop has launched a task for it
+                utils.print_debug("File ID %d is not available for "
+                                  "chained '%s' action" % (file_id, action),
+                                  'reduce')
+                break
+            utils.print_info("Chaining '%s' action for File ID %d" %
+                             (action, file_id), 2)
+            file_id = run_task(action, dict(row.items()))
+    finally:
+        utils.stop_archive_caching()
+    return file_id
+
+
+def record_syscalls(action, row, records):
+    """Insert the resource usage of external commands into
+        the database.
+
+        Inputs:
+            action: The action during which the commands were run.
+            row: The row of the file being processed.
+            records: A list of syscall records, as returned by
+                'utils.stop_syscall_accounting'.
+
+        Outputs:
+            None
+    """
+    if not records:
+        return
+    db = database.Database()
+    values = []
+    for record in records:
+        vals = record.copy()
+        vals['cmdline'] = vals['cmdline'][:schema.NOTELEN]
+        values.append(vals)
+    with db.transaction() as conn:
+        insert = db.syscalls.insert().\
+                    values(file_id=row['file_id'],
+                           obs_id=row['obs_id'],
+                           action=action)
+        conn.execute(insert, values)
+    utils.print_debug("Recorded resource usage of %d commands for "
+                      "File ID %d" % (len(values), row['file_id']),
+                      'reduce')
 
 
 def get_caldb_lock(sourcename):
@@ -1889,8 +2435,15 @@ def get_caldb_lock(sourcename):
     name = utils.get_prefname(sourcename)
     if name.endswith('_R'):
         name = name[:-2]
-    lock = CALDB_LOCKS.setdefault(name, multiprocessing.Lock())
-    return lock
+    if name not in CALDB_LOCKS:
+        if config.distributed:
+            # Other hosts might be updating the calibrator database
+            CALDB_LOCKS[name] = claims.ClaimLock("caldb:%s" % name)
+        elif CALDB_LOCK_MANAGER is not None:
+            CALDB_LOCKS[name] = CALDB_LOCK_MANAGER.Lock()
+        else:
+            CALDB_LOCKS[name] = multiprocessing.Lock()
+    return CALDB_LOCKS[name]
 
 
 def prioritize_pulsar(db, psrname):
@@ -1950,6 +2503,11 @@ ACTIONS = {'combine': (['grouped'], False, False, load_combined_file),
            'calibrate': (['cleaned'], True, True, load_calibrated_file),
            'load': ([], True, False, load_to_toaster)}
 
+# Actions that need no human input, in the order they are
+# performed. When chaining is on, consecutive actions from this
+# list are performed by the same task.
+CHAINABLE = ['combine', 'correct', 'clean']
+
 PRIORITY_FUNC = {'pulsar': prioritize_pulsar,
                  'psr': prioritize_pulsar,
                  #'date': prioritize_daterange,
@@ -1987,19 +2545,33 @@ def main():
         actions_to_perform = [act for act in ACTIONS.keys() \
                               if act not in args.actions_to_exclude]
 
+    if args.distributed:
+        config.distributed = True
+
     global mjd_to_receiver
     if args.lband_rcvr_map is not None:
         mjd_to_receiver = correct.read_receiver_file(args.lband_rcvr_map)
     else:
         mjd_to_receiver = None
 
-    inprogress = []
+    # Remove scratch space left behind by processes that died
+    scratch.reap()
+
+    pool = None
+    queued_leases = None
     try:
         priority_list = []
         for priority_str in args.priority:
             priority_list.extend(parse_priorities(priority_str))
         db = database.Database()
 
+        if args.watch:
+            # Start watching before the initial scan so that
+            # nothing created in between is missed
+            rawdata_watcher = watcher.get_watcher()
+        else:
+            rawdata_watcher = None
+
         # Load raw data directories
         print "Loading directories..."
         ndirs = load_directories(db, force=args.reattempt_dirs)
@@ -2015,49 +2587,158 @@ def main():
         # Turn off progress counters before we enter the main loop
         config.show_progress = False
 
+        # Calibrator database locks are sent to workers through
+        # a queue, so they must be proxies
+        global CALDB_LOCK_MANAGER
+        CALDB_LOCK_MANAGER = multiprocessing.Manager()
+
+        # Wake up as soon as a task ends
+        wakeup = Wakeup()
+
+        # Determine the code's version once. Workers are given
+        # the result instead of inspecting the repositories.
+        fingerprint = utils.get_fingerprint()
+
+        # Workers are long-lived. They notify the main loop 
+        # whenever they finish a task.
+        pool = workers.WorkerPool(args.numproc, run_chain,
+                                  maxtasks=config.worker_max_tasks,
+                                  maxgrowth=config.worker_max_growth,
+                                  initializer=functools.partial(init_worker,
+                                                                fingerprint),
+                                  notify=functools.partial(os.kill, 
+                                                           os.getpid(),
+                                                           signal.SIGUSR1))
+
+        # Files are claimed when their tasks are submitted. Renew
+        # the claims of tasks waiting in the pool's queue, so they
+        # don't expire (and get claimed by another instance) before
+        # a worker starts renewing them. Maps task names to claims.
+        queued_leases = claims.LeaseRenewer()
+        queued_leases.start()
+        queued = {}
+
+        # Only launch tasks whose estimated memory use fits
+        if args.mem_budget is not None:
+            membudget = scheduling.MemoryBudget(args.mem_budget*1024**2)
+        else:
+            membudget = scheduling.MemoryBudget()
+
+        # Throughput and latency metrics
+        stats = metrics.Metrics()
+        last_depths = None
+        if args.metrics_port is not None:
+            metrics_server = metrics.MetricsServer(stats, args.metrics_port)
+            metrics_server.start()
+            utils.print_info("Serving metrics on port %d" %
+                             args.metrics_port, 1)
+
         print "Entering main loop..."
         while True:
-            nfree = args.numproc - len(inprogress)
+            if (last_depths is None) or \
+                    (time.time()-last_depths >= config.metrics_interval):
+                depths = get_queue_depths(db, actions_to_perform,
+                                          priority_list)
+                for action, depth in depths.iteritems():
+                    stats.set_queue_depth(action, depth)
+                last_depths = time.time()
+            # Requeue files whose workers have disappeared
+            claims.find_orphans(db)
+            for file_id in claims.reclaim_expired(db):
+                utils.print_info("File ID %d has been put back in the "
+                                 "queue" % file_id, 0)
+            nfree = pool.get_nfree()
             nsubmit = 0
             if nfree:
                 utils.print_info("Will perform the following actions: %s" % 
                                  ", ".join(actions_to_perform), 1)
+                # IDs of files considered for launching
+                considered = set()
                 for action in actions_to_perform:
                     if action == 'load':
-                        rows = get_toload(db)[:nfree]
+                        rows = get_toload(db, limit=nfree)
                     else:
+                        # Memory admission might skip some rows,
+                        # so consider more of them
+                        if membudget.budget is None:
+                            limit = nfree
+                        else:
+                            limit = nfree*ADMISSION_CANDIDATES
                         rows = get_todo(db, action,
-                                        priorities=priority_list)[:nfree]
+                                        priorities=priority_list,
+                                        policy=args.policy, limit=limit)
+                    if args.chain:
+                        chain = get_chain(action, actions_to_perform)
+                    else:
+                        chain = None
+                    nnew = 0
                     for row in rows:
-                        proc = launch_task(db, action, row)
-                        inprogress.append(proc)
-                    nnew = len(rows)
+                        if nnew >= nfree:
+                            break
+                        considered.add(row['file_id'])
+                        nbytes = 0
+                        if (membudget.budget is not None) and \
+                                (action != 'load'):
+                            memfactors = scheduling.get_memory_factors(db)
+                            nbytes = max([scheduling.estimate_memory(act, 
+                                                    row, memfactors)
+                                          for act in [action]+(chain or [])])
+                            if not membudget.admit(row['file_id'], nbytes):
+                                continue
+                        name = launch_task(db, action, row, pool, chain)
+                        if name is not None:
+                            queued[name] = \
+                                    claims.get_file_resource(row['file_id'])
+                            queued_leases.add(queued[name])
+                            membudget.reserve(name, nbytes)
+                            stats.task_started(name, action,
+                                               row['filesize'])
+                            nnew += 1
                     nfree -= nnew
                     nsubmit += nnew
                     if nnew:
                         utils.print_info("Launched %d '%s' tasks" %
                                          (nnew, action), 0)
+                    if not nfree:
+                        break
+                membudget.forget_waiting(considered)
             utils.print_info("[%s] - Num running: %d; Num submitted: %d" %
-                        (datetime.datetime.now(), len(inprogress), nsubmit), 0)
-            # Sleep between iterations
-            time.sleep(args.sleep_time)
+                        (datetime.datetime.now(), pool.get_nbusy(), nsubmit), 0)
+            # Wait until a task ends. Time out in case the database
+            # was changed by something other than our tasks.
+            if rawdata_watcher is None:
+                wakeup.wait(args.sleep_time)
+            else:
+                # Pick up new raw data while waiting
+                ingest_new_directories(db, rawdata_watcher, args.sleep_time,
+                                       wakefds=[wakeup])
+                wakeup.clear()
             # Check for completed tasks
-            for ii in xrange(len(inprogress)-1, -1, -1):
-                proc = inprogress[ii]
-                #print "Checking %s" % proc.name
-                #print "Is alive: %s; Exitcode: %s" % \
-                #        (proc.is_alive(), proc.exitcode)
-                if not proc.is_alive() and proc.exitcode is not None:
-                    if proc.exitcode != 0:
-                        if proc.exitcode < 0:
-                            msg = "With signal %d" % (-proc.exitcode)
-                        else:
-                            msg = "With error code %d" % proc.exitcode
-                        sys.stderr.write("Process failed! %s\n" % msg)
-                    inprogress.pop(ii)
+            for name, error in pool.collect():
+                membudget.release(name)
+                stats.task_finished(name, error)
+                if error is not None:
+                    sys.stderr.write("Task failed! (%s)\n%s\n" % (name, error))
+            # Workers renew the claims of the tasks they have started
+            for name in queued.keys():
+                if not pool.is_queued(name):
+                    queued_leases.discard(queued.pop(name))
+            if args.metrics_file is not None:
+                try:
+                    stats.write(args.metrics_file)
+                except (IOError, OSError), exc:
+                    warnings.warn("Could not write metrics to %s: %s" %
+                                  (args.metrics_file, exc),
+                                  errors.CoastGuardWarning)
     except:
         # Re-raise the error
         raise
+    finally:
+        if pool is not None:
+            # Let workers finish their current tasks
+            pool.close()
+        if queued_leases is not None:
+            queued_leases.stop()
 
 
 if __name__ == '__main__':
@@ -2068,11 +2749,22 @@ if __name__ == '__main__':
                         help="Number of processes to run simultaneously.")
     parser.add_argument("-t", "--sleep-time", dest='sleep_time', type=int,
                         default=300,
-                        help="Number of seconds to sleep between iterations "
-                             "of the main loop. (Default: 300s)")
+                        help="Maximum number of seconds to wait between "
+                             "iterations of the main loop. The loop also "
+                             "wakes up whenever a task ends, or when "
+                             "SIGUSR1 is received. (Default: 300s)")
     parser.add_argument("--prioritize", action='append',
                         default=[], dest='priority',
                         help="A rule for prioritizing observations.")
+    parser.add_argument("--policy", dest='policy',
+                        choices=scheduling.POLICIES,
+                        default=config.scheduling_policy,
+                        help="The policy used to decide which tasks to "
+                             "launch first. Must be one of '%s'. Tasks "
+                             "are only considered if they match the "
+                             "--prioritize rules. (Default: %s)" %
+                             ("', '".join(scheduling.POLICIES),
+                              config.scheduling_policy))
     actgroup = parser.add_mutually_exclusive_group()
     actgroup.add_argument("-x", "--exclude", choices=ACTIONS.keys(),
                           default=[], metavar="ACTION", 
@@ -2098,5 +2790,42 @@ if __name__ == '__main__':
                              "modification time. Exisiting DB entries will "
                              "not be modified or duplicated. (Default: "
                              "only load recently modified directories.)")
+    parser.add_argument("--watch", dest="watch", action="store_true",
+                        help="Watch the raw data directories while running. "
+                             "New directories are loaded as they appear and "
+                             "grouped once they stop changing. (Default: "
+                             "only load directories when starting.)")
+    parser.add_argument("--mem-budget", dest='mem_budget', type=int,
+                        default=None, metavar="MB",
+                        help="Maximum amount of memory, in MB, tasks "
+                             "should use at once. Tasks are launched if "
+                             "their estimated memory use fits. (Default: "
+                             "use config.memory_budget)")
+    parser.add_argument("--distributed", dest="distributed",
+                        action="store_true",
+                        help="Share the database with instances running "
+                             "on other hosts. Calibrator databases are "
+                             "then locked through the database instead "
+                             "of locally. Files are always claimed "
+                             "atomically, so this only matters when "
+                             "instances run on more than one host. "
+                             "(Default: use config.distributed)")
+    parser.add_argument("--chain", dest="chain", action="store_true",
+                        help="Have a single task perform consecutive "
+                             "actions that need no human input (%s) "
+                             "on an observation, one after the other. "
+                             "(Default: launch a separate task for each "
+                             "action.)" % ", ".join(CHAINABLE))
+    parser.add_argument("--metrics-file", dest="metrics_file", type=str,
+                        default=config.metrics_file,
+                        help="File to write throughput and latency "
+                             "metrics to, in Prometheus' text format, "
+                             "in each iteration of the main loop. "
+                             "(Default: use config.metrics_file)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int,
+                        default=config.metrics_port,
+                        help="Port to serve throughput and latency "
+                             "metrics on over HTTP, in Prometheus' text "
+                             "format. (Default: use config.metrics_port)")
     args = parser.parse_args()
     main()
@@ -16,6 +16,7 @@ import ui_reviewer
 
 import database
 import utils
+import log
 import reduce_data
 
 
@@ -57,7 +58,7 @@ class FailedFilesModel(qtcore.QAbstractTableModel):
             val = self.__files[row][col]
             if col == 12:
                 with open(val, 'r') as logfile:
-                    val = logfile.read()
+                    val = log.format_log(logfile.read())
         elif role == qtcore.Qt.BackgroundRole:
             if row in self.__reattempted:
                 val = qtgui.QBrush(qtgui.QColor('#90EE90'))
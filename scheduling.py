@@ -0,0 +1,463 @@
+"""
+Order tasks for the automated data reduction.
+
+The cost of a task is estimated from its observation's metadata
+and the time previous tasks of the same action took. Each action
+has a measure of the amount of work a task involves (see
+'get_work_units'). The number of seconds per unit of work is
+learned from the wall time of the external commands recorded in
+the 'syscalls' table.
+
+Scheduling policies:
+    fifo: Keep the order rows come out of the database.
+    sjf: Shortest (estimated) job first.
+    fair: Take turns between sources, shortest job first for
+        each source, so one source's long observations don't
+        hold up everybody else's.
+    deadline: Least slack first. Observations should be
+        processed within 'config.scheduling_deadline' seconds of
+        being added to the database. The slack is the time left
+        before the deadline once the task is complete.
+
+Tasks' peak memory use is estimated the same way, using the
+maximum resident set size of recorded commands per unit of work.
+A MemoryBudget only admits tasks whose estimated memory fits in
+what is left of the node's budget.
+"""
+import time
+import datetime
+
+import sqlalchemy as sa
+
+from coast_guard import config
+from coast_guard import errors
+from coast_guard import utils
+
+
+POLICIES = ['fifo', 'sjf', 'fair', 'deadline']
+
+# Policies whose order can't be computed by the database
+# consider this many times more candidates than requested
+CANDIDATE_FACTOR = 10
+
+# Number of seconds cost models are re-used before being
+# re-computed from the database
+MODELS_REFRESH = 600
+
+# Percentile of past tasks' memory use per unit of work used
+# to estimate the memory future tasks will need
+MEMORY_PERCENTILE = 90
+
+# Cached cost models, and the time they were computed
+__models = None
+__models_time = None
+
+
+def get_work_units(action, row):
+    """Get the amount of work a task involves, in units whose
+        processing time is roughly constant.
+
+        Inputs:
+            action: The action to perform.
+            row: The task's row (see 'reduce_data.select_tasks').
+
+        Output:
+            units: The number of units of work.
+    """
+    if action == 'combine':
+        # The 'grouped' file only lists the sub-ints. The work is
+        # proportional to the number of sub-int files to combine.
+        if row['nsubints'] and row['nsubbands']:
+            return row['nsubints']*row['nsubbands']
+        return row['length'] or 0
+    else:
+        return row['filesize'] or 0
+
+
+def compute_cost_models(db):
+    """Compute the number of seconds, and bytes of memory, per
+        unit of work of each action from the recorded resource
+        usage of past tasks.
+
+        Input:
+            db: A Database object to use.
+
+        Outputs:
+            rates: A dictionary mapping actions to seconds per
+                unit of work.
+            memfactors: A dictionary mapping actions to peak
+                memory use, in bytes, per unit of work.
+    """
+    sc = db.syscalls
+    groupcols = [sc.c.action, sc.c.file_id, db.files.c.filesize,
+                 db.obs.c.nsubints, db.obs.c.nsubbands, db.obs.c.length]
+    with db.transaction() as conn:
+        select = db.select(groupcols +
+                           [sa.func.sum(sc.c.wall_time).label('wall_time'),
+                            sa.func.max(sc.c.max_rss).label('max_rss')],
+                    from_obj=[sc.\
+                        join(db.files,
+                            onclause=db.files.c.file_id == sc.c.file_id).\
+                        join(db.obs,
+                            onclause=db.obs.c.obs_id == sc.c.obs_id)]).\
+                    group_by(*groupcols)
+        results = conn.execute(select)
+        rows = results.fetchall()
+        results.close()
+    totals = {}
+    ratios = {}
+    for row in rows:
+        units = get_work_units(row['action'], row)
+        if not units:
+            continue
+        if row['wall_time']:
+            wall, nunits = totals.get(row['action'], (0.0, 0))
+            totals[row['action']] = (wall+row['wall_time'], nunits+units)
+        if row['max_rss']:
+            # 'max_rss' is in kB
+            ratios.setdefault(row['action'], []).\
+                    append(row['max_rss']*1024.0/units)
+    rates = {}
+    for action, (wall, nunits) in totals.iteritems():
+        rates[action] = wall/float(nunits)
+        utils.print_debug("Estimated cost of '%s' tasks: %g s per unit "
+                          "of work" % (action, rates[action]), 'reduce')
+    memfactors = {}
+    for action, actratios in ratios.iteritems():
+        actratios.sort()
+        index = int(len(actratios)*MEMORY_PERCENTILE/100.0)
+        memfactors[action] = actratios[min(index, len(actratios)-1)]
+        utils.print_debug("Estimated memory use of '%s' tasks: %g bytes "
+                          "per unit of work" % (action, memfactors[action]),
+                          'reduce')
+    return rates, memfactors
+
+
+def get_cost_models(db):
+    """Get the number of seconds, and bytes of memory, per unit
+        of work of each action. They are re-computed every
+        'MODELS_REFRESH' seconds.
+
+        Input:
+            db: A Database object to use.
+
+        Outputs:
+            rates: A dictionary mapping actions to seconds per
+                unit of work.
+            memfactors: A dictionary mapping actions to peak
+                memory use, in bytes, per unit of work.
+    """
+    global __models, __models_time
+    if (__models is None) or (time.time()-__models_time > MODELS_REFRESH):
+        __models = compute_cost_models(db)
+        __models_time = time.time()
+    return __models
+
+
+def get_rates(db):
+    """Get the number of seconds per unit of work of each
+        action. See 'get_cost_models'.
+    """
+    return get_cost_models(db)[0]
+
+
+def get_memory_factors(db):
+    """Get the peak memory use, in bytes, per unit of work of
+        each action. See 'get_cost_models'.
+    """
+    return get_cost_models(db)[1]
+
+
+def estimate_cost(action, row, rates):
+    """Estimate how long a task will take.
+
+        Inputs:
+            action: The action to perform.
+            row: The task's row.
+            rates: Seconds per unit of work of each action
+                (see 'get_rates').
+
+        Output:
+            cost: The estimated cost in seconds. If the action
+                has no history the number of units of work is
+                returned, so tasks can still be compared to each
+                other.
+    """
+    units = get_work_units(action, row)
+    return units*rates.get(action, 1.0)
+
+
+def estimate_memory(action, row, memfactors):
+    """Estimate the peak memory use of a task.
+
+        Inputs:
+            action: The action to perform.
+            row: The task's row.
+            memfactors: Bytes of memory per unit of work of each
+                action (see 'get_memory_factors').
+
+        Output:
+            nbytes: The estimated peak memory use, in bytes. The
+                recorded commands don't include work done in the
+                worker process itself, so the estimate is never
+                less than what 'config.memory_factors' gives.
+                Combining in memory ('combine_inprocess') holds the
+                whole observation in the worker, which is added.
+    """
+    units = get_work_units(action, row)
+    factor = max(memfactors.get(action, 0),
+                 config.memory_factors.get(action, 0))
+    if (action == 'combine') and config.cfg.combine_inprocess:
+        factor += config.memory_factors.get('combine_inprocess', 0)
+    return int(units*factor)
+
+
+def get_slack(action, row, rates, now=None):
+    """Get the number of seconds that will be left before a
+        task's deadline once the task is complete.
+
+        Inputs:
+            action: The action to perform.
+            row: The task's row.
+            rates: Seconds per unit of work of each action
+                (see 'get_rates').
+            now: The current time. (Default: now)
+
+        Output:
+            slack: The number of seconds of slack. Negative if
+                the deadline can't be met.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    cost = 0.0
+    if action in rates:
+        cost = estimate_cost(action, row, rates)
+    added = row['obs_added'] or now
+    age = now - added
+    age = age.days*86400.0 + age.seconds + age.microseconds*1e-6
+    return config.scheduling_deadline - age - cost
+
+
+def interleave_sources(rows, keyfunc):
+    """Order rows so consecutive rows belong to different
+        sources, as much as possible.
+
+        Inputs:
+            rows: The rows to order.
+            keyfunc: The function to order each source's rows by.
+
+        Output:
+            ordered: A list of the rows in their new order.
+    """
+    bysource = {}
+    for row in rows:
+        bysource.setdefault(row['sourcename'], []).append(row)
+    queues = []
+    for srcrows in bysource.itervalues():
+        srcrows.sort(key=keyfunc)
+        queues.append(srcrows)
+    # Sources with the cheapest tasks get the first turn
+    queues.sort(key=lambda srcrows: keyfunc(srcrows[0]))
+    ordered = []
+    for ii in xrange(max([len(srcrows) for srcrows in queues] or [0])):
+        for srcrows in queues:
+            if ii < len(srcrows):
+                ordered.append(srcrows[ii])
+    return ordered
+
+
+def get_order_by(db, action, policy=None):
+    """Get the ordering the database should apply to tasks, so
+        the best candidates for a policy are returned first.
+
+        Inputs:
+            db: A Database object to use.
+            action: The action the tasks perform.
+            policy: The scheduling policy. (Default:
+                config.scheduling_policy)
+
+        Output:
+            order_by: A list of clauses to order by.
+    """
+    if policy is None:
+        policy = config.scheduling_policy
+    order_by = []
+    if action == 'calibrate':
+        # Calibrator scans first (see 'order_tasks')
+        order_by.append(sa.case([(db.obs.c.obstype == 'cal', 0)], else_=1))
+    if policy in ('sjf', 'fair'):
+        # Smallest amount of work first (see 'get_work_units')
+        if action == 'combine':
+            order_by.append((db.obs.c.nsubints*db.obs.c.nsubbands).asc())
+        else:
+            order_by.append(db.files.c.filesize.asc())
+    elif policy == 'deadline':
+        order_by.append(db.obs.c.added.asc())
+    order_by.append(db.files.c.file_id.asc())
+    return order_by
+
+
+def get_candidate_limit(limit, policy=None):
+    """Get the number of rows to fetch from the database to
+        pick 'limit' tasks according to a policy.
+
+        Inputs:
+            limit: The number of tasks wanted.
+            policy: The scheduling policy. (Default:
+                config.scheduling_policy)
+
+        Output:
+            ncandidates: The number of rows to fetch.
+    """
+    if policy is None:
+        policy = config.scheduling_policy
+    if policy in ('fifo', 'sjf'):
+        # The database's order is the policy's order
+        return limit
+    return limit*CANDIDATE_FACTOR
+
+
+def order_tasks(db, action, rows, policy=None, now=None):
+    """Order tasks according to a scheduling policy.
+
+        Inputs:
+            db: A Database object to use.
+            action: The action the tasks perform.
+            rows: The tasks' rows (see 'reduce_data.select_tasks').
+            policy: The scheduling policy. Must be one of
+                'POLICIES'. (Default: config.scheduling_policy)
+            now: The current time, as a datetime object, used by
+                the 'deadline' policy. (Default: the time now)
+
+        Output:
+            rows: A list of the rows in the order they should
+                be launched.
+    """
+    if policy is None:
+        policy = config.scheduling_policy
+    if policy not in POLICIES:
+        raise errors.UnrecognizedValueError("The scheduling policy '%s' "
+                                            "is not recognized. Valid "
+                                            "policies are '%s'." %
+                                            (policy, "', '".join(POLICIES)))
+    rows = list(rows)
+    if (policy == 'fifo') or (len(rows) < 2):
+        return rows
+    rates = get_rates(db)
+    if policy == 'deadline':
+        if now is None:
+            now = datetime.datetime.now()
+        keyfunc = lambda row: get_slack(action, row, rates, now)
+    else:
+        keyfunc = lambda row: estimate_cost(action, row, rates)
+    if policy == 'fair':
+        rows = interleave_sources(rows, keyfunc)
+    else:
+        rows.sort(key=keyfunc)
+    if action == 'calibrate':
+        # Calibrator scans must be reduced before the pulsar
+        # observations that need them
+        rows.sort(key=lambda row: row['obstype'] != 'cal')
+    return rows
+
+
+class MemoryBudget(object):
+    def __init__(self, budget=None, starvation_time=None):
+        """Admission control for tasks based on their estimated
+            peak memory use.
+
+            Tasks are admitted while their estimates fit in what
+            is left of the budget. Tasks that don't fit are
+            skipped, so smaller tasks can still fill free slots.
+            A task that is too large for the whole budget is
+            admitted when nothing else is running. Once a task
+            has been turned away for longer than 'starvation_time'
+            seconds, other tasks are held back until it fits.
+
+            Inputs:
+                budget: The memory budget in bytes. None means
+                    no limit. (Default: config.memory_budget)
+                starvation_time: Number of seconds a task may be
+                    turned away before other tasks are held back.
+                    (Default: config.memory_starvation_time)
+        """
+        if budget is None:
+            budget = config.memory_budget
+        if starvation_time is None:
+            starvation_time = config.memory_starvation_time
+        self.budget = budget
+        self.starvation_time = starvation_time
+        # Maps task names to their reserved memory
+        self.reserved = {}
+        # Maps file IDs of tasks turned away to the time they
+        # were first turned away
+        self.waiting = {}
+
+    def get_used(self):
+        """Return the number of bytes reserved by running tasks.
+        """
+        return sum(self.reserved.values())
+
+    def get_starving(self):
+        """Return the file ID of the task that has been turned
+            away for too long, or None.
+        """
+        if not self.waiting:
+            return None
+        file_id, since = min(self.waiting.items(), key=lambda xx: xx[1])
+        if (time.time()-since) > self.starvation_time:
+            return file_id
+        return None
+
+    def admit(self, file_id, nbytes):
+        """Decide if a task may be launched now.
+
+            Inputs:
+                file_id: The ID of the file the task acts on.
+                nbytes: The task's estimated peak memory use.
+
+            Output:
+                admitted: True if the task may be launched.
+        """
+        if self.budget is None:
+            return True
+        used = self.get_used()
+        starving = self.get_starving()
+        if (starving is not None) and (starving != file_id):
+            admitted = False
+        else:
+            admitted = (not self.reserved) or (used+nbytes <= self.budget)
+        if admitted:
+            self.waiting.pop(file_id, None)
+        else:
+            self.waiting.setdefault(file_id, time.time())
+            utils.print_debug("Not launching task on File ID %d yet. It "
+                              "needs an estimated %d MB (%d of %d MB in "
+                              "use)" % (file_id, nbytes/1024**2,
+                                        used/1024**2, self.budget/1024**2),
+                              'reduce')
+        return admitted
+
+    def reserve(self, name, nbytes):
+        """Reserve memory for a launched task.
+        """
+        self.reserved[name] = nbytes
+
+    def release(self, name):
+        """Release the memory reserved by a task that has ended.
+        """
+        self.reserved.pop(name, None)
+
+    def forget_waiting(self, file_ids):
+        """Stop tracking turned away tasks whose files are no
+            longer waiting to be processed.
+
+            Input:
+                file_ids: IDs of files still waiting.
+
+            Outputs:
+                None
+        """
+        for file_id in self.waiting.keys():
+            if file_id not in file_ids:
+                del self.waiting[file_id]
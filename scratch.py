@@ -0,0 +1,316 @@
+"""
+Manage scratch space for temporary files and directories.
+
+Temporary work is placed in a RAM-backed (tmpfs) directory when
+its estimated size fits in the configured budget, and in
+'config.tmp_directory' otherwise.
+
+Reservations made by all processes on a host are recorded in a
+ledger file, which is protected by a lock. This way concurrent
+workers see each others' usage. Reservations belonging to
+processes that no longer exist (e.g. workers that crashed) are
+removed, along with their files, the next time the ledger is
+updated.
+"""
+import os
+import os.path
+import errno
+import fcntl
+import shutil
+import socket
+import tempfile
+import warnings
+import contextlib
+
+from coast_guard import config
+from coast_guard import errors
+from coast_guard import utils
+
+
+LEDGER_NAME = ".scratch_ledger"
+
+
+def get_tmpfs_directory():
+    """Get the RAM-backed scratch directory, creating it if
+        necessary.
+
+        Inputs:
+            None
+
+        Output:
+            tmpfsdir: The tmpfs directory, or None if no usable
+                tmpfs directory is configured.
+    """
+    tmpfsdir = config.tmpfs_directory
+    if tmpfsdir is None:
+        return None
+    try:
+        os.makedirs(tmpfsdir)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST:
+            warnings.warn("Cannot create tmpfs scratch directory (%s): %s. "
+                          "Temporary files will be written to %s." %
+                          (tmpfsdir, exc, config.tmp_directory),
+                          errors.CoastGuardWarning)
+            return None
+    return tmpfsdir
+
+
+def get_free_space(path):
+    """Get the number of bytes available on the file system
+        containing 'path'.
+
+        Input:
+            path: A path on the file system.
+
+        Output:
+            nbytes: The number of bytes available.
+    """
+    stats = os.statvfs(path)
+    return stats.f_bavail*stats.f_frsize
+
+
+def is_alive(pid):
+    """Return True if a process with the given PID exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def remove_path(path):
+    """Remove a scratch file or directory, if it exists.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class Ledger(object):
+    def __init__(self, ledgerdir=None):
+        """A record of scratch space reservations shared by
+            all processes on this host.
+
+            Input:
+                ledgerdir: Directory containing the ledger file.
+                    (Default: config.tmp_directory)
+        """
+        if ledgerdir is None:
+            ledgerdir = config.tmp_directory
+        self.fn = os.path.join(ledgerdir, LEDGER_NAME)
+        self.lockfile = None
+        self.entries = None
+
+    def __enter__(self):
+        self.lockfile = open(self.fn+".lock", 'a')
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        self.entries = self.read()
+        self.reap()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                self.write()
+        finally:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+            self.lockfile.close()
+            self.lockfile = None
+            self.entries = None
+
+    def read(self):
+        """Read the ledger file.
+
+            Inputs:
+                None
+
+            Output:
+                entries: A list of (host, pid, nbytes, intmpfs, path)
+                    tuples.
+        """
+        entries = []
+        if not os.path.exists(self.fn):
+            return entries
+        with open(self.fn, 'r') as ff:
+            for line in ff:
+                split = line.strip().split(None, 4)
+                if len(split) != 5:
+                    continue
+                host, pid, nbytes, intmpfs, path = split
+                entries.append((host, int(pid), int(nbytes),
+                                intmpfs == '1', path))
+        return entries
+
+    def write(self):
+        """Write the ledger file atomically.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        tmpfn = "%s.%d" % (self.fn, os.getpid())
+        with open(tmpfn, 'w') as ff:
+            for host, pid, nbytes, intmpfs, path in self.entries:
+                ff.write("%s %d %d %d %s\n" % (host, pid, nbytes,
+                                               int(intmpfs), path))
+        os.rename(tmpfn, self.fn)
+
+    def reap(self):
+        """Remove reservations, and their files, belonging to
+            processes on this host that no longer exist.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        host = socket.gethostname()
+        keep = []
+        for entry in self.entries:
+            if (entry[0] == host) and not is_alive(entry[1]):
+                utils.print_debug("Removing scratch space (%s) of "
+                                  "defunct process (PID: %d)" %
+                                  (entry[4], entry[1]), 'scratch')
+                remove_path(entry[4])
+            else:
+                keep.append(entry)
+        self.entries = keep
+
+    def get_tmpfs_usage(self):
+        """Get the number of bytes reserved in the tmpfs
+            directory on this host.
+        """
+        host = socket.gethostname()
+        return sum([nbytes for ehost, pid, nbytes, intmpfs, path
+                    in self.entries if intmpfs and (ehost == host)])
+
+    def add(self, path, nbytes, intmpfs):
+        self.entries.append((socket.gethostname(), os.getpid(),
+                             int(nbytes), intmpfs, path))
+
+    def remove(self, path):
+        self.entries = [entry for entry in self.entries
+                        if entry[4] != path]
+
+
+def reserve(nbytes, isdir, suffix="", prefix="tmp"):
+    """Create a scratch file or directory, in the tmpfs
+        directory if 'nbytes' fits in the budget, or in
+        'config.tmp_directory' otherwise.
+
+        Inputs:
+            nbytes: The estimated maximum size of the scratch
+                space, in bytes.
+            isdir: If True create a directory, otherwise create
+                a file.
+            suffix: Suffix of the scratch file/directory name.
+                (Default: no suffix)
+            prefix: Prefix of the scratch file/directory name.
+                (Default: 'tmp')
+
+        Output:
+            path: The scratch file/directory created.
+    """
+    with Ledger() as ledger:
+        basedir = config.tmp_directory
+        intmpfs = False
+        tmpfsdir = get_tmpfs_directory()
+        if tmpfsdir is not None:
+            used = ledger.get_tmpfs_usage()
+            if (used+nbytes <= config.tmpfs_budget) and \
+                    (nbytes < get_free_space(tmpfsdir)):
+                basedir = tmpfsdir
+                intmpfs = True
+            else:
+                utils.print_debug("Scratch space request (%d bytes) "
+                                  "doesn't fit in tmpfs (%d of %d bytes "
+                                  "in use). Using %s." %
+                                  (nbytes, used, config.tmpfs_budget,
+                                   basedir), 'scratch', stepsback=3)
+        if isdir:
+            path = tempfile.mkdtemp(suffix=suffix, prefix=prefix,
+                                    dir=basedir)
+        else:
+            fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix,
+                                        dir=basedir)
+            os.close(fd)
+        ledger.add(path, nbytes, intmpfs)
+    utils.print_debug("Reserved %d bytes of scratch space: %s" %
+                      (nbytes, path), 'scratch', stepsback=3)
+    return path
+
+
+def mkdtemp(nbytes=0, suffix="", prefix="tmp"):
+    """Create a scratch directory. See 'reserve' for details.
+    """
+    return reserve(nbytes, True, suffix=suffix, prefix=prefix)
+
+
+def mkstemp(nbytes=0, suffix="", prefix="tmp"):
+    """Create a scratch file. See 'reserve' for details.
+        Unlike 'tempfile.mkstemp' only the file's name is returned.
+    """
+    return reserve(nbytes, False, suffix=suffix, prefix=prefix)
+
+
+def release(path, remove=True):
+    """Release a scratch file or directory.
+
+        Inputs:
+            path: The scratch file/directory to release.
+            remove: If True, also remove the file/directory.
+                (Default: True)
+
+        Outputs:
+            None
+    """
+    with Ledger() as ledger:
+        ledger.remove(path)
+    if remove:
+        remove_path(path)
+    utils.print_debug("Released scratch space: %s" % path, 'scratch',
+                      stepsback=2)
+
+
+def reap():
+    """Remove scratch space belonging to processes on this host
+        that no longer exist.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    with Ledger():
+        pass
+
+
+@contextlib.contextmanager
+def scratch_directory(nbytes=0, suffix="", prefix="tmp"):
+    """A context manager providing a scratch directory that
+        is removed on exit.
+    """
+    path = mkdtemp(nbytes, suffix=suffix, prefix=prefix)
+    try:
+        yield path
+    finally:
+        release(path)
+
+
+@contextlib.contextmanager
+def scratch_file(nbytes=0, suffix="", prefix="tmp"):
+    """A context manager providing a scratch file name that
+        is removed on exit (unless it has been moved away).
+    """
+    path = mkstemp(nbytes, suffix=suffix, prefix=prefix)
+    try:
+        yield path
+    finally:
+        release(path)
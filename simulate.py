@@ -0,0 +1,604 @@
+#!/usr/bin/env python
+"""
+Replay the history of the automated data reduction (reduce_data.py)
+with different scheduler settings, to plan how many processes are
+needed to keep up with incoming data and how the settings affect the
+time observations take to be done.
+
+Each observation arrives when its grouped file was added to the
+database, and takes the path it took historically (e.g. observations
+that failed cleaning fail again). Each action takes as long as it
+took historically: the wall time of the external commands it ran
+(see the 'syscalls' table). If none were recorded the time is
+estimated with the cost models (see 'scheduling.get_rates'), or
+failing that, taken to be the time between the input and output
+files being added. Files wait for quality control as long as they
+did historically.
+
+The database is only read. Nothing is reduced.
+"""
+import math
+import heapq
+import datetime
+import itertools
+
+import sqlalchemy as sa
+
+from coast_guard import config
+from coast_guard import utils
+from coast_guard import database
+from coast_guard import scheduling
+from coast_guard import reduce_data
+
+
+# Map stages to the action performed on files of that stage
+STAGE_ACTIONS = dict([(stage, action) for action, (stages, qcpassed_only,
+                                                   withlock, actfunc)
+                      in reduce_data.ACTIONS.iteritems()
+                      for stage in stages])
+
+# Actions that must wait for a file of the given stage to pass
+# quality control, as (action, stage) tuples
+QC_GATES = [('calibrate', 'cleaned'), ('load', 'calibrated')]
+
+PERCENTILES = [50, 90, 99]
+
+
+def get_seconds(delta):
+    return delta.days*86400.0 + delta.seconds + delta.microseconds*1e-6
+
+
+def get_percentile(values, pct):
+    """Get a percentile of a list of values (nearest rank).
+
+        Inputs:
+            values: The values.
+            pct: The percentile, between 0 and 100.
+
+        Output:
+            value: The percentile's value. None if there are
+                no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = int(math.ceil(pct/100.0*len(ordered)))-1
+    return ordered[max(0, index)]
+
+
+def get_obs_whereclause(db, start=None, end=None, priorities=None):
+    """Get the condition observations to replay satisfy.
+
+        Inputs:
+            db: A Database object to use.
+            start: Only include observations added on or after
+                this date. (Default: no limit)
+            end: Only include observations added before this date.
+                (Default: no limit)
+            priorities: A list of prioritization rules, as returned
+                by 'reduce_data.parse_priorities'.
+                (Default: include all observations)
+
+        Output:
+            whereclause: The condition.
+    """
+    whereclauses = []
+    if start is not None:
+        whereclauses.append(db.obs.c.added >= start)
+    if end is not None:
+        whereclauses.append(db.obs.c.added < end)
+    if priorities:
+        prioritizer, cfgstr = priorities[0]
+        tmp = prioritizer(db, cfgstr)
+        for prioritizer, cfgstr in priorities[1:]:
+            tmp |= prioritizer(db, cfgstr)
+        whereclauses.append(tmp)
+    return sa.and_(*whereclauses)
+
+
+def get_history(db, whereclause):
+    """Read the history of observations' reduction.
+
+        Inputs:
+            db: A Database object to use.
+            whereclause: The condition observations satisfy
+                (see 'get_obs_whereclause').
+
+        Outputs:
+            files: A dictionary mapping obs IDs to a dictionary
+                of their files' rows, keyed by file ID.
+            services: A dictionary mapping (file ID, action) to the
+                wall time, in seconds, of the commands run by the
+                action on the file.
+            qcadded: A dictionary mapping file IDs to the time they
+                were first given a quality control grade.
+    """
+    files = {}
+    services = {}
+    qcadded = {}
+    with db.transaction() as conn:
+        select = db.select([db.files,
+                            db.obs.c.sourcename,
+                            db.obs.c.obstype,
+                            db.obs.c.length,
+                            db.obs.c.nsubints,
+                            db.obs.c.nsubbands,
+                            db.obs.c.current_file_id,
+                            db.obs.c.added.label('obs_added')],
+                    from_obj=[db.obs.\
+                        join(db.files,
+                            onclause=db.files.c.obs_id == db.obs.c.obs_id)]).\
+                    where(whereclause).\
+                    order_by(db.files.c.file_id)
+        results = conn.execute(select)
+        for row in results:
+            files.setdefault(row['obs_id'], {})[row['file_id']] = dict(row)
+        results.close()
+
+        select = db.select([db.syscalls.c.file_id,
+                            db.syscalls.c.action,
+                            sa.func.sum(db.syscalls.c.wall_time).\
+                                    label('wall_time')],
+                    from_obj=[db.syscalls.\
+                        join(db.obs,
+                            onclause=db.syscalls.c.obs_id == db.obs.c.obs_id)]).\
+                    where(whereclause).\
+                    group_by(db.syscalls.c.file_id, db.syscalls.c.action)
+        results = conn.execute(select)
+        for row in results:
+            if row['wall_time'] is not None:
+                services[(row['file_id'], row['action'])] = row['wall_time']
+        results.close()
+
+        select = db.select([db.qctrl.c.file_id,
+                            sa.func.min(db.qctrl.c.added).label('added')],
+                    from_obj=[db.qctrl.\
+                        join(db.obs,
+                            onclause=db.qctrl.c.obs_id == db.obs.c.obs_id)]).\
+                    where(whereclause).\
+                    group_by(db.qctrl.c.file_id)
+        results = conn.execute(select)
+        for row in results:
+            qcadded[row['file_id']] = row['added']
+        results.close()
+    return files, services, qcadded
+
+
+def get_lineage(obsfiles, current_file_id):
+    """Get the files an observation's current file was derived
+        from, by following parent file IDs.
+
+        Inputs:
+            obsfiles: A dictionary of the observation's file rows,
+                keyed by file ID.
+            current_file_id: The ID of the observation's current
+                file.
+
+        Output:
+            lineage: A list of file rows, starting with the grouped
+                file and ending with the current file. Empty if the
+                lineage is incomplete.
+    """
+    lineage = []
+    file_id = current_file_id
+    while file_id is not None:
+        row = obsfiles.get(file_id)
+        if row is None:
+            return []
+        lineage.insert(0, row)
+        file_id = row['parent_file_id']
+    if lineage and (lineage[0]['stage'] != 'grouped'):
+        return []
+    return lineage
+
+
+def is_loaded(row):
+    """Return True if loading the file into TOASTER was attempted
+        (see 'reduce_data.load_to_toaster').
+    """
+    note = row['note'] or ''
+    return note.startswith("Loaded into TOASTER") or \
+            note.startswith("Could not be loaded")
+
+
+def get_plan(lineage):
+    """Get the actions that were performed on an observation.
+
+        Input:
+            lineage: The observation's files (see 'get_lineage').
+
+        Outputs:
+            steps: A list of (action, row, child row) tuples, in
+                the order the actions were performed. 'row' is the
+                file the action was performed on. 'child row' is the
+                file it produced, or None.
+            isdone: True if the observation's reduction is done.
+    """
+    steps = []
+    for parent, child in zip(lineage[:-1], lineage[1:]):
+        steps.append((STAGE_ACTIONS[parent['stage']], parent, child))
+    current = lineage[-1]
+    stage = current['stage']
+    status = current['status']
+    isdone = False
+    if status == 'failed':
+        if stage in STAGE_ACTIONS:
+            # The action performed on the current file failed
+            steps.append((STAGE_ACTIONS[stage], current, None))
+    elif (stage == 'cleaned') and (status in ('calfail', 'toload', 'done')):
+        # Calibration failed
+        steps.append(('calibrate', current, None))
+        if is_loaded(current):
+            steps.append(('load', current, None))
+            isdone = True
+    elif (stage == 'calibrated') and (status == 'done'):
+        if is_loaded(current):
+            steps.append(('load', current, None))
+        isdone = True
+    elif (status == 'new') and (STAGE_ACTIONS.get(stage) in
+                                reduce_data.CHAINABLE):
+        # The next action would be performed without waiting
+        # for quality control
+        steps.append((STAGE_ACTIONS[stage], current, None))
+    return steps, isdone
+
+
+def get_plans(db, files, services, qcadded, qc_delay=None):
+    """Get the observations to replay.
+
+        Inputs:
+            db: A Database object to use.
+            files, services, qcadded: The history of observations'
+                reduction (see 'get_history').
+            qc_delay: The number of seconds files wait for quality
+                control. (Default: as long as they did historically)
+
+        Outputs:
+            plans: A list of dictionaries, one per observation, with
+                the time, in seconds, the observation arrived
+                ('arrival'), whether its reduction is done
+                ('isdone'), and its steps ('steps'). Steps are
+                dictionaries with the action ('action'), the file
+                it is performed on ('row'), how long it takes in
+                seconds ('service'), and how long the file waits for
+                quality control before the action can be performed
+                ('gate'). Arrival times are relative to 'start'.
+            start: The time the first observation arrived, as a
+                datetime object.
+            sources: A dictionary mapping where service times came
+                from ('recorded', 'estimated', 'file times' or
+                'unknown') to the number of steps.
+    """
+    rates = scheduling.get_rates(db)
+    histplans = []
+    for obs_id, obsfiles in files.iteritems():
+        current_file_id = obsfiles.values()[0]['current_file_id']
+        lineage = get_lineage(obsfiles, current_file_id)
+        if not lineage:
+            utils.print_debug("Skipping obs ID %d. Its files don't lead "
+                              "back to a grouped file." % obs_id, 'reduce')
+            continue
+        steps, isdone = get_plan(lineage)
+        histplans.append((lineage[0]['added'], steps, isdone))
+    if not histplans:
+        return [], None, {}
+
+    # Historical time files waited for quality control
+    qcdelays = {}
+    for added, steps, isdone in histplans:
+        for action, row, child in steps:
+            if ((action, row['stage']) in QC_GATES) and \
+                        (row['file_id'] in qcadded):
+                qcdelays[row['file_id']] = \
+                        max(0, get_seconds(qcadded[row['file_id']] -
+                                           row['added']))
+    default_qc_delay = get_percentile(qcdelays.values(), 50) or 0
+
+    start = min([added for added, steps, isdone in histplans])
+    plans = []
+    sources = {}
+    for added, steps, isdone in histplans:
+        plan = {'arrival': get_seconds(added-start),
+                'isdone': isdone,
+                'steps': []}
+        for action, row, child in steps:
+            if (row['file_id'], action) in services:
+                service = services[(row['file_id'], action)]
+                source = 'recorded'
+            elif action in rates:
+                service = scheduling.estimate_cost(action, row, rates)
+                source = 'estimated'
+            elif child is not None:
+                service = max(0, get_seconds(child['added']-row['added']))
+                source = 'file times'
+            else:
+                service = 0.0
+                source = 'unknown'
+            sources[source] = sources.get(source, 0)+1
+            gate = 0.0
+            if (action, row['stage']) in QC_GATES:
+                if qc_delay is not None:
+                    gate = qc_delay
+                else:
+                    gate = qcdelays.get(row['file_id'], default_qc_delay)
+            plan['steps'].append({'action': action,
+                                  'row': row,
+                                  'service': service,
+                                  'gate': gate})
+        plans.append(plan)
+    plans.sort(key=lambda plan: plan['arrival'])
+    return plans, start, sources
+
+
+def simulate(plans, actions, numproc, sleep_time, order, chain=False):
+    """Replay observations' reduction with the main loop of
+        'reduce_data.py'.
+
+        The loop launches tasks for the files waiting for each
+        action, in the order given by 'order', until all processes
+        are busy. It then waits until a task ends, or for
+        'sleep_time' seconds. Files that arrive, or pass quality
+        control, while the loop waits are picked up by the next
+        iteration.
+
+        Inputs:
+            plans: The observations to replay (see 'get_plans').
+            actions: The actions to perform, in the order the main
+                loop considers them.
+            numproc: The number of processes.
+            sleep_time: The maximum number of seconds to wait
+                between iterations.
+            order: A function ordering the rows of files waiting
+                for an action. It is called as
+                order(action, rows, seconds since start).
+            chain: Have a task perform consecutive actions that
+                need no human input. (Default: False)
+
+        Output:
+            results: A dictionary with the time observations took
+                to be done, in seconds ('latencies'), the time from
+                the first arrival until the last task ended
+                ('makespan'), the total
+                time tasks ran ('busy'), and the mean and maximum
+                numbers of files waiting for each action
+                ('backlog_mean', 'backlog_max').
+    """
+    counter = itertools.count()
+    # Files that aren't available yet, as
+    # (time available, sequence number, plan, step index)
+    pending = [(plan['arrival']+plan['steps'][0]['gate'], next(counter),
+                plan, 0) for plan in plans if plan['steps']]
+    heapq.heapify(pending)
+    # Files available, for each action, as (plan, step index)
+    waiting = dict([(action, []) for action in actions])
+    # Running tasks, as (end time, sequence number, plan,
+    # index of the next step)
+    running = []
+    latencies = []
+    area = dict([(action, 0.0) for action in actions])
+    backlog_max = dict([(action, 0) for action in actions])
+    busy = 0.0
+    tnow = pending[0][0] if pending else 0.0
+    tlast = tnow
+    while True:
+        for action in actions:
+            area[action] += len(waiting[action])*(tnow-tlast)
+        # Collect tasks that have ended
+        while running and (running[0][0] <= tnow):
+            end, seq, plan, index = heapq.heappop(running)
+            if index < len(plan['steps']):
+                heapq.heappush(pending, (end+plan['steps'][index]['gate'],
+                                         next(counter), plan, index))
+            elif plan['isdone']:
+                latencies.append(end-plan['arrival'])
+        while pending and (pending[0][0] <= tnow):
+            ready, seq, plan, index = heapq.heappop(pending)
+            action = plan['steps'][index]['action']
+            if action in waiting:
+                waiting[action].append((plan, index))
+        # Launch tasks
+        nfree = numproc - len(running)
+        for action in actions:
+            if not nfree:
+                break
+            if not waiting[action]:
+                continue
+            byid = dict([(plan['steps'][index]['row']['file_id'],
+                          (plan, index))
+                         for plan, index in waiting[action]])
+            rows = order(action, [plan['steps'][index]['row']
+                                  for plan, index in waiting[action]], tnow)
+            launched = set()
+            for row in rows[:nfree]:
+                plan, index = byid[row['file_id']]
+                if chain:
+                    acts = [action]+reduce_data.get_chain(action, actions)
+                else:
+                    acts = [action]
+                service = 0.0
+                for act in acts:
+                    if (index >= len(plan['steps'])) or \
+                            (plan['steps'][index]['action'] != act) or \
+                            ((act != action) and plan['steps'][index]['gate']):
+                        break
+                    service += plan['steps'][index]['service']
+                    index += 1
+                heapq.heappush(running, (tnow+service, next(counter),
+                                         plan, index))
+                busy += service
+                launched.add(row['file_id'])
+            waiting[action] = [(plan, index) for plan, index
+                               in waiting[action]
+                               if plan['steps'][index]['row']['file_id']
+                               not in launched]
+            nfree -= len(launched)
+        for action in actions:
+            backlog_max[action] = max(backlog_max[action],
+                                      len(waiting[action]))
+        if not (running or pending or any(waiting.values())):
+            break
+        # Wait until a task ends, or time out
+        twake = tnow + sleep_time
+        if running:
+            twake = min(twake, running[0][0])
+        elif not any(waiting.values()):
+            # Idle. Skip iterations until a file is available.
+            nskip = math.ceil((pending[0][0]-tnow)/float(sleep_time))
+            twake = tnow + max(1, nskip)*sleep_time
+        tlast, tnow = tnow, twake
+    start = min([plan['arrival'] for plan in plans]) if plans else 0.0
+    makespan = tnow-start
+    return {'latencies': latencies,
+            'makespan': makespan,
+            'busy': busy,
+            'backlog_mean': dict([(action, area[action]/makespan
+                                            if makespan else 0.0)
+                                  for action in actions]),
+            'backlog_max': backlog_max}
+
+
+def main():
+    db = database.Database()
+    if args.only_action is not None:
+        actions = [args.only_action]
+    else:
+        actions = [act for act in reduce_data.ACTIONS.keys()
+                   if act not in args.actions_to_exclude]
+    priority_list = []
+    for prioritizer in args.priority:
+        priority_list.extend(reduce_data.parse_priorities(prioritizer))
+    whereclause = get_obs_whereclause(db, args.start, args.end,
+                                      priority_list)
+    files, services, qcadded = get_history(db, whereclause)
+    plans, start, sources = get_plans(db, files, services, qcadded,
+                                      args.qc_delay)
+    if not plans:
+        print "No observations to replay."
+        return
+    print "Replaying %d observations added since %s" % (len(plans), start)
+    print "Action durations: %s" % \
+            ", ".join(["%d %s" % (num, source) for source, num
+                       in sorted(sources.items())])
+    if sources.get('unknown'):
+        print "WARNING: %d actions have no recorded or estimated duration " \
+              "and are assumed to take no time." % sources['unknown']
+    print ""
+    print "%4s %6s %-8s %-5s | %7s %8s %8s %8s %8s | %8s %8s | %8s %5s" % \
+            ("Proc", "Sleep", "Policy", "Chain", "Done",
+             "p50 (h)", "p90 (h)", "p99 (h)", "Max (h)",
+             "Backlog", "Max", "Span (d)", "Util")
+    for numproc, sleep_time, policy in itertools.product(args.numprocs,
+                                                          args.sleep_times,
+                                                          args.policies):
+        def order(action, rows, tnow):
+            rows.sort(key=lambda row: row['file_id'])
+            now = start + datetime.timedelta(seconds=tnow)
+            if action != 'load':
+                rows = scheduling.order_tasks(db, action, rows, policy, now)
+            if action == 'calibrate':
+                # Calibrator scans are selected first (see
+                # 'scheduling.get_order_by')
+                rows.sort(key=lambda row: row['obstype'] != 'cal')
+            return rows
+        results = simulate(plans, actions, numproc, sleep_time, order,
+                           chain=args.chain)
+        latencies = [lat/3600.0 for lat in results['latencies']]
+        pcts = [get_percentile(latencies, pct) for pct in
+                PERCENTILES+[100]]
+        span = results['makespan']
+        print "%4d %6d %-8s %-5s | %7d %s | %8.1f %8d | %8.2f %5.2f" % \
+                (numproc, sleep_time, policy, args.chain,
+                 len(latencies),
+                 " ".join(["%8s" % ("%.2f" % pct if pct is not None else "-")
+                           for pct in pcts]),
+                 sum(results['backlog_mean'].values()),
+                 sum(results['backlog_max'].values()),
+                 span/86400.0,
+                 results['busy']/(numproc*span) if span else 0)
+        if args.per_action:
+            for action in actions:
+                print "%31s: mean backlog %.1f, max %d" % \
+                        (action, results['backlog_mean'][action],
+                         results['backlog_max'][action])
+    print ""
+    print "Done: observations whose reduction was done (of %d). " \
+          "Backlog: mean number of files waiting (summed over actions). " \
+          "Max: sum of each action's maximum. Util: fraction of process " \
+          "time spent running tasks." % \
+            len([plan for plan in plans if plan['isdone']])
+
+
+def parse_date(datestr):
+    return datetime.datetime.strptime(datestr, "%Y-%m-%d")
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Replay the history of "
+                        "the automated data reduction with different "
+                        "scheduler settings, and report the backlog of "
+                        "files waiting and the time observations take to "
+                        "be done. The database is only read.")
+    parser.add_argument("-P", "--num-procs", dest='numprocs', type=int,
+                        action='append', default=[],
+                        help="Number of processes to run simultaneously. "
+                             "Multiple -P/--num-procs options may be "
+                             "provided to compare them. (Default: 1)")
+    parser.add_argument("-t", "--sleep-time", dest='sleep_times', type=int,
+                        action='append', default=[],
+                        help="Maximum number of seconds to wait between "
+                             "iterations of the main loop. Multiple "
+                             "-t/--sleep-time options may be provided "
+                             "to compare them. (Default: 300s)")
+    parser.add_argument("--policy", dest='policies',
+                        choices=scheduling.POLICIES,
+                        action='append', default=[],
+                        help="The policy used to decide which tasks to "
+                             "launch first. Multiple --policy options may "
+                             "be provided to compare them. (Default: %s)" %
+                             config.scheduling_policy)
+    parser.add_argument("--prioritize", action='append',
+                        default=[], dest='priority',
+                        help="A rule for prioritizing observations. Only "
+                             "observations matching a rule are replayed.")
+    actgroup = parser.add_mutually_exclusive_group()
+    actgroup.add_argument("-x", "--exclude",
+                          choices=reduce_data.ACTIONS.keys(),
+                          default=[], metavar="ACTION",
+                          action='append', dest="actions_to_exclude",
+                          help="Action to not perform. Multiple -x/--exclude "
+                               "arguments may be provided. "
+                               "(Default: perform all actions.)")
+    actgroup.add_argument("--only", choices=reduce_data.ACTIONS.keys(),
+                          default=None, metavar="ACTION",
+                          dest="only_action",
+                          help="Only perform the given action. "
+                               "(Default: perform all actions.)")
+    parser.add_argument("--chain", dest="chain", action="store_true",
+                        help="Have a single task perform consecutive "
+                             "actions that need no human input (%s). "
+                             "(Default: launch a separate task for each "
+                             "action.)" % ", ".join(reduce_data.CHAINABLE))
+    parser.add_argument("--start", dest='start', type=parse_date,
+                        default=None,
+                        help="Only replay observations added on or after "
+                             "this date (YYYY-MM-DD). (Default: no limit)")
+    parser.add_argument("--end", dest='end', type=parse_date,
+                        default=None,
+                        help="Only replay observations added before this "
+                             "date (YYYY-MM-DD). (Default: no limit)")
+    parser.add_argument("--qc-delay", dest='qc_delay', type=float,
+                        default=None,
+                        help="Number of seconds files wait for quality "
+                             "control. (Default: as long as each file "
+                             "waited historically)")
+    parser.add_argument("--per-action", dest='per_action',
+                        action='store_true',
+                        help="Also report the backlog of each action.")
+    args = parser.parse_args()
+    if not args.numprocs:
+        args.numprocs = [1]
+    if not args.sleep_times:
+        args.sleep_times = [300]
+    if not args.policies:
+        args.policies = [config.scheduling_policy]
+    main()
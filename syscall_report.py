@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import sqlalchemy as sa
+
+from coast_guard import database
+from coast_guard import utils
+
+
+def get_usage_summary(db, by_obs=False, obs_ids=None, actions=None):
+    """Get the resource usage of external commands aggregated
+        per action and command (and optionally per observation).
+
+        Inputs:
+            db: A Database object.
+            by_obs: Also aggregate per observation. (Default: False)
+            obs_ids: Only include these observations.
+                (Default: include all observations)
+            actions: Only include these actions.
+                (Default: include all actions)
+
+        Output:
+            rows: A list of aggregated rows.
+    """
+    groupcols = [db.syscalls.c.action, db.syscalls.c.command]
+    if by_obs:
+        groupcols.insert(0, db.syscalls.c.obs_id)
+    whereclauses = []
+    if obs_ids:
+        whereclauses.append(db.syscalls.c.obs_id.in_(obs_ids))
+    if actions:
+        whereclauses.append(db.syscalls.c.action.in_(actions))
+    with db.transaction() as conn:
+        select = db.select(groupcols +
+                           [sa.func.count().label('ncalls'),
+                            sa.func.sum(db.syscalls.c.wall_time).\
+                                    label('wall_time'),
+                            sa.func.sum(db.syscalls.c.cpu_time).\
+                                    label('cpu_time'),
+                            sa.func.max(db.syscalls.c.max_rss).\
+                                    label('max_rss'),
+                            sa.func.sum(db.syscalls.c.block_bytes_read).\
+                                    label('block_bytes_read'),
+                            sa.func.sum(db.syscalls.c.block_bytes_written).\
+                                    label('block_bytes_written'),
+                            sa.func.sum(sa.case([(db.syscalls.c.retcode != 0, 1)],
+                                                else_=0)).\
+                                    label('nfailed')]).\
+                    where(sa.and_(*whereclauses)).\
+                    group_by(*groupcols).\
+                    order_by(*groupcols)
+        results = conn.execute(select)
+        rows = results.fetchall()
+        results.close()
+    return rows
+
+
+def main():
+    db = database.Database()
+    rows = get_usage_summary(db, by_obs=args.by_obs,
+                             obs_ids=args.obs_ids, actions=args.actions)
+    if args.by_obs:
+        print "%8s " % "Obs ID",
+    print "%-10s %-12s %7s %12s %12s %12s %13s %13s %7s" % \
+            ("Action", "Command", "Ncalls", "Wall (s)", "CPU (s)",
+             "MaxRSS (MB)", "BlkRead (MB)", "BlkWrite (MB)", "Failed")
+    for row in rows:
+        if args.by_obs:
+            print "%8d " % row['obs_id'],
+        print "%-10s %-12s %7d %12.1f %12.1f %12.1f %13.1f %13.1f %7d" % \
+                (row['action'], row['command'], row['ncalls'],
+                 row['wall_time'] or 0, row['cpu_time'] or 0,
+                 (row['max_rss'] or 0)/1024.0,
+                 (row['block_bytes_read'] or 0)/1024.0**2,
+                 (row['block_bytes_written'] or 0)/1024.0**2,
+                 row['nfailed'] or 0)
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Report the resource "
+                        "usage of external commands run by the automated "
+                        "data reduction, aggregated by action and command.")
+    parser.add_argument("--by-obs", dest="by_obs", action="store_true",
+                        help="Also aggregate per observation. "
+                             "(Default: aggregate over all observations)")
+    parser.add_argument("-O", "--obs-id", dest="obs_ids", type=int,
+                        action="append", default=[],
+                        help="Observation ID to include. Multiple "
+                             "-O/--obs-id options may be provided. "
+                             "(Default: include all observations)")
+    parser.add_argument("-a", "--action", dest="actions", type=str,
+                        action="append", default=[],
+                        help="Action to include. Multiple -a/--action "
+                             "options may be provided. "
+                             "(Default: include all actions)")
+    args = parser.parse_args()
+    main()
@@ -13,12 +13,18 @@ import optparse
 import sys
 import subprocess
 import types
-import inspect
 import datetime
 import argparse
 import string
+import time
 import tempfile
 import stat
+import shutil
+import errno
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import functools
 
 import numpy as np
 
@@ -87,11 +93,24 @@ jname_cache = {}
 prefname_cache = {}
 # A cache for version IDs
 versionid_cache = {}
+# The code version fingerprint of this process
+__fingerprint = None
+# The modification time of the version file when it was last read
+__version_file_mtime = None
 # A cache for fluxcal names
 __fluxcals = None
 # A cache for psrchive configurations
 __psrchive_configs = None
 
+# Number of bytes to read at a time when computing checksums
+MD5_BLOCK_SIZE = 4*1024*1024
+# Resource usage of external commands. This is only
+# recorded while syscall accounting is turned on.
+__syscall_records = None
+# ArchiveFile objects kept in memory while archive file
+# caching is on. Maps file names to (mtime, size, ArchiveFile).
+__archive_files = None
+
 def get_psrchive_configs():
     global __psrchive_configs
     if __psrchive_configs is None:
@@ -196,6 +215,31 @@ def set_warning_mode(mode=None, reset=True):
     warnings.simplefilter(mode)
 
 
+def get_caller_info(stepsback=1):
+    """Get the file name, line number and function name of
+        a caller.
+
+        Input:
+            stepsback: The number of steps back into the call stack
+                from the function calling 'get_caller_info'.
+                (Default: 1 - i.e. its caller)
+
+        Outputs:
+            fn: The base name of the caller's file.
+            lineno: The line number.
+            funcnm: The name of the caller's function.
+    """
+    # 'sys._getframe' is much cheaper than 'inspect.stack', which
+    # reads the source of every frame on the stack.
+    try:
+        frame = sys._getframe(stepsback+1)
+    except ValueError:
+        # The stack isn't that deep
+        return "?", 0, "?"
+    code = frame.f_code
+    return os.path.split(code.co_filename)[-1], frame.f_lineno, code.co_name
+
+
 def log_message(msg, level='info'):
     """Log a message
 
@@ -207,9 +251,11 @@ def log_message(msg, level='info'):
         Outputs:
             None
     """
-    fn, lineno, funcnm = inspect.stack()[1][1:4]
+    if not log.is_enabled(level):
+        return
+    fn, lineno, funcnm = get_caller_info()
     log.log("Log message: [%s:%d - %s(...)]\n%s" % \
-            (os.path.split(fn)[-1], lineno, funcnm, msg), level)
+            (fn, lineno, funcnm, msg), level)
 
 
 def print_info(msg, level=1):
@@ -226,16 +272,21 @@ def print_info(msg, level=1):
         Outputs:
             None
     """
-    fn, lineno, funcnm = inspect.stack()[1][1:4]
-    if config.log_verbosity >= level:
+    to_log = (config.log_verbosity >= level) and log.is_enabled('info')
+    to_print = (config.verbosity >= level)
+    if not (to_log or to_print):
+        return
+    if to_log or config.excessive_verbosity:
+        fn, lineno, funcnm = get_caller_info()
+    if to_log:
         log.log("verbosity: %d [%s:%d - %s(...)]\n%s" % \
-                (level, os.path.split(fn)[-1], lineno, funcnm, msg), 'info')
+                (level, fn, lineno, funcnm, msg), 'info')
 
-    if config.verbosity >= level:
+    if to_print:
         if config.excessive_verbosity:
             # Get caller info
             colour.cprint("INFO (level: %d) [%s:%d - %s(...)]:" % 
-                    (level, os.path.split(fn)[-1], lineno, funcnm), 'infohdr')
+                    (level, fn, lineno, funcnm), 'infohdr')
             msg = msg.replace('\n', '\n    ')
             colour.cprint("    %s" % msg, 'info')
         else:
@@ -259,14 +310,14 @@ def print_debug(msg, category, stepsback=1):
             None
     """
     if config.debug.is_on(category):
-        fn, lineno, funcnm = inspect.stack()[stepsback][1:4]
+        fn, lineno, funcnm = get_caller_info(stepsback)
         log.log("mode: %s [%s:%d - %s(...)]\n%s" % \
-                (category.upper(), os.path.split(fn)[-1], lineno, 
+                (category.upper(), fn, lineno, 
                     funcnm, msg), 'debug')
         if config.helpful_debugging:
             # Get caller info
             to_print = colour.cstring("DEBUG %s [%s:%d - %s(...)]:\n" % \
-                        (category.upper(), os.path.split(fn)[-1], lineno, funcnm), \
+                        (category.upper(), fn, lineno, funcnm), \
                             'debughdr')
             msg = msg.replace('\n', '\n    ')
             to_print += colour.cstring("    %s" % msg, 'debug')
@@ -303,7 +354,9 @@ def get_norm_parfile(arfn):
             arfn: Name of archive file.
 
         Output:
-            parfn: Name of (temporary) parfile.
+            parfn: Name of (temporary) parfile. It must be
+                released with 'scratch.release' (see
+                'normalise_parfile').
     """
     return normalise_parfile(extract_parfile(arfn))
 
@@ -320,7 +373,9 @@ def normalise_parfile(par):
                 c) A list of parfile lines (ie a list of strings)
 
         Output:
-            parfn: Name of (temporary) parfile.
+            parfn: Name of (temporary) parfile. It is a scratch
+                file, so the caller must release it with
+                'scratch.release' once done with it.
     """
     if isinstance(par, types.StringTypes):
         # Assume input is
@@ -340,36 +395,139 @@ def normalise_parfile(par):
                     and (not line.startswith("JUMP"))]
     
     # Make a temporary file for the parfile
-    tmpfd, tmpfn = tempfile.mkstemp(suffix='.par', dir=config.tmp_directory)
-    tmpfile = os.fdopen(tmpfd, 'w')
-    tmpfile.write("\n".join(parlines)+"\n")
+    from coast_guard import scratch
+    text = "\n".join(parlines)+"\n"
+    tmpfn = scratch.mkstemp(nbytes=len(text), suffix='.par')
+    tmpfile = open(tmpfn, 'w')
+    tmpfile.write(text)
     tmpfile.close()
     print_info("Normalised parfile output to %s." % tmpfn, 3)
     return tmpfn
 
 
-def get_md5sum(fn, block_size=16*8192):
+def get_md5sum(fn, block_size=MD5_BLOCK_SIZE, use_mmap=True):
     """Compute and return the MD5 sum for the given file.
-        The file is read in blocks of 'block_size' bytes.
+        The file is memory-mapped and hashed in a single call,
+        unless 'use_mmap' is False, in which case it is read in
+        blocks of 'block_size' bytes.
 
         Inputs:
             fn: The name of the file to get the md5 for.
             block_size: The number of bytes to read at a time.
-                (Default: 16*8192)
+                (Default: 4 MiB)
+            use_mmap: Memory-map the file instead of reading
+                it in blocks. (Default: True)
 
         Output:
             md5: The hexidecimal string of the MD5 checksum.
     """
-    f = open(fn, 'rb')
     md5 = hashlib.md5()
-    block = f.read(block_size)
-    while block:
-        md5.update(block)
-        block = f.read(block_size)
-    f.close()
+    with open(fn, 'rb') as ff:
+        # Empty files cannot be memory-mapped
+        if use_mmap and os.fstat(ff.fileno()).st_size:
+            mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                md5.update(mm)
+            finally:
+                mm.close()
+        else:
+            block = ff.read(block_size)
+            while block:
+                md5.update(block)
+                block = ff.read(block_size)
     return md5.hexdigest()
 
 
+def get_md5sums(fns, numproc=None):
+    """Compute MD5 sums for many files in parallel.
+        This is intended for back-filling checksums of
+        files already on disk.
+
+        Inputs:
+            fns: A list of file names.
+            numproc: The number of processes to use.
+                (Default: the number of CPUs)
+
+        Output:
+            md5sums: A dictionary mapping each file name to
+                its MD5 sum.
+    """
+    pool = multiprocessing.Pool(numproc)
+    try:
+        md5sums = pool.map(get_md5sum, fns, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(fns, md5sums))
+
+
+def copy_file_md5sum(src, dest, block_size=MD5_BLOCK_SIZE):
+    """Copy a file and compute its MD5 sum in the same pass,
+        so the data are only read once. File permission bits
+        and timestamps are copied as well (like shutil.copy2).
+
+        Inputs:
+            src: The file to copy.
+            dest: The destination file name.
+            block_size: The number of bytes to copy at a time.
+                (Default: 4 MiB)
+
+        Output:
+            md5: The hexidecimal string of the MD5 checksum.
+    """
+    md5 = hashlib.md5()
+    with open(src, 'rb') as infile:
+        with open(dest, 'wb') as outfile:
+            block = infile.read(block_size)
+            while block:
+                md5.update(block)
+                outfile.write(block)
+                block = infile.read(block_size)
+    shutil.copystat(src, dest)
+    return md5.hexdigest()
+
+
+def move_file_md5sum(src, dest, md5sum=None, block_size=MD5_BLOCK_SIZE):
+    """Move a file and return its MD5 sum.
+
+        If possible the file is renamed, which doesn't touch the
+        data. Otherwise (e.g. the destination is on a different
+        file system) the file is copied, computing the checksum
+        in the same pass, and the original is removed. A renamed
+        file still has to be read to be hashed, unless its MD5 sum
+        is provided.
+
+        Inputs:
+            src: The file to move.
+            dest: The destination file name.
+            md5sum: The known MD5 sum of the file. If provided,
+                a copied file is verified against it, and no
+                checksum is computed when the file is renamed.
+                (Default: unknown)
+            block_size: The number of bytes to copy at a time.
+                (Default: 4 MiB)
+
+        Output:
+            md5: The hexidecimal string of the MD5 checksum.
+    """
+    try:
+        os.rename(src, dest)
+    except OSError, exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        # Cross-device move. Copy and checksum in one pass.
+        md5 = copy_file_md5sum(src, dest, block_size)
+        if (md5sum is not None) and (md5 != md5sum):
+            os.remove(dest)
+            raise errors.BadFile("MD5 sum of copied file (%s) doesn't "
+                                 "match expected value (%s != %s)!" %
+                                 (dest, md5, md5sum))
+        os.remove(src)
+    else:
+        md5 = md5sum or get_md5sum(dest, block_size)
+    return md5
+
+
 def get_version_id(db):
     """Get the version ID number from the database.
         If the version number isn't in the database, add it.
@@ -379,24 +537,10 @@ def get_version_id(db):
 
         Output:
             version_id: The version ID for the current pipeline/psrchive
-                combination.
+                combination. This is the version the process started
+                with (see 'get_fingerprint').
     """
-    # Check to make sure the repositories are clean
-    is_gitrepo_dirty(config.coastguard_repo)
-    is_gitrepo_dirty(config.psrchive_repo)
-    # Get git hashes
-    coastguard_githash = get_githash(config.coastguard_repo)
-    if is_gitrepo(config.psrchive_repo):
-        psrchive_githash = get_githash(config.psrchive_repo)
-    else:
-        warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
-                        "Falling back to 'psrchive --version' for version " \
-                        "information." % config.psrchive_repo, \
-                        errors.CoastGuardWarning)
-        cmd = ["psrchive", "--version"]
-        stdout, stderr = execute(cmd)
-        psrchive_githash = stdout.strip()
-  
+    coastguard_githash, psrchive_githash = get_fingerprint()
     if (coastguard_githash, psrchive_githash) in versionid_cache:
         version_id = versionid_cache[(coastguard_githash, psrchive_githash)]
     else:
@@ -439,6 +583,166 @@ def get_version_id(db):
     return version_id
 
 
+def compute_fingerprint():
+    """Compute the fingerprint of the code's version by inspecting
+        the Coast Guard and PSRCHIVE repositories. A warning is
+        issued for repositories with uncommitted changes.
+
+        NOTE: This runs several 'git' commands. Use 'get_fingerprint'
+            to get the fingerprint of the running process.
+
+        Inputs:
+            None
+
+        Output:
+            fingerprint: A (Coast Guard githash, PSRCHIVE githash) tuple.
+    """
+    coastguard_githash = get_githash(config.coastguard_repo)
+    if is_gitrepo(config.psrchive_repo):
+        psrchive_githash = get_githash(config.psrchive_repo)
+    else:
+        warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
+                        "Falling back to 'psrchive --version' for version " \
+                        "information." % config.psrchive_repo, \
+                        errors.CoastGuardWarning)
+        cmd = ["psrchive", "--version"]
+        stdout, stderr = execute(cmd)
+        psrchive_githash = stdout.strip()
+    return coastguard_githash, psrchive_githash
+
+
+def write_version_file(fn, fingerprint=None):
+    """Write the code version fingerprint to a file, so it
+        doesn't need to be computed when the pipeline starts.
+
+        Inputs:
+            fn: The name of the file to write.
+            fingerprint: The fingerprint to write.
+                (Default: compute it with 'compute_fingerprint')
+
+        Outputs:
+            None
+    """
+    if fingerprint is None:
+        fingerprint = compute_fingerprint()
+    coastguard_githash, psrchive_githash = fingerprint
+    # Repositories with uncommitted changes are recorded, so
+    # processes using the file can warn about them
+    repodirs = [config.coastguard_repo or os.path.split(__file__)[0],
+                config.psrchive_repo]
+    with open(fn, 'w') as ff:
+        ff.write("coastguard_githash %s\n" % coastguard_githash)
+        ff.write("psrchive_githash %s\n" % psrchive_githash)
+        for repodir in repodirs:
+            if is_gitrepo(repodir) and is_gitrepo_dirty(repodir):
+                ff.write("dirty %s\n" % os.path.abspath(repodir))
+
+
+def read_version_file(fn):
+    """Read the code version fingerprint from a file written
+        by 'write_version_file'. A warning is issued if the
+        repositories had uncommitted changes when it was written.
+
+        Input:
+            fn: The name of the file to read.
+
+        Output:
+            fingerprint: A (Coast Guard githash, PSRCHIVE githash) tuple.
+    """
+    info = {}
+    dirty = []
+    with open(fn, 'r') as ff:
+        for line in ff:
+            key, sep, val = line.strip().partition(' ')
+            if key == 'dirty':
+                dirty.append(val)
+            elif key:
+                info[key] = val
+    for repodir in dirty:
+        warnings.warn("Git repository (%s) had uncommitted changes when " \
+                        "the version file (%s) was written!" % \
+                        (repodir, fn), errors.LoggedCoastGuardWarning)
+    try:
+        return info['coastguard_githash'], info['psrchive_githash']
+    except KeyError, exc:
+        raise errors.InputError("Version file (%s) is missing '%s'!" % \
+                                (fn, exc.args[0]))
+
+
+def get_fingerprint():
+    """Get the code version fingerprint of this process. It
+        is read from 'config.version_file' if set, and computed
+        otherwise, the first time it is requested.
+
+        The fingerprint describes the code the process started
+        with, so it doesn't change when new code is deployed. If
+        the version file is rewritten with a different version
+        a warning is issued: the process must be restarted to
+        run (and record) the new version.
+
+        Inputs:
+            None
+
+        Output:
+            fingerprint: A (Coast Guard githash, PSRCHIVE githash) tuple.
+    """
+    global __fingerprint, __version_file_mtime
+    if __fingerprint is None:
+        if config.version_file is not None:
+            __version_file_mtime = os.path.getmtime(config.version_file)
+            __fingerprint = read_version_file(config.version_file)
+        else:
+            __fingerprint = compute_fingerprint()
+    elif config.version_file is not None:
+        check_version_file()
+    return __fingerprint
+
+
+def check_version_file():
+    """Warn if the version file has been rewritten with a
+        version other than this process's since it was last
+        checked.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    global __version_file_mtime
+    try:
+        mtime = os.path.getmtime(config.version_file)
+    except OSError:
+        # Being replaced by a deploy. Check again later.
+        return
+    if mtime == __version_file_mtime:
+        return
+    __version_file_mtime = mtime
+    fingerprint = read_version_file(config.version_file)
+    if fingerprint != __fingerprint:
+        warnings.warn("A new code version (Coast Guard: %s; PSRCHIVE: "
+                      "%s) has been deployed, but this process (PID: %d) "
+                      "is still running, and recording, the version it "
+                      "started with (Coast Guard: %s; PSRCHIVE: %s). "
+                      "Restart it to use the new version." %
+                      (fingerprint + (os.getpid(),) + tuple(__fingerprint)),
+                      errors.LoggedCoastGuardWarning)
+
+
+def set_fingerprint(fingerprint):
+    """Set the code version fingerprint of this process
+        (e.g. to one computed by the process that started it).
+
+        Input:
+            fingerprint: A (Coast Guard githash, PSRCHIVE githash) tuple.
+
+        Outputs:
+            None
+    """
+    global __fingerprint
+    __fingerprint = fingerprint
+
+
 def get_githash(repodir=None):
     """Get the git hash of a repository.
 
@@ -559,6 +863,9 @@ def get_archive_snr(fn):
         Output:
             snr: The signal-to-noise ratio of the fully scrunched archive.
     """
+    if config.use_archive_server:
+        from coast_guard import archive_server
+        return archive_server.call('snr', fn)
     cmd = "psrstat -Qq -j DTFp -c 'snr' %s" % fn
     outstr, errstr = execute(cmd)
     snr = float(outstr)
@@ -569,6 +876,131 @@ def exclude_files(file_list, to_exclude):
     return [f for f in file_list if f not in to_exclude]
 
 
+class AccountedPopen(subprocess.Popen):
+    """A subprocess.Popen object that keeps the resource usage
+        of the child process when it is reaped. The usage is
+        stored in the 'rusage' attribute (see os.wait4).
+    """
+    rusage = None
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0)
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                elif exc.errno != errno.ECHILD:
+                    raise
+                # The child has already been reaped elsewhere
+                pid, sts, rusage = self.pid, 0, None
+            if pid == self.pid:
+                self.rusage = rusage
+                self._handle_exitstatus(sts)
+        return self.returncode
+
+
+def start_syscall_accounting():
+    """Start recording the resource usage of each command
+        run with 'execute'. Previous records are discarded.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    global __syscall_records
+    __syscall_records = []
+
+
+def stop_syscall_accounting():
+    """Stop recording the resource usage of commands run
+        with 'execute' and return the records.
+
+        Inputs:
+            None
+
+        Output:
+            records: A list of dictionaries, one per command.
+                (See 'execute' for the keys.)
+    """
+    global __syscall_records
+    records = __syscall_records or []
+    __syscall_records = None
+    return records
+
+
+def start_archive_caching():
+    """Start keeping ArchiveFile objects returned by
+        'get_archive_file' in memory, so that a file's header
+        values (and its loaded archive, if any) are only read
+        once. Previously cached objects are discarded.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    global __archive_files
+    __archive_files = {}
+
+
+def stop_archive_caching():
+    """Stop caching ArchiveFile objects and free the cache.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    global __archive_files
+    __archive_files = None
+
+
+def get_archive_file(fn):
+    """Get an ArchiveFile object for a file. If archive file
+        caching is on (see 'start_archive_caching') and the 
+        file hasn't changed since it was cached, the cached
+        object is returned.
+
+        Input:
+            fn: The name of the archive file.
+
+        Output:
+            arf: An ArchiveFile object.
+    """
+    if __archive_files is not None:
+        fn = os.path.abspath(fn)
+        cached = __archive_files.get(fn)
+        if cached is not None:
+            stats = os.stat(fn)
+            if cached[:2] == (stats.st_mtime, stats.st_size):
+                print_debug("Using cached header values of %s" % fn,
+                            'reduce')
+                return cached[2]
+    arf = ArchiveFile(fn)
+    cache_archive_file(arf)
+    return arf
+
+
+def cache_archive_file(arf):
+    """Keep an ArchiveFile object in memory, if archive file
+        caching is on.
+
+        Input:
+            arf: The ArchiveFile object to cache.
+
+        Outputs:
+            None
+    """
+    if __archive_files is not None:
+        stats = os.stat(arf.fn)
+        __archive_files[arf.fn] = (stats.st_mtime, stats.st_size, arf)
+
+
 def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None): 
     """Execute the command 'cmd' after logging the command
         to STDOUT. Execute the command in the directory 'dir',
@@ -580,6 +1012,13 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         By default stdout is subprocess.PIPE and stderr is sent 
         to sys.stderr.
 
+        If syscall accounting is on, the command's wall time,
+        CPU time, max RSS (kB), block I/O, and exit status are
+        recorded (see 'start_syscall_accounting'). Block I/O only
+        counts reads and writes that reached a block device, so
+        it excludes I/O served by the page cache, or done over
+        network filesystems.
+
         Returns (stdoutdata, stderrdata). These will both be None, 
         unless subprocess.PIPE is provided.
     """
@@ -600,9 +1039,11 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         shell=True
     else:
         shell=False
-    pipe = subprocess.Popen(cmd, shell=shell, cwd=dir, \
+    starttime = time.time()
+    pipe = AccountedPopen(cmd, shell=shell, cwd=dir, \
                             stdout=stdout, stderr=subprocess.PIPE)
     (stdoutdata, stderrdata) = pipe.communicate()
+    walltime = time.time() - starttime
     
     # Close file objects, if any
     if stdoutfile:
@@ -612,6 +1053,35 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
         stderr.close()
     
     retcode = pipe.returncode 
+    usage = pipe.rusage
+    if usage is not None:
+        print_debug("Command finished with status %d (wall: %.2f s; "
+                    "CPU: %.2f s; max RSS: %d kB)" %
+                    (retcode, walltime, usage.ru_utime+usage.ru_stime,
+                     usage.ru_maxrss), 'syscalls', stepsback=2)
+    if __syscall_records is not None:
+        if type(cmd) == types.StringType:
+            cmdstr = cmd
+            prog = cmd.split()[0]
+        else:
+            cmdstr = " ".join(cmd)
+            prog = cmd[0]
+        record = {'command': os.path.basename(prog),
+                  'cmdline': cmdstr,
+                  'wall_time': walltime,
+                  'retcode': retcode,
+                  'cpu_time': None,
+                  'max_rss': None,
+                  'block_bytes_read': None,
+                  'block_bytes_written': None}
+        if usage is not None:
+            record.update({'cpu_time': usage.ru_utime+usage.ru_stime,
+                           'max_rss': usage.ru_maxrss,
+                           # Block counts are in units of 512 bytes
+                           'block_bytes_read': usage.ru_inblock*512,
+                           'block_bytes_written': usage.ru_oublock*512})
+        __syscall_records.append(record)
+
     if retcode < 0:
         raise errors.SystemCallError("Execution of command (%s) " \
                                     "terminated by signal (%s)!" % \
@@ -627,6 +1097,101 @@ def execute(cmd, stdout=subprocess.PIPE, stderr=sys.stderr, dir=None):
     return (stdoutdata, stderrdata)
 
 
+def run_concurrently(funcs, numproc=None, raise_errors=False,
+                     progress=False):
+    """Call functions concurrently using a bounded pool of
+        threads. This is intended for functions that spend
+        their time waiting on external commands (e.g. 'execute').
+
+        Inputs:
+            funcs: A list of functions to call. Each is called
+                without arguments (see functools.partial).
+            numproc: The maximum number of functions to run at 
+                once. (Default: the 'nthreads' configuration)
+            raise_errors: If True, once all calls are complete
+                raise the first exception encountered (in the
+                order of 'funcs'), if any, with its original
+                traceback. (Default: False)
+            progress: If True, show a progress counter as calls
+                complete (see 'show_progress'). (Default: False)
+
+        Output:
+            outcomes: A list of (retval, exc) tuples, in the same
+                order as 'funcs'. 'exc' is None if the call succeeded,
+                otherwise it is the exception raised and 'retval' is
+                None. If 'raise_errors' is True only the return
+                values are returned.
+    """
+    if numproc is None:
+        numproc = config.cfg.nthreads
+
+    def call(func):
+        try:
+            return (func(), None)
+        except Exception:
+            # Keep the traceback so the error can be re-raised
+            # from where it happened
+            return (None, sys.exc_info())
+
+    if (numproc <= 1) or (len(funcs) <= 1):
+        calls = (call(func) for func in funcs)
+        pool = None
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(numproc, len(funcs)))
+        calls = pool.imap(call, funcs, chunksize=1)
+    try:
+        if progress:
+            calls = show_progress(calls, width=50, tot=len(funcs))
+        results = list(calls)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if raise_errors:
+        for retval, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return [retval for retval, exc_info in results]
+    outcomes = [(retval, exc_info and exc_info[1])
+                for retval, exc_info in results]
+    return outcomes
+
+
+def execute_many(cmds, numproc=None, progress=False, **kwargs):
+    """Execute independent commands concurrently.
+        All commands are run, even if some fail.
+
+        Inputs:
+            cmds: A list of commands to execute.
+            numproc: The maximum number of commands to run at 
+                once. (Default: the 'nthreads' configuration)
+            progress: If True, show a progress counter as commands
+                complete. (Default: False)
+            ** Additional keyword arguments are passed to 'execute'
+                for each command.
+
+        Output:
+            results: A list of (stdoutdata, stderrdata) tuples,
+                one per command, in the same order as 'cmds'.
+    """
+    outcomes = run_concurrently([functools.partial(execute, cmd, **kwargs)
+                                 for cmd in cmds], numproc,
+                                progress=progress)
+    failed = [exc for retval, exc in outcomes if exc is not None]
+    if failed:
+        msgs = []
+        for exc in failed:
+            if isinstance(exc, errors.CoastGuardError):
+                msgs.append(exc.get_message())
+            else:
+                msgs.append("%s: %s" % (type(exc).__name__, exc))
+        raise errors.SystemCallError("Execution of %d (of %d) commands "
+                                     "failed!\n%s" %
+                                     (len(failed), len(cmds),
+                                      "\n".join(msgs)))
+    return [retval for retval, exc in outcomes]
+
+
 def group_by_ctr_freq(infns):
     """Given a list of input files group them according to their
         centre frequencies.
@@ -0,0 +1,403 @@
+"""
+Watch raw data directory trees for new observations.
+
+The raw data layout is <basedir>/<pulsar>/<YYYYMMDD>/<sub-band>/.
+New date directories are reported as soon as they are created.
+Once no files have been added to a new date directory for
+'config.watch_settle_time' seconds it is reported as settled,
+and is ready to be grouped.
+
+On Linux, inotify is used (through ctypes) so changes are noticed
+as they happen. Elsewhere, or if inotify cannot be initialised,
+the directory trees are polled using 'dirscan', whose cached
+listings make polling unchanged trees cheap.
+"""
+import os
+import os.path
+import time
+import errno
+import struct
+import select
+import datetime
+import ctypes
+import ctypes.util
+
+from coast_guard import config
+from coast_guard import utils
+from coast_guard import dirscan
+
+
+# inotify constants (see 'man 7 inotify')
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+EVENT_HEADER = struct.Struct('iIII')
+
+# Depths of directories in the raw data tree
+BASE_DEPTH, PULSAR_DEPTH, DATE_DEPTH, SUBBAND_DEPTH = range(4)
+
+
+def is_date_dirname(name):
+    """Return True if 'name' is a valid 'YYYYMMDD' directory name.
+    """
+    if (len(name) != 8) or not name.isdigit():
+        return False
+    try:
+        datetime.datetime.strptime(name, "%Y%m%d")
+    except ValueError:
+        return False
+    return True
+
+
+def wait_readable(fds, timeout):
+    """Wait until any of the file descriptors (or objects with
+        a 'fileno' method) is readable, or 'timeout' seconds
+        elapse. Being interrupted by a signal counts as waking up.
+
+        Inputs:
+            fds: A list of file descriptors to wait on.
+            timeout: Maximum number of seconds to wait.
+
+        Output:
+            ready: A list of the readable file descriptors, or
+                None if interrupted by a signal.
+    """
+    try:
+        return select.select(fds, [], [], timeout)[0]
+    except select.error, exc:
+        if exc.args[0] != errno.EINTR:
+            raise
+        return None
+
+
+class Watcher(object):
+    def __init__(self, basedirs=None, settle_time=None):
+        """Base class of raw data watchers.
+
+            Inputs:
+                basedirs: Roots of the directory trees to watch.
+                    (Default: config.base_rawdata_dirs)
+                settle_time: Number of seconds without changes
+                    before a new date directory is reported as
+                    settled. (Default: config.watch_settle_time)
+        """
+        if basedirs is None:
+            basedirs = config.base_rawdata_dirs
+        if settle_time is None:
+            settle_time = config.watch_settle_time
+        self.basedirs = [os.path.abspath(basedir) for basedir in basedirs]
+        self.settle_time = settle_time
+        # New date directories not reported yet
+        self.newdirs = []
+        # Maps date directories to the time of their last change
+        self.pending = {}
+
+    def found_datedir(self, path):
+        if path not in self.pending:
+            utils.print_debug("New raw data directory: %s" % path, 'scan')
+            self.newdirs.append(path)
+            self.pending[path] = time.time()
+
+    def changed_datedir(self, path):
+        if path in self.pending:
+            self.pending[path] = time.time()
+
+    def read_events(self, timeout, wakefds=()):
+        """Wait up to 'timeout' seconds for changes and process them.
+            Return True if woken up early by one of 'wakefds'.
+            Must be implemented by subclasses.
+        """
+        raise NotImplementedError
+
+    def forget(self, path):
+        """Stop watching a settled date directory. Subclasses
+            may override this.
+        """
+        pass
+
+    def wait(self, timeout, wakefds=()):
+        """Wait until new date directories appear, or pending
+            date directories settle, but no longer than 'timeout'
+            seconds.
+
+            Inputs:
+                timeout: Maximum number of seconds to wait.
+                wakefds: File descriptors that end the wait early
+                    when they become readable. (Default: None)
+
+            Outputs:
+                newdirs: A list of new date directories.
+                settled: A list of date directories that have settled.
+        """
+        deadline = time.time()+timeout
+        while True:
+            now = time.time()
+            settled = [path for path, last in self.pending.iteritems()
+                       if (now-last) >= self.settle_time]
+            if self.newdirs or settled or (now >= deadline):
+                break
+            wait = deadline-now
+            if self.pending:
+                wait = min(wait, min(self.pending.values()) +
+                                 self.settle_time - now)
+            if self.read_events(max(wait, 0), wakefds):
+                break
+        newdirs = self.newdirs
+        self.newdirs = []
+        for path in settled:
+            del self.pending[path]
+            self.forget(path)
+        return newdirs, settled
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, basedirs=None, settle_time=None, poll_interval=None):
+        """A watcher that periodically re-scans the raw data trees.
+
+            Inputs:
+                basedirs: Roots of the directory trees to watch.
+                    (Default: config.base_rawdata_dirs)
+                settle_time: Number of seconds without changes
+                    before a new date directory is reported as
+                    settled. (Default: config.watch_settle_time)
+                poll_interval: Number of seconds between scans.
+                    (Default: config.watch_poll_interval)
+        """
+        super(PollingWatcher, self).__init__(basedirs, settle_time)
+        if poll_interval is None:
+            poll_interval = config.watch_poll_interval
+        self.poll_interval = poll_interval
+        self.known = set(self.scan())
+        self.mtimes = {}
+        self.last_poll = time.time()
+
+    def scan(self):
+        datedirs = []
+        for basedir in self.basedirs:
+            for psrdir in dirscan.list_dirs(basedir):
+                psrdir = os.path.join(basedir, psrdir)
+                datedirs.extend([os.path.join(psrdir, name) for name
+                                 in dirscan.list_dirs(psrdir)
+                                 if is_date_dirname(name)])
+        dirscan.save_cache()
+        return datedirs
+
+    def get_mtime(self, datedir):
+        # Files are written into sub-band directories
+        mtimes = [os.path.getmtime(datedir)]
+        for subdir in dirscan.list_dirs(datedir, cache=False):
+            mtimes.append(os.path.getmtime(os.path.join(datedir, subdir)))
+        return max(mtimes)
+
+    def read_events(self, timeout, wakefds=()):
+        wait = min(timeout, self.last_poll+self.poll_interval-time.time())
+        if wait > 0:
+            ready = wait_readable(list(wakefds), wait)
+            if (ready is None) or ready:
+                return True
+        if time.time() < self.last_poll+self.poll_interval:
+            return False
+        self.last_poll = time.time()
+        for datedir in self.scan():
+            if datedir not in self.known:
+                self.known.add(datedir)
+                self.found_datedir(datedir)
+        for datedir in self.pending.keys():
+            try:
+                mtime = self.get_mtime(datedir)
+            except OSError:
+                # Directory was removed
+                del self.pending[datedir]
+                continue
+            if self.mtimes.get(datedir, mtime) != mtime:
+                self.changed_datedir(datedir)
+            self.mtimes[datedir] = mtime
+        return False
+
+    def forget(self, path):
+        self.mtimes.pop(path, None)
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, basedirs=None, settle_time=None):
+        """A watcher that uses Linux's inotify to be notified
+            of changes to the raw data trees.
+
+            Inputs:
+                basedirs: Roots of the directory trees to watch.
+                    (Default: config.base_rawdata_dirs)
+                settle_time: Number of seconds without changes
+                    before a new date directory is reported as
+                    settled. (Default: config.watch_settle_time)
+        """
+        super(InotifyWatcher, self).__init__(basedirs, settle_time)
+        libcname = ctypes.util.find_library('c')
+        if libcname is None:
+            raise OSError("C library not found")
+        self.libc = ctypes.CDLL(libcname, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Maps watch descriptors to (path, depth, date directory)
+        self.watches = {}
+        # Date directories that exist already, or have been reported
+        self.known = set()
+        for basedir in self.basedirs:
+            self.add_watch(basedir, BASE_DEPTH)
+            for psrdir in dirscan.list_dirs(basedir):
+                psrdir = os.path.join(basedir, psrdir)
+                self.add_watch(psrdir, PULSAR_DEPTH)
+                self.known.update(self.list_datedirs(psrdir))
+        dirscan.save_cache()
+
+    def list_datedirs(self, psrdir):
+        return [os.path.join(psrdir, name) for name
+                in dirscan.list_dirs(psrdir) if is_date_dirname(name)]
+
+    def add_watch(self, path, depth, datedir=None):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before it could be watched
+                return
+            raise OSError(err, "Cannot watch %s: %s" %
+                          (path, os.strerror(err)))
+        self.watches[wd] = (path, depth, datedir)
+
+    def new_directory(self, path, depth, datedir=None):
+        """Start watching a newly created directory. Entries created
+            before the watch was added are handled too.
+        """
+        if depth == PULSAR_DEPTH:
+            self.add_watch(path, depth)
+            for name in os.listdir(path):
+                if is_date_dirname(name) and \
+                        os.path.isdir(os.path.join(path, name)):
+                    self.new_directory(os.path.join(path, name), DATE_DEPTH)
+        elif depth == DATE_DEPTH:
+            self.known.add(path)
+            self.found_datedir(path)
+            self.add_watch(path, depth, path)
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path, name)):
+                    self.new_directory(os.path.join(path, name),
+                                       SUBBAND_DEPTH, path)
+        elif depth == SUBBAND_DEPTH:
+            self.add_watch(path, depth, datedir)
+            self.changed_datedir(datedir)
+
+    def read_events(self, timeout, wakefds=()):
+        ready = wait_readable([self.fd]+list(wakefds), timeout)
+        if ready is None:
+            return True
+        if self.fd not in ready:
+            return bool(ready)
+        buf = os.read(self.fd, 64*1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, namelen = \
+                    EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset+namelen].rstrip('\0')
+            offset += namelen
+            if mask & IN_Q_OVERFLOW:
+                utils.print_debug("inotify event queue overflowed. "
+                                  "Rescanning.", 'scan')
+                self.rescan()
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            parent, depth, datedir = self.watches[wd]
+            path = os.path.join(parent, name)
+            if (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)):
+                if (depth == PULSAR_DEPTH) and not is_date_dirname(name):
+                    continue
+                try:
+                    self.new_directory(path, depth+1, datedir)
+                except OSError:
+                    # Directory was removed already
+                    pass
+            elif datedir is not None:
+                self.changed_datedir(datedir)
+        return len(ready) > 1
+
+    def rescan(self):
+        """Find directories that might have been missed. New date
+            directories are looked for under every pulsar directory,
+            including the ones already watched, and new sub-band
+            directories under every pending date directory.
+        """
+        watched = set([path for path, depth, datedir
+                       in self.watches.itervalues()])
+        for basedir in self.basedirs:
+            for psrdir in dirscan.list_dirs(basedir):
+                psrdir = os.path.join(basedir, psrdir)
+                try:
+                    if psrdir not in watched:
+                        self.new_directory(psrdir, PULSAR_DEPTH)
+                        continue
+                    for datedir in self.list_datedirs(psrdir):
+                        if (datedir not in watched) and \
+                                (datedir not in self.known):
+                            self.new_directory(datedir, DATE_DEPTH)
+                except OSError:
+                    # Directory was removed already
+                    pass
+        dirscan.save_cache()
+        for datedir in self.pending.keys():
+            try:
+                for name in os.listdir(datedir):
+                    subdir = os.path.join(datedir, name)
+                    if (subdir not in watched) and os.path.isdir(subdir):
+                        self.new_directory(subdir, SUBBAND_DEPTH, datedir)
+            except OSError:
+                pass
+            self.changed_datedir(datedir)
+
+    def forget(self, path):
+        for wd, (watched, depth, datedir) in self.watches.items():
+            if datedir == path:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def close(self):
+        os.close(self.fd)
+        self.watches = {}
+
+
+def get_watcher(basedirs=None, settle_time=None):
+    """Get a watcher for the raw data directory trees. An
+        inotify-based watcher is used if possible.
+
+        Inputs:
+            basedirs: Roots of the directory trees to watch.
+                (Default: config.base_rawdata_dirs)
+            settle_time: Number of seconds without changes
+                before a new date directory is reported as
+                settled. (Default: config.watch_settle_time)
+
+        Output:
+            watcher: A Watcher object.
+    """
+    try:
+        watcher = InotifyWatcher(basedirs, settle_time)
+    except (OSError, AttributeError), exc:
+        utils.print_info("Cannot use inotify (%s). Will poll raw data "
+                         "directories instead." % exc, 1)
+        watcher = PollingWatcher(basedirs, settle_time)
+    return watcher
@@ -0,0 +1,295 @@
+"""
+A pool of long-lived worker processes.
+
+Workers run tasks one after another, so database engines, caches
+and loaded libraries stay warm between tasks. To contain leaks, a
+worker exits after running a maximum number of tasks, or once its
+memory use has grown too much. Workers that exit (or die) are
+replaced.
+
+Each worker is given one task at a time, through its own pipe, once
+it has reported it is ready. So the pool always knows which worker
+holds which task, and the task of a worker that dies is reported as
+failed, whether or not the worker had started it.
+"""
+import os
+import resource
+import traceback
+import collections
+import multiprocessing
+import multiprocessing.queues
+
+from coast_guard import utils
+
+
+def get_rss():
+    """Get the resident memory of the current process, in bytes.
+
+        Inputs:
+            None
+
+        Output:
+            rss: The resident set size.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as ff:
+            return int(ff.read().split()[1])*resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Not Linux. Fall back to the peak resident size (in KB).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def work(target, tasks, results, maxtasks=None, maxgrowth=None,
+         initializer=None, notify=None):
+    """The main loop of a worker process.
+
+        Inputs:
+            target: The function to call for each task.
+            tasks: The connection to receive tasks from. Tasks are
+                (taskid, args) tuples. 'None' stops the worker.
+            results: The queue to report to. Messages are tuples
+                whose first element is 'ready', 'start', 'done'
+                or 'exit'. A task is only sent after 'ready'.
+            maxtasks: Exit after this many tasks.
+                (Default: no limit)
+            maxgrowth: Exit once resident memory has grown by more
+                than this many bytes since the first task ended.
+                (Default: no limit)
+            initializer: A function to call when the worker starts.
+                (Default: None)
+            notify: A function to call after reporting to 'results'.
+                (Default: None)
+
+        Outputs:
+            None
+    """
+    pid = os.getpid()
+    if initializer is not None:
+        initializer()
+    ntasks = 0
+    baseline = None
+    reason = "stopped"
+    while True:
+        results.put(('ready', pid))
+        try:
+            item = tasks.recv()
+        except EOFError:
+            # The pool has gone away
+            break
+        if item is None:
+            break
+        taskid, args = item
+        results.put(('start', pid, taskid))
+        try:
+            target(*args)
+        except Exception:
+            results.put(('done', pid, taskid, traceback.format_exc()))
+        else:
+            results.put(('done', pid, taskid, None))
+        if notify is not None:
+            notify()
+        ntasks += 1
+        rss = get_rss()
+        if baseline is None:
+            # Don't count memory allocated by caches filling up
+            # during the first task
+            baseline = rss
+        if maxtasks and (ntasks >= maxtasks):
+            reason = "ran %d tasks" % ntasks
+            break
+        if maxgrowth and (rss-baseline > maxgrowth):
+            reason = "memory grew by %d MB" % ((rss-baseline)/1024**2)
+            break
+    results.put(('exit', pid, reason))
+
+
+class WorkerPool(object):
+    def __init__(self, numproc, target, maxtasks=None, maxgrowth=None,
+                 initializer=None, notify=None):
+        """A pool of long-lived worker processes.
+
+            Inputs:
+                numproc: The number of workers.
+                target: The function to call for each task.
+                maxtasks: Replace a worker after it has run this
+                    many tasks. (Default: no limit)
+                maxgrowth: Replace a worker once its resident memory
+                    has grown by this many bytes. (Default: no limit)
+                initializer: A function each worker calls when it
+                    starts. (Default: None)
+                notify: A function each worker calls after it
+                    finishes a task. (Default: None)
+        """
+        self.numproc = numproc
+        self.target = target
+        self.maxtasks = maxtasks
+        self.maxgrowth = maxgrowth
+        self.initializer = initializer
+        self.notify = notify
+        # Messages are written to the results pipe synchronously,
+        # so none are lost if a worker dies suddenly
+        self.results = multiprocessing.queues.SimpleQueue()
+        # Maps worker PIDs to Process objects
+        self.workers = {}
+        # Maps worker PIDs to the connection tasks are sent through
+        self.conns = {}
+        # PIDs of workers waiting for a task, in the order they
+        # became ready
+        self.idle = []
+        # Maps worker PIDs to the ID of the task they were given
+        self.running = {}
+        # Tasks submitted but not given to a worker yet, as
+        # (taskid, args) tuples
+        self.pending = collections.deque()
+        # IDs of tasks submitted but not started yet
+        self.unstarted = set()
+        self.closing = False
+        self.fill()
+
+    def fill(self):
+        """Start workers until there are 'numproc' of them.
+        """
+        while len(self.workers) < self.numproc:
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=work, name="worker",
+                                           args=(self.target, reader,
+                                                 self.results, self.maxtasks,
+                                                 self.maxgrowth,
+                                                 self.initializer,
+                                                 self.notify))
+            proc.start()
+            reader.close()
+            self.workers[proc.pid] = proc
+            self.conns[proc.pid] = writer
+            utils.print_debug("Started worker (PID: %d)" % proc.pid,
+                              'reduce')
+
+    def get_nfree(self):
+        """Return the number of tasks that can be submitted
+            without waiting.
+        """
+        return max(0, self.numproc - len(self.running) - len(self.pending))
+
+    def get_nbusy(self):
+        """Return the number of tasks submitted that haven't
+            finished yet.
+        """
+        return len(self.running) + len(self.pending)
+
+    def is_queued(self, taskid):
+        """Return True if a task has been submitted, but no worker
+            has started it yet.
+        """
+        return taskid in self.unstarted
+
+    def submit(self, taskid, *args):
+        """Submit a task.
+
+            Inputs:
+                taskid: An identifier for the task.
+                *args: Arguments to pass to the target function.
+
+            Outputs:
+                None
+        """
+        self.pending.append((taskid, args))
+        self.unstarted.add(taskid)
+        self.dispatch()
+
+    def dispatch(self):
+        """Give pending tasks to workers that are ready.
+
+            Inputs:
+                None
+
+            Outputs:
+                None
+        """
+        while self.pending and self.idle:
+            pid = self.idle.pop(0)
+            taskid, args = self.pending[0]
+            try:
+                self.conns[pid].send((taskid, args))
+            except (IOError, OSError):
+                # The worker has died. It is replaced by 'collect'.
+                continue
+            self.pending.popleft()
+            self.running[pid] = taskid
+
+    def collect(self):
+        """Process messages from workers, replace workers that
+            have exited and give pending tasks to workers that
+            are ready.
+
+            Inputs:
+                None
+
+            Output:
+                finished: A list of (taskid, error) tuples of
+                    finished tasks. 'error' is None for tasks that
+                    succeeded, and an error message otherwise.
+        """
+        finished = []
+        # Find workers that have exited before reading messages,
+        # so all of their messages are read below.
+        exited = [pid for pid, proc in self.workers.iteritems()
+                  if not proc.is_alive()]
+        while not self.results.empty():
+            msg = self.results.get()
+            if msg[0] == 'ready':
+                pid = msg[1]
+                self.idle.append(pid)
+            elif msg[0] == 'start':
+                pid, taskid = msg[1:]
+                self.unstarted.discard(taskid)
+            elif msg[0] == 'done':
+                pid, taskid, error = msg[1:]
+                self.running.pop(pid, None)
+                finished.append((taskid, error))
+            elif msg[0] == 'exit':
+                pid, reason = msg[1:]
+                utils.print_debug("Worker (PID: %d) exited (%s)" %
+                                  (pid, reason), 'reduce')
+        for pid in exited:
+            proc = self.workers.pop(pid)
+            proc.join()
+            self.conns.pop(pid).close()
+            if pid in self.idle:
+                self.idle.remove(pid)
+            if pid in self.running:
+                # The worker died holding a task
+                taskid = self.running.pop(pid)
+                if taskid in self.unstarted:
+                    self.unstarted.discard(taskid)
+                    error = "Worker (PID: %d) died with exit code %s " \
+                            "before starting the task" % (pid, proc.exitcode)
+                else:
+                    error = "Worker (PID: %d) died with exit code %s" % \
+                            (pid, proc.exitcode)
+                finished.append((taskid, error))
+        if not self.closing:
+            self.fill()
+            self.dispatch()
+        return finished
+
+    def close(self, timeout=None):
+        """Stop the workers once they have finished their tasks.
+            Tasks not given to a worker yet are not run.
+
+            Input:
+                timeout: Maximum number of seconds to wait for
+                    each worker to stop. (Default: wait forever)
+
+            Outputs:
+                None
+        """
+        self.closing = True
+        for conn in self.conns.values():
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                # The worker has already died
+                pass
+        for proc in self.workers.values():
+            proc.join(timeout)
+        self.collect()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from coast_guard import config
+from coast_guard import utils
+
+def main():
+    fn = args.outfn or config.version_file
+    if fn is None:
+        raise ValueError("No version file given, and 'version_file' "
+                         "is not configured.")
+    utils.write_version_file(fn)
+    print "Wrote %s (Coast Guard: %s, PSRCHIVE: %s)" % \
+                ((fn,)+utils.read_version_file(fn))
+
+
+if __name__ == '__main__':
+    parser = utils.DefaultArguments(description="Record the versions " \
+                        "of Coast Guard and PSRCHIVE in a version file " \
+                        "(e.g. at deploy time), so the pipeline doesn't " \
+                        "need to inspect the git repositories.")
+    parser.add_argument("-o", "--outfn", dest='outfn', type=str, \
+                        default=None, \
+                        help="File to write. (Default: the configured " \
+                            "'version_file'.)")
+    args = parser.parse_args()
+    main()